@@ -1,8 +1,11 @@
 # Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
 
-from . import gui
-from .app import App
+from .timing import profile_startup
+
+with profile_startup('import app'):
+    from . import gui
+    from .app import App
 
 
 INFO = dict(title='Algaware page',
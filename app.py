@@ -4,33 +4,78 @@
 # To use basemap you might need to install Microsoft Visual C++: https://visualstudio.microsoft.com/visual-cpp-build-tools/
 
 
+import collections.abc
 import os
+import time
 import tkinter as tk
 
 from plugins.SHARKtools_algaware import gui
-import core
 
+from plugins.plugin_app import PluginApp
 
-from sharkpylib import loglib
-import sharkpylib.tklib.tkinter_widgets as tkw
+from .session import create_session
+from .data_cache import shared_data_cache
+from .compact import format_memory_report
+from .timing import import_module, profile_startup, log_startup_report
+from .jobs import Job
+from .pipeline import PeriodPipeline
+from . import events
+from . import saves
 
-from plugins.plugin_app import PluginApp
 
-import algaware
+class LazyPages(collections.abc.Mapping):
+    """
+    Page name to page class. The class is looked up in gui (and its module imported) on first access.
+    """
+    def __init__(self, page_names):
+        self._page_names = list(page_names)
+
+    def __getitem__(self, page_name):
+        if page_name not in self._page_names:
+            raise KeyError(page_name)
+        return getattr(gui, page_name)
+
+    def __iter__(self):
+        return iter(self._page_names)
+
+    def __len__(self):
+        return len(self._page_names)
+
 
+class LazyPageNames(collections.abc.Mapping):
+    """
+    Page class to page name, the inverse of pages (LazyPages). Looking up a class does not import the other pages.
+    """
+    def __init__(self, pages):
+        self._pages = pages
+
+    def __getitem__(self, page):
+        page_name = getattr(page, '__name__', None)
+        if page_name not in self._pages or self._pages[page_name] is not page:
+            raise KeyError(page)
+        return page_name
+
+    def __iter__(self):
+        return iter(self._pages.values())
 
-ALL_PAGES = dict()
-ALL_PAGES['PageAlgaware'] = gui.PageAlgaware
-ALL_PAGES['PageUser'] = gui.PageUser
+    def __len__(self):
+        return len(self._pages)
 
-APP_TO_PAGE = dict()
-for page_name, page in ALL_PAGES.items():
-    APP_TO_PAGE[page] = page_name
+
+ALL_PAGES = LazyPages(['PageAlgaware', 'PageUser'])
+
+APP_TO_PAGE = LazyPageNames(ALL_PAGES)
 
 
 class App(PluginApp):
     """
     """
+    # Create pages not yet shown when the GUI is idle after startup
+    prewarm_pages = False
+
+    # Copy the CTD files of the period to a local directory before loading (see ctd_staging.CTDStaging)
+    stage_ctd_files = False
+
     def __init__(self, parent, main_app, **kwargs):
         PluginApp.__init__(self, parent, main_app, **kwargs)
         # parent is the frame "container" in App. controller is the App class
@@ -46,17 +91,26 @@ class App(PluginApp):
 
     def startup(self):
         """
+        Set environment variable ALGAWARE_PROFILE_STARTUP=1 to log import and construction time
+        of modules and pages (see timing.profile_startup).
         """
+        with profile_startup('startup App'):
+            self._startup()
+        log_startup_report(self.log_directory)
+
+    def _startup(self):
         # Setting upp GUI logger
         if not os.path.exists(self.log_directory):
             os.makedirs(self.log_directory)
 
+        core = import_module('core')
         self.paths = core.Paths(self.plugin_directory)
 
         self.user_manager = self.main_app.user_manager
         self.user = self.main_app.user
 
-        self.alg_session = algaware.core.Session()
+        self.session = self._create_session()
+        self.alg_session = self.session.alg_session
 
         self._create_titles()
 
@@ -72,6 +126,9 @@ class App(PluginApp):
 
         self._set_frame()
 
+        # Debounced events are delivered on the Tk thread
+        events.set_scheduler(self)
+
         self.startup_pages()
 
         self.page_history = ['PageUser']
@@ -79,18 +136,29 @@ class App(PluginApp):
 
         self.update_all()
 
+    def _create_session(self):
+        # pyplot in this process belongs to the main app, so figures are drawn in worker processes
+        return create_session(log_directory=self.log_directory,
+                              shared_data_cache=shared_data_cache,
+                              stage_ctd_files=self.stage_ctd_files,
+                              render_in_subprocess=True)
+
     def update_page(self):
         self.update_all()
 
     def close(self):
+        self.session.close()
+        events.shutdown()
         for page_name, frame in self.frames.items():
             if self.pages_started.get(page_name):
                 try:
                     frame.close()
                 except:
                     pass
+        saves.flush_all()
 
     def _set_frame(self):
+        tkw = import_module('sharkpylib.tklib.tkinter_widgets')
         self.frame_top = tk.Frame(self, bg='red')
 
         # Grid
@@ -106,28 +174,58 @@ class App(PluginApp):
         tkw.grid_configure(self.frame_top)
 
     def startup_pages(self):
-        # Tuple that store all pages
-        
-        self.pages_started = dict()
-
-        # Dictionary to store all frame classes
-        self.frames = {}
-        
-        # Looping all pages to make them active. 
-        for page_name, Page in ALL_PAGES.items():  # Capital P to emphasize class
-            # Destroy old page if called as an update
+        """
+        Pages are created on their first show_frame (or when the GUI is idle if prewarm_pages).
+        """
+        # Destroy old pages if called as an update
+        for page_name, frame in getattr(self, 'frames', {}).items():
             try:
-                self.frames[page_name].destroy()
-                print(Page, u'Destroyed')
+                frame.destroy()
+                print(page_name, u'Destroyed')
             except:
                 pass
+
+        self.pages_started = dict()
+
+        # Dictionary to store all created frames
+        self.frames = {}
+
+        self.container.rowconfigure(0, weight=1)
+        self.container.columnconfigure(0, weight=1)
+
+        if self.prewarm_pages:
+            self.after_idle(self._prewarm_pages)
+
+    def _create_page(self, page_name):
+        Page = ALL_PAGES[page_name]  # Capital P to emphasize class
+        t0 = time.perf_counter()
+        with profile_startup(f'construct {page_name}'):
             frame = Page(self.container, self)
-            frame.grid(row=0, column=0, sticky="nsew")
+        frame.grid(row=0, column=0, sticky="nsew")
+        self.frames[page_name] = frame
+        self.logger.info(f'Page {page_name} created in {time.perf_counter() - t0:.3f} s')
+        return frame
+
+    def get_frame(self, page_name):
+        """
+        :param page_name:
+        :return: The frame of the given page. The page is created if not done before.
+        """
+        if page_name not in self.frames:
+            self._create_page(page_name)
+        return self.frames[page_name]
 
-            self.container.rowconfigure(0, weight=1)
-            self.container.columnconfigure(0, weight=1) 
-            
-            self.frames[page_name] = frame
+    def _prewarm_pages(self):
+        """
+        Creates one page not yet created and schedules the next, so the GUI stays responsive between pages.
+        """
+        for page_name in ALL_PAGES:
+            if page_name not in self.frames:
+                self._create_page(page_name)
+                if self.active_page in self.frames:
+                    self.frames[self.active_page].tkraise()
+                self.after_idle(self._prewarm_pages)
+                return
 
     def _set_load_frame(self):
         pass
@@ -146,21 +244,22 @@ class App(PluginApp):
         """
 
         load_page = True
-        frame = self.frames[page_name]
+        frame = self.get_frame(page_name)
         # self.withdraw()
         if not self.pages_started.get(page_name, None):
-            frame.startup()
+            with profile_startup(f'startup {page_name}'):
+                frame.startup()
             self.pages_started[page_name] = True
         frame.update_page()
 
         if load_page:
             frame.tkraise()
             self.previous_page = self.active_page
-            self.active_page = page
+            self.active_page = page_name
             # Check page history
-            if page in self.page_history:
+            if page_name in self.page_history:
                 self.page_history.pop()
-                self.page_history.append(page)
+                self.page_history.append(page_name)
         self.update()
 
     def goto_previous_page(self, event):
@@ -190,23 +289,56 @@ class App(PluginApp):
         """
         :return:
         """
-        df = self.alg_session.get_xlist()
-        return df
+        return self.session.get_data_xlist()
 
     def load_data(self, update_kwargs,
                   ctd_directory=None,
                   lims_path=None,
-                  archive_root_dir=None):
+                  archive_root_dir=None,
+                  stations=None,
+                  job=None):
+        """
+        :param stations: Only load the rows of the LIMS export for these stations
+        :return:
+        """
+        self.session.load_data(update_kwargs,
+                               ctd_directory=ctd_directory,
+                               lims_path=lims_path,
+                               archive_root_dir=archive_root_dir,
+                               stations=stations,
+                               job=job)
+
+    def is_data_loaded(self):
+        """
+        :return: True if the latest load has finished. Nothing can be plotted after a cancelled or failed load.
+        """
+        return self.session.data_loaded
+
+    def set_compact_data(self, compact_data):
         """
+        :param compact_data: Make the loaded tables smaller from the next load (see compact.compact_frame)
         :return:
         """
-        self.alg_session.update_attributes(**update_kwargs)
-        self.alg_session.update_year(self.alg_session.start_time.year)
-        self.alg_session.initialize_statistic_handler()
-        self.alg_session.initialize_data_handler(ctd_directory=ctd_directory,
-                                                 lims_path=lims_path,
-                                                 archive_root_dir=archive_root_dir)
-        self.alg_session.load_data()
+        self.session.compact_data = bool(compact_data)
+
+    def get_memory_report(self):
+        """
+        :return: Text with memory used by the loaded tables and their largest columns
+        """
+        return format_memory_report(self.session.get_memory_report())
+
+    def get_timing_summary(self):
+        """
+        :return: Text with time spent in each stage of the latest load or plot
+        """
+        return self.session.timer.get_summary()
+
+    def rebuild_archive_index(self, archive_root_dir):
+        """
+        :param archive_root_dir:
+        :return: number of files in the index
+        """
+        return self.session.rebuild_archive_index(archive_root_dir)
 
     def plot(self, figure_key, save_as_format=None):
         """
@@ -214,7 +346,77 @@ class App(PluginApp):
         :param save_as_format:
         :return:
         """
-        self.alg_session.initialize_figure_handler()
-        self.alg_session.update_figure_settings(figure_key)
-        self.alg_session.initialize_plot_handler()
-        self.alg_session.plot_figure(save_as_format=save_as_format)
+        self.session.plot(figure_key, save_as_format=save_as_format)
+
+    def plot_figures(self, figure_keys, save_as_format=None, parallel=False, nr_workers=None, job=None):
+        """
+        :param figure_keys:
+        :param save_as_format:
+        :param parallel: Render each figure_key in its own worker process
+        :param nr_workers: Number of worker processes. Defaults to the number of cores.
+        :param job:
+        :return: dict with figure_key as key and None or the raised exception as value
+        """
+        return self.session.plot_figures(figure_keys,
+                                         save_as_format=save_as_format,
+                                         parallel=parallel,
+                                         nr_workers=nr_workers,
+                                         job=job)
+
+    def plot_periods(self, periods, figure_keys,
+                     save_as_format=None,
+                     ctd_directory=None,
+                     lims_path=None,
+                     archive_root_dir=None,
+                     job=None):
+        """
+        Loads and plots each period. The next period is loaded while the current one is plotted
+        (see pipeline.PeriodPipeline). Uses separate sessions, so the data loaded in the page is kept.
+        :param periods: list of (start_time, end_time)
+        :param figure_keys:
+        :param save_as_format:
+        :param ctd_directory:
+        :param lims_path:
+        :param archive_root_dir:
+        :param job:
+        :return: dict with period as key and a dict (figure_key: None or exception)
+                 or the exception raised when creating the session or loading as value
+        """
+        pipeline = PeriodPipeline(self._create_session)
+        return pipeline.run(periods, figure_keys,
+                            save_as_format=save_as_format,
+                            load_kwargs=dict(ctd_directory=ctd_directory,
+                                             lims_path=lims_path,
+                                             archive_root_dir=archive_root_dir),
+                            job=job)
+
+    def start_job(self, name, target, on_progress=None, on_done=None, on_error=None, on_cancelled=None):
+        """
+        Runs target(job) in a background thread. Callbacks are called in the tkinter thread.
+        Only one job can run at a time.
+        :param name:
+        :param target:
+        :param on_progress: called with stage, step, nr_steps
+        :param on_done: called with the return value of target
+        :param on_error: called with the raised exception
+        :param on_cancelled:
+        :return: jobs.Job or None if a job is already running
+        """
+        if self.progress_running:
+            return None
+
+        def finished(func):
+            def wrapper(*args):
+                self.progress_running = False
+                if func:
+                    func(*args)
+            return wrapper
+
+        self.progress_running = True
+        job = Job(self, target,
+                  name=name,
+                  on_progress=on_progress,
+                  on_done=finished(on_done),
+                  on_error=finished(on_error),
+                  on_cancelled=finished(on_cancelled))
+        return job.start()
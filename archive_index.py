@@ -0,0 +1,414 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import bisect
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+# Increase when the structure of the index file changes
+INDEX_FORMAT_VERSION = 2
+
+DEFAULT_INDEX_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent, 'cache', 'archive_index')
+
+DATE_PATTERN = re.compile(r'^(\d{4})-?(\d{2})-?(\d{2})$')
+
+# Dataset directory in the SHARK archive, e.g. SHARK_PhysicalChemical_2019_BAS_SMHI. Holds data for the year.
+DATASET_PATTERN = re.compile(r'^SHARK_[^_]+_(\d{4})(?:_|$)', re.IGNORECASE)
+
+# Columns in tab separated data files (e.g. processed_data/data.txt) holding sample date and station
+DATE_COLUMNS = ['SDATE', 'sample_date', 'Provtagningsdatum']
+STATION_COLUMNS = ['STATN', 'station_name', 'Station']
+
+DATA_FILE_SUFFIXES = ['.txt']
+DATA_FILE_ENCODING = 'cp1252'
+
+# Line in the header of Sea-Bird cnv files holding the station name, e.g. "** Station: BY2 ARKONA"
+CNV_STATION_PATTERN = re.compile(r'^\*\*\s*Station\s*:\s*(.*?)\s*$', re.IGNORECASE)
+CNV_END_OF_HEADER = '*END*'
+
+
+def parse_file_date(name):
+    """
+    Returns the date (YYYY-MM-DD) in a file name: the first part of the name (split on "_" and " ") that is a date.
+    :param name:
+    :return: date or None if not found
+    """
+    for part in re.split(r'[_ ]', pathlib.Path(name).stem):
+        match = DATE_PATTERN.match(part)
+        if not match:
+            continue
+        try:
+            return datetime.date(*[int(item) for item in match.groups()]).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def get_dataset_period(name):
+    """
+    :param name: Name of a directory in the archive
+    :return: tuple (start_date, end_date) of the year of a SHARK dataset directory or None for other directories
+    """
+    match = DATASET_PATTERN.match(name)
+    if not match:
+        return None
+    year = match.group(1)
+    return f'{year}-01-01', f'{year}-12-31'
+
+
+def _normalize_date(value):
+    match = re.match(r'^(\d{4})[-/.]?(\d{2})[-/.]?(\d{2})(?!\d)', value.strip().strip('"'))
+    if not match:
+        return ''
+    return '-'.join(match.groups())
+
+
+def _get_column_index(header, alternatives):
+    for name in alternatives:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def _read_data_file(path):
+    """
+    Reads the sample dates and stations in a tab separated data file.
+    :param path:
+    :return: tuple (first date, last date, sorted list of stations) or None if the file has no date column
+    """
+    first_date = ''
+    last_date = ''
+    stations = set()
+    with open(path, encoding=DATA_FILE_ENCODING, errors='replace') as fid:
+        header = [item.strip().strip('"') for item in fid.readline().rstrip('\r\n').split('\t')]
+        date_index = _get_column_index(header, DATE_COLUMNS)
+        station_index = _get_column_index(header, STATION_COLUMNS)
+        if date_index is None:
+            return None
+        for line in fid:
+            values = line.rstrip('\r\n').split('\t')
+            if len(values) > date_index:
+                date = _normalize_date(values[date_index])
+                if date:
+                    first_date = min(first_date, date) if first_date else date
+                    last_date = max(last_date, date)
+            if station_index is not None and len(values) > station_index:
+                station = values[station_index].strip().strip('"').upper()
+                if station:
+                    stations.add(station)
+    return first_date, last_date, sorted(stations)
+
+
+def _read_cnv_station(path):
+    """
+    :param path: Sea-Bird cnv file
+    :return: Station name in the header or None
+    """
+    with open(path, encoding=DATA_FILE_ENCODING, errors='replace') as fid:
+        for line in fid:
+            if line.startswith(CNV_END_OF_HEADER):
+                break
+            match = CNV_STATION_PATTERN.match(line)
+            if match and match.group(1):
+                return match.group(1).upper()
+    return None
+
+
+def get_file_info(path, period=None):
+    """
+    Returns the period and the stations of the data in a file:
+        tab separated data files (e.g. processed_data/data.txt in a SHARK dataset): read from the sample date
+            and station columns
+        Sea-Bird cnv files: the station in the header and the date in the file name
+        other files: the date in the file name or else the period of the dataset directory
+    :param path:
+    :param period: tuple (start_date, end_date) of the dataset directory holding the file (see get_dataset_period)
+    :return: tuple (start_date, end_date, stations). Dates are "" if not known. stations is an empty list if not known.
+    """
+    path = pathlib.Path(path)
+    start_date, end_date = period or ('', '')
+    date = parse_file_date(path.name)
+    if date:
+        start_date = end_date = date
+    stations = []
+    try:
+        if path.suffix.lower() in DATA_FILE_SUFFIXES:
+            data_info = _read_data_file(path)
+            if data_info:
+                first_date, last_date, stations = data_info
+                if first_date:
+                    start_date, end_date = first_date, last_date
+        elif path.suffix.lower() == '.cnv':
+            station = _read_cnv_station(path)
+            stations = [station] if station else []
+    except OSError as e:
+        logger.warning(f'Could not read {path}: {e}')
+    return start_date, end_date, stations
+
+
+def _is_in_period(period, start_date=None, end_date=None):
+    """
+    :param period: tuple (start_date, end_date) or None if not known
+    :return: True if period overlaps start_date..end_date or is not known
+    """
+    if not period:
+        return True
+    return (not end_date or period[0] <= end_date) and (not start_date or period[1] >= start_date)
+
+
+class ArchiveIndex:
+    """
+    Persistent index of the files under the archive root directory.
+    Every directory is stored with its mtime and is only listed again when the mtime has changed,
+    so update() does one stat per directory instead of walking all files.
+    Files can be looked up by data type (first folder under the root), station and date.
+
+    The date range and stations of a file are read from its content (see get_file_info) when the file is new
+    or changed: data files of SHARK datasets (SHARK_<data type>_<year>_...) hold neither in the file name.
+    If update() is given a period, dataset directories of other years are not visited.
+    """
+    def __init__(self, root_directory, index_directory=None):
+        self.root_directory = pathlib.Path(root_directory)
+        self.index_directory = pathlib.Path(index_directory or DEFAULT_INDEX_DIRECTORY)
+        name = hashlib.md5(str(self.root_directory.resolve()).encode()).hexdigest()
+        self.file_path = pathlib.Path(self.index_directory, f'{name}.json')
+        self._directories = {}
+        self._records = None
+        self._records_by_station = None
+        self._load()
+
+    def _load(self):
+        if not self.file_path.exists():
+            return
+        try:
+            with open(self.file_path) as fid:
+                data = json.load(fid)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not read archive index {self.file_path}: {e}')
+            return
+        if data.get('version') != INDEX_FORMAT_VERSION or data.get('root') != str(self.root_directory):
+            return
+        self._directories = data.get('directories', {})
+
+    def _save(self):
+        self.index_directory.mkdir(parents=True, exist_ok=True)
+        data = dict(version=INDEX_FORMAT_VERSION,
+                    root=str(self.root_directory),
+                    directories=self._directories)
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fid:
+            json.dump(data, fid)
+        os.replace(tmp_path, self.file_path)
+
+    def _scan_directory(self, rel_path, mtime, period):
+        """
+        Lists one directory. Files not changed since the previous listing keep their date range and stations.
+        :param rel_path:
+        :param mtime:
+        :param period: see get_dataset_period
+        :return: list of sub directories (relative paths)
+        """
+        previous = self._directories.get(rel_path) or {}
+        previous_files = {item[0]: item for item in previous.get('files', [])}
+        files = []
+        sub_directories = []
+        with os.scandir(pathlib.Path(self.root_directory, rel_path)) as it:
+            for entry in it:
+                if entry.is_dir():
+                    sub_directories.append(str(pathlib.Path(rel_path, entry.name)))
+                elif entry.is_file():
+                    stat = entry.stat()
+                    item = previous_files.get(entry.name)
+                    if not item or item[1:3] != [stat.st_mtime_ns, stat.st_size]:
+                        start_date, end_date, stations = get_file_info(entry.path, period)
+                        item = [entry.name, stat.st_mtime_ns, stat.st_size, start_date, end_date, stations]
+                    files.append(item)
+        self._directories[rel_path] = dict(mtime=mtime, period=period, files=files, directories=sub_directories)
+        return sub_directories
+
+    def update(self, start_date=None, end_date=None):
+        """
+        Lists directories that are new or has changed since the last update and removes the ones that are gone.
+        If a period is given, dataset directories (see get_dataset_period) of other years are not visited
+        and keep what is stored for them.
+        :param start_date: YYYY-MM-DD
+        :param end_date: YYYY-MM-DD
+        :return: number of directories listed
+        """
+        if not self.root_directory.exists():
+            self._directories = {}
+            return 0
+        nr_scanned = 0
+        found = set()
+        skipped = []
+        stack = [('.', None)]
+        while stack:
+            rel_path, period = stack.pop()
+            period = get_dataset_period(pathlib.Path(rel_path).name) or period
+            if not _is_in_period(period, start_date, end_date):
+                skipped.append(rel_path)
+                continue
+            try:
+                mtime = os.stat(pathlib.Path(self.root_directory, rel_path)).st_mtime_ns
+            except OSError:
+                continue
+            found.add(rel_path)
+            info = self._directories.get(rel_path)
+            # Editing a file in place does not change the mtime of its directory. The files of the datasets
+            # of the period are checked, so that their date range and stations are read again.
+            if info and info['mtime'] == mtime and not (period and (start_date or end_date) and
+                                                        self._has_changed_files(rel_path, info)):
+                sub_directories = info['directories']
+            else:
+                sub_directories = self._scan_directory(rel_path, mtime, period)
+                nr_scanned += 1
+            stack.extend((sub_directory, period) for sub_directory in sub_directories)
+        removed = [rel_path for rel_path in set(self._directories) - found
+                   if not any(self._is_in_directory(rel_path, skipped_path) for skipped_path in skipped)]
+        for rel_path in removed:
+            self._directories.pop(rel_path)
+        if nr_scanned or removed:
+            self._save()
+            self._records = None
+        logger.debug(f'Archive index updated: {nr_scanned} of {len(found)} directories listed, '
+                     f'{len(skipped)} directories outside the period skipped')
+        return nr_scanned
+
+    def _has_changed_files(self, rel_path, info):
+        for name, mtime, size, start_date, end_date, stations in info['files']:
+            try:
+                stat = os.stat(pathlib.Path(self.root_directory, rel_path, name))
+            except OSError:
+                return True
+            if stat.st_mtime_ns != mtime or stat.st_size != size:
+                return True
+        return False
+
+    @staticmethod
+    def _is_in_directory(rel_path, directory):
+        return rel_path == directory or pathlib.PurePath(directory) in pathlib.PurePath(rel_path).parents
+
+    def rebuild(self):
+        """
+        Throws away the stored index and lists all directories again.
+        :return:
+        """
+        self._directories = {}
+        self._records = None
+        return self.update()
+
+    def get_signature(self, start_date=None, end_date=None, stations=None):
+        """
+        Returns a string that changes when a directory in the archive that may hold data for the period changes
+        or a file that may hold data for the period is added, removed or modified. Editing a file in place does
+        not change the mtime of its directory, so these files (see get_period_files) are stat'ed again.
+        Call update() first.
+        If stations are given only the files of those stations (and files without a known station)
+        are used, so changes for other stations do not change the signature.
+        :param start_date: YYYY-MM-DD
+        :param end_date: YYYY-MM-DD
+        :param stations: list of station names
+        :return:
+        """
+        md5 = hashlib.md5()
+        if stations is None:
+            for rel_path in sorted(self._directories):
+                info = self._directories[rel_path]
+                if _is_in_period(info.get('period'), start_date, end_date):
+                    md5.update(f'{rel_path}:{info["mtime"]};'.encode())
+        paths = self.get_period_files(start_date=start_date, end_date=end_date, stations=stations)
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                md5.update(f'{path}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+            except OSError:
+                md5.update(f'{path}:;'.encode())
+        logger.debug(f'Archive signature from {len(paths)} files')
+        return md5.hexdigest()
+
+    def get_period_files(self, start_date=None, end_date=None, stations=None):
+        """
+        Returns paths to the files that may hold data for the period: files with data in the period
+        and all files without a known date. All files if no period is given. Call update() first.
+        :param start_date: YYYY-MM-DD
+        :param end_date: YYYY-MM-DD
+        :param stations: Only files with data for these stations and files without a known station
+        :return: sorted list of paths
+        """
+        if self._records is None:
+            self._build_lookup()
+        if stations is None:
+            groups = [self._records]
+        else:
+            keys = set([''] + [station.upper() for station in stations])
+            groups = [self._records_by_station.get(key, []) for key in keys]
+        paths = set()
+        for records in groups:
+            if start_date or end_date:
+                # Files without a date are sorted first
+                nr_undated = bisect.bisect_left(records, ('0',))
+                records = records[:nr_undated] + self._get_date_range(records, start_date, end_date)
+            paths.update(record[-1] for record in records)
+        return sorted(paths)
+
+    @staticmethod
+    def _get_date_range(records, start_date, end_date):
+        """
+        :param records: records sorted on start date
+        :return: records with data in start_date..end_date
+        """
+        start = bisect.bisect_left(records, ('0',))
+        end = bisect.bisect_right(records, ((end_date or '9999') + '\uffff',))
+        return [record for record in records[start:end] if not start_date or record[1] >= start_date]
+
+    def _build_lookup(self):
+        """
+        Builds in memory lookup tables: all files sorted on start date and the same per station.
+        Files are listed under each of their stations, and under station "" if no station is known.
+        Records are tuples (start_date, end_date, data_type, path). Files without a date have dates "".
+        """
+        records = []
+        records_by_station = {}
+        for rel_path, info in self._directories.items():
+            parts = pathlib.Path(rel_path).parts
+            data_type = parts[0] if parts else ''
+            for name, mtime, size, start_date, end_date, stations in info['files']:
+                record = (start_date or '', end_date or '', data_type,
+                          str(pathlib.Path(self.root_directory, rel_path, name)))
+                records.append(record)
+                for station in stations or ['']:
+                    records_by_station.setdefault(station, []).append(record)
+        self._records = sorted(records)
+        self._records_by_station = {station: sorted(items) for station, items in records_by_station.items()}
+
+    def lookup(self, data_type=None, station=None, start_date=None, end_date=None):
+        """
+        Returns paths to the indexed files matching the given criteria. Call update() first.
+        :param data_type: Name of the first folder under the root directory
+        :param station:
+        :param start_date: YYYY-MM-DD
+        :param end_date: YYYY-MM-DD
+        :return:
+        """
+        if self._records is None:
+            self._build_lookup()
+        records = self._records
+        if station:
+            records = self._records_by_station.get(station.upper(), [])
+        if start_date or end_date:
+            records = self._get_date_range(records, start_date, end_date)
+        return [pathlib.Path(path) for file_start_date, file_end_date, file_data_type, path in records
+                if not data_type or file_data_type == data_type]
+
+    @property
+    def nr_files(self):
+        return sum(len(info['files']) for info in self._directories.values())
@@ -0,0 +1,216 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+Headless loading and plotting of AlgAware figures for many periods.
+
+Example (from the SHARKtools root directory):
+    python -m plugins.SHARKtools_algaware.batch --archive-root //share/arkiv --periods 2020-01 2020-02 --workers 2
+    python -m plugins.SHARKtools_algaware.batch --archive-root //share/arkiv --periods 2020-01 2020-02 2020-03 --pipeline
+"""
+
+import argparse
+import calendar
+import datetime
+import functools
+import logging
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .render import use_non_interactive_backend, get_nr_workers, ALL_FORMATS
+from .statistics_store import StatisticsStore
+from .pipeline import PeriodPipeline
+
+
+logger = logging.getLogger(__name__)
+
+# Directory for the timing file (see timing.StageTimer)
+DEFAULT_LOG_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent, 'log')
+
+DEFAULT_AREAS = ['The Skagerrak', 'The Kattegat and The Sound', 'The Southern Baltic',
+                 'The Western Baltic', 'The Eastern Baltic']
+
+
+def get_period(string):
+    """
+    Returns a tuple (start_time, end_time) as strings in format %Y-%m-%d.
+    :param string: "YYYY-MM" for a whole month or "YYYY-MM-DD:YYYY-MM-DD"
+    :return:
+    """
+    if ':' in string:
+        sdate, edate = [item.strip() for item in string.split(':')]
+        for item in [sdate, edate]:
+            datetime.datetime.strptime(item, '%Y-%m-%d')
+        return sdate, edate
+    month = datetime.datetime.strptime(string.strip(), '%Y-%m').date()
+    end_day = calendar.monthrange(month.year, month.month)[1]
+    return month.strftime('%Y-%m-%d'), month.replace(day=end_day).strftime('%Y-%m-%d')
+
+
+def _run_period(period, areas, save_as_format, ctd_directory, lims_path, archive_root_dir, stations,
+                log_directory):
+    use_non_interactive_backend()
+    session = _create_batch_session(log_directory=log_directory)
+    start_time, end_time = period
+    session.load_data({'start_time': start_time, 'end_time': end_time},
+                      ctd_directory=ctd_directory,
+                      lims_path=lims_path,
+                      archive_root_dir=archive_root_dir,
+                      stations=stations)
+    result = session.plot_figures(areas, save_as_format=save_as_format)
+    return {figure_key: str(error) if error else None for figure_key, error in result.items()}
+
+
+def _create_batch_session(log_directory=DEFAULT_LOG_DIRECTORY):
+    # Same caches as in the App. Figures are drawn in this process, which has no GUI.
+    from .session import create_session
+    return create_session(log_directory=log_directory)
+
+
+def run_pipeline(periods,
+                 areas=None,
+                 archive_root_dir=None,
+                 ctd_directory=None,
+                 lims_path=None,
+                 stations=None,
+                 save_as_format=None,
+                 max_buffered=1,
+                 log_directory=DEFAULT_LOG_DIRECTORY):
+    """
+    Loads and plots all periods in this process. The next period is loaded while the current is plotted.
+    :param periods: list of (start_time, end_time) or strings accepted by get_period
+    :param areas: list of figure_keys. Defaults to DEFAULT_AREAS
+    :param archive_root_dir:
+    :param ctd_directory:
+    :param lims_path:
+    :param stations: Only load the rows of the LIMS export for these stations
+    :param save_as_format:
+    :param max_buffered: Max number of loaded periods waiting to be plotted
+    :param log_directory: Directory for the timing file
+    :return: dict with period as key and a dict (figure_key: error or None) or the raised exception as value
+    """
+    use_non_interactive_backend()
+    periods = [get_period(period) if isinstance(period, str) else tuple(period) for period in periods]
+    pipeline = PeriodPipeline(functools.partial(_create_batch_session, log_directory=log_directory),
+                              max_buffered=max_buffered)
+    result = pipeline.run(periods, list(areas or DEFAULT_AREAS),
+                          save_as_format=save_as_format or ['png', 'pdf'],
+                          load_kwargs=dict(ctd_directory=ctd_directory,
+                                           lims_path=lims_path,
+                                           archive_root_dir=archive_root_dir,
+                                           stations=stations))
+    for period, value in result.items():
+        if not isinstance(value, Exception):
+            result[period] = {figure_key: str(error) if error else None for figure_key, error in value.items()}
+    return result
+
+
+def run_batch(periods,
+              areas=None,
+              archive_root_dir=None,
+              ctd_directory=None,
+              lims_path=None,
+              stations=None,
+              save_as_format=None,
+              nr_workers=None,
+              log_directory=DEFAULT_LOG_DIRECTORY):
+    """
+    Loads data and plots figures for all periods. Each period is handled in its own worker process.
+    :param periods: list of (start_time, end_time) or strings accepted by get_period
+    :param areas: list of figure_keys. Defaults to DEFAULT_AREAS
+    :param archive_root_dir:
+    :param ctd_directory:
+    :param lims_path:
+    :param stations: Only load the rows of the LIMS export for these stations
+    :param save_as_format:
+    :param nr_workers: Number of worker processes. Defaults to the number of cores.
+    :param log_directory: Directory for the timing file
+    :return: dict with period as key and a dict (figure_key: error or None) or the raised exception as value
+    """
+    periods = [get_period(period) if isinstance(period, str) else tuple(period) for period in periods]
+    areas = list(areas or DEFAULT_AREAS)
+    save_as_format = save_as_format or ['png', 'pdf']
+    nr_workers = get_nr_workers(nr_workers, nr_jobs=len(periods))
+    logger.info(f'Running {len(periods)} periods using {nr_workers} worker processes')
+    result = {}
+    with ProcessPoolExecutor(max_workers=nr_workers) as executor:
+        futures = {executor.submit(_run_period, period, areas, save_as_format,
+                                   ctd_directory, lims_path, archive_root_dir, stations, log_directory): period
+                   for period in periods}
+        for future in as_completed(futures):
+            period = futures[future]
+            try:
+                result[period] = future.result()
+                logger.info(f'Period {period[0]} - {period[1]} done')
+            except Exception as e:
+                logger.error(f'Period {period[0]} - {period[1]} failed: {e}')
+                result[period] = e
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Plot AlgAware figures for one or more periods without the GUI.')
+    parser.add_argument('--archive-root', dest='archive_root_dir', default=None)
+    parser.add_argument('--ctd-directory', dest='ctd_directory', default=None)
+    parser.add_argument('--lims-path', dest='lims_path', default=None)
+    parser.add_argument('--stations', nargs='+', default=None,
+                        help='Only load the rows of the LIMS export for these stations')
+    parser.add_argument('--periods', nargs='+', default=[],
+                        help='"YYYY-MM" for a whole month or "YYYY-MM-DD:YYYY-MM-DD"')
+    parser.add_argument('--build-statistics', dest='statistics_years', nargs='+', type=int, default=[],
+                        help='Compute and store the statistics for the given years')
+    parser.add_argument('--rebuild-statistics', dest='rebuild_statistics', action='store_true',
+                        help='Compute the statistics for --build-statistics also for years that are already stored')
+    parser.add_argument('--areas', nargs='+', default=DEFAULT_AREAS)
+    parser.add_argument('--formats', nargs='+', default=['png', 'pdf'],
+                        help=f'Any of {ALL_FORMATS} or ALL')
+    parser.add_argument('--workers', dest='nr_workers', type=int, default=None)
+    parser.add_argument('--log-directory', dest='log_directory', default=str(DEFAULT_LOG_DIRECTORY),
+                        help='Directory for the timing file')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run all periods in one process, loading the next period while plotting the current')
+    args = parser.parse_args(args)
+
+    if not args.periods and not args.statistics_years:
+        parser.error('Nothing to do. Give --periods and/or --build-statistics')
+    if args.periods and not args.archive_root_dir and not args.lims_path:
+        parser.error('One of --archive-root or --lims-path must be given')
+
+    logging.basicConfig(level=logging.INFO)
+    nr_failed = 0
+    if args.statistics_years:
+        statistics_result = StatisticsStore().build(args.statistics_years, nr_workers=args.nr_workers,
+                                                   overwrite=args.rebuild_statistics)
+        nr_failed += len([error for error in statistics_result.values() if error])
+    if not args.periods:
+        return 1 if nr_failed else 0
+
+    if args.pipeline:
+        result = run_pipeline(args.periods,
+                              areas=args.areas,
+                              archive_root_dir=args.archive_root_dir,
+                              ctd_directory=args.ctd_directory,
+                              lims_path=args.lims_path,
+                              stations=args.stations,
+                              save_as_format=args.formats,
+                              log_directory=args.log_directory)
+    else:
+        result = run_batch(args.periods,
+                           areas=args.areas,
+                           archive_root_dir=args.archive_root_dir,
+                           ctd_directory=args.ctd_directory,
+                           lims_path=args.lims_path,
+                           stations=args.stations,
+                           save_as_format=args.formats,
+                           nr_workers=args.nr_workers,
+                           log_directory=args.log_directory)
+    for period, value in sorted(result.items()):
+        if isinstance(value, Exception):
+            nr_failed += 1
+            continue
+        nr_failed += len([error for error in value.values() if error])
+    return 1 if nr_failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,278 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+Benchmarks of loading and plotting on synthetic data. Results are stored as json and compared to a saved baseline.
+
+Example (from the SHARKtools root directory):
+    python -m plugins.SHARKtools_algaware.benchmarks.run --scale medium --save-baseline
+    python -m plugins.SHARKtools_algaware.benchmarks.run --scale medium
+
+The second run exits with 1 if any benchmark is slower than the baseline by more than --tolerance.
+The plugin benchmarks (archive index, CTD staging, LIMS filter) run without algaware.
+load_data, get_data_xlist and plot per area are run through a session configured as in the App
+(see session.create_session) with its caches in a new temporary directory for every repeat, so no GUI is needed.
+Each repeat measures a cold load and plot followed by a warm one in a second session using the same caches.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from . import synthetic
+from ..archive_index import ArchiveIndex
+from ..ctd_staging import CTDStaging
+from ..lims import filter_lims_export
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent.parent, 'cache', 'benchmarks')
+
+DEFAULT_AREAS = ['The Skagerrak', 'The Kattegat and The Sound', 'The Southern Baltic',
+                 'The Western Baltic', 'The Eastern Baltic']
+
+
+class Timings:
+    """
+    Collects wall times per benchmark name.
+    """
+    def __init__(self):
+        self.times = {}
+
+    def time(self, name, func, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.times.setdefault(name, []).append(time.perf_counter() - t0)
+        return result
+
+    def get_result(self):
+        return {name: dict(times=times,
+                           min=min(times),
+                           median=statistics.median(times),
+                           mean=statistics.mean(times))
+                for name, times in self.times.items()}
+
+
+def _get_period(year):
+    """
+    :return: start_time and end_time of a summer month in year (as in the monthly AlgAware report)
+    """
+    return f'{year}-07-01', f'{year}-07-31'
+
+
+def run_plugin_benchmarks(sources, timings, repeat=3):
+    """
+    Benchmarks the parts of the plugin that do not need algaware.
+    :param sources: dict from synthetic.generate
+    :param timings: Timings
+    :param repeat:
+    :return:
+    """
+    start_time, end_time = _get_period(sources['years'][-1])
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmp_directory:
+            index = ArchiveIndex(sources['archive_root_dir'], index_directory=tmp_directory)
+            timings.time('archive_index_cold', index.update)
+            index = ArchiveIndex(sources['archive_root_dir'], index_directory=tmp_directory)
+            timings.time('archive_index_warm', index.update, start_date=start_time, end_date=end_time)
+            paths = timings.time('archive_index_lookup', index.lookup, start_date=start_time, end_date=end_time)
+            station_paths = timings.time('archive_index_lookup_station', index.lookup, station=sources['stations'][0],
+                                         start_date=start_time, end_date=end_time)
+            if not paths or not station_paths:
+                logger.warning(f'Archive index lookup found {len(paths)} files for the period '
+                               f'and {len(station_paths)} for station {sources["stations"][0]}')
+
+        with tempfile.TemporaryDirectory() as tmp_directory:
+            staging = CTDStaging(staging_directory=tmp_directory)
+            timings.time('ctd_staging_cold', staging.stage, sources['ctd_directory'], start_time, end_time)
+            timings.time('ctd_staging_warm', staging.stage, sources['ctd_directory'], start_time, end_time)
+
+        with tempfile.TemporaryDirectory() as tmp_directory:
+            target_path = pathlib.Path(tmp_directory, 'lims.txt')
+            timings.time('lims_filter', filter_lims_export, sources['lims_path'], start_time, end_time,
+                         target_path=target_path)
+            timings.time('lims_filter_sorted', filter_lims_export, sources['lims_path'], start_time, end_time,
+                         target_path=target_path, sorted_by_date=True)
+
+
+def run_session_benchmarks(sources, timings, areas, save_as_format, source='archive', repeat=3,
+                           stage_ctd_files=False, compact_data=False):
+    """
+    Benchmarks load_data, get_data_xlist and plot of each area.
+    :param sources: dict from synthetic.generate
+    :param timings: Timings
+    :param areas: list of figure_keys
+    :param save_as_format:
+    :param source: "archive" or "lims"
+    :param repeat:
+    :param stage_ctd_files: see session.create_session
+    :param compact_data: see session.create_session
+    :return:
+    """
+    from ..render import use_non_interactive_backend
+    use_non_interactive_backend()
+    from ..session import create_session
+    from ..data_cache import SharedDataCache
+
+    start_time, end_time = _get_period(sources['years'][-1])
+    load_kwargs = dict(ctd_directory=sources['ctd_directory'])
+    if source == 'lims':
+        load_kwargs['lims_path'] = sources['lims_path']
+    else:
+        load_kwargs['archive_root_dir'] = sources['archive_root_dir']
+
+    update_kwargs = {'start_time': start_time, 'end_time': end_time}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cache_directory:
+            for state in ['cold', 'warm']:
+                # A new shared data cache, so the warm session reads the data from the data cache on disk
+                session = create_session(cache_directory=cache_directory,
+                                         shared_data_cache=SharedDataCache(),
+                                         stage_ctd_files=stage_ctd_files,
+                                         compact_data=compact_data)
+                try:
+                    timings.time(f'load_data_{state}', session.load_data, update_kwargs, **load_kwargs)
+                    timings.time(f'load_data_unchanged_{state}', session.load_data, update_kwargs, **load_kwargs)
+                    timings.time(f'get_data_xlist_{state}', session.get_data_xlist)
+                    for area in areas:
+                        timings.time(f'plot_{state}:{area}', session.plot, area, save_as_format=save_as_format)
+                finally:
+                    session.close()
+
+
+def get_environment():
+    environment = dict(python=sys.version.split()[0],
+                       platform=platform.platform(),
+                       processor=platform.processor(),
+                       nr_cpus=os.cpu_count())
+    try:
+        import algaware
+        environment['algaware'] = getattr(algaware, '__version__', '')
+    except ImportError:
+        environment['algaware'] = None
+    return environment
+
+
+def compare(result, baseline, tolerance=0.2, min_delta=0.05):
+    """
+    :param result: dict with benchmark name as key and dict with "median" as value
+    :param baseline: same structure as result
+    :param tolerance: Allowed relative increase of the median
+    :param min_delta: Increases (seconds) smaller than this are never regressions
+    :return: list of (name, baseline_median, median) for benchmarks slower than the baseline
+    """
+    regressions = []
+    for name, value in result.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]['median']
+        median = value['median']
+        if median - base > min_delta and median > base * (1 + tolerance):
+            regressions.append((name, base, median))
+    return regressions
+
+
+def _print_result(result, baseline=None):
+    baseline = baseline or {}
+    for name, value in result.items():
+        line = f'{name:<45} median {value["median"]:8.3f} s   min {value["min"]:8.3f} s'
+        if name in baseline:
+            base = baseline[name]['median']
+            change = (value['median'] - base) / base * 100 if base else 0
+            line = f'{line}   baseline {base:8.3f} s ({change:+.0f} %)'
+        print(line)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark loading and plotting of AlgAware figures '
+                                                 'on synthetic data.')
+    parser.add_argument('--scale', choices=sorted(synthetic.SCALES), default='small')
+    parser.add_argument('--stations', dest='nr_stations', type=int, default=None)
+    parser.add_argument('--years', dest='nr_years', type=int, default=None)
+    parser.add_argument('--samples', dest='nr_samples_per_year', type=int, default=None,
+                        help='Number of samples per station and year')
+    parser.add_argument('--directory', default=str(DEFAULT_DIRECTORY),
+                        help='Directory for synthetic data, results and baseline')
+    parser.add_argument('--source', choices=['archive', 'lims'], default='archive')
+    parser.add_argument('--areas', nargs='+', default=DEFAULT_AREAS)
+    parser.add_argument('--formats', nargs='+', default=['png'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stage-ctd', dest='stage_ctd_files', action='store_true',
+                        help='Copy the CTD files of the period to a local directory before loading')
+    parser.add_argument('--compact', dest='compact_data', action='store_true',
+                        help='Make the loaded tables smaller')
+    parser.add_argument('--plugin-only', action='store_true', help='Skip benchmarks that need algaware')
+    parser.add_argument('--baseline', default=None, help='Defaults to <directory>/baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    directory = pathlib.Path(args.directory)
+    scale = dict(synthetic.SCALES[args.scale])
+    for key in ['nr_stations', 'nr_years', 'nr_samples_per_year']:
+        if getattr(args, key):
+            scale[key] = getattr(args, key)
+    data_directory = pathlib.Path(directory, 'data', '_'.join(str(value) for value in scale.values()))
+    print(f'Generating synthetic data in {data_directory}')
+    sources = synthetic.generate(data_directory, **scale)
+
+    timings = Timings()
+    run_plugin_benchmarks(sources, timings, repeat=args.repeat)
+    if not args.plugin_only:
+        try:
+            import algaware
+        except ImportError:
+            print('algaware is not installed. Running plugin benchmarks only.')
+        else:
+            run_session_benchmarks(sources, timings, args.areas, args.formats,
+                                   source=args.source, repeat=args.repeat,
+                                   stage_ctd_files=args.stage_ctd_files, compact_data=args.compact_data)
+
+    result = timings.get_result()
+    data = dict(created=datetime.datetime.now().isoformat(timespec='seconds'),
+                environment=get_environment(),
+                scale=scale,
+                source=args.source,
+                options=dict(stage_ctd_files=args.stage_ctd_files, compact_data=args.compact_data),
+                result=result)
+    results_directory = pathlib.Path(directory, 'results')
+    results_directory.mkdir(parents=True, exist_ok=True)
+    result_path = pathlib.Path(results_directory, f'{datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")}.json')
+    result_path.write_text(json.dumps(data, indent=2))
+
+    baseline_path = pathlib.Path(args.baseline or pathlib.Path(directory, 'baseline.json'))
+    baseline = {}
+    if baseline_path.exists():
+        baseline_data = json.loads(baseline_path.read_text())
+        if baseline_data.get('scale') != scale or baseline_data.get('source') != args.source or \
+                baseline_data.get('options') != data['options']:
+            print(f'Baseline {baseline_path} is for another scale, source or options. Not comparing.')
+        else:
+            baseline = baseline_data['result']
+    _print_result(result, baseline)
+    print(f'Result saved to {result_path}')
+
+    if args.save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(data, indent=2))
+        print(f'Baseline saved to {baseline_path}')
+        return 0
+
+    regressions = compare(result, baseline, tolerance=args.tolerance)
+    for name, base, median in regressions:
+        print(f'REGRESSION {name}: {base:.3f} s -> {median:.3f} s')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,239 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+Generator of synthetic data sources for benchmarking, written in the formats of the real sources:
+    archive tree:   <root>/<data type>/SHARK_<DataType>_<year>_BAS_SMHI/ with shark_metadata.txt and
+                    processed_data/data.txt (tab separated SHARK columns MYEAR, STATN, SDATE, STIME, SHIPC, SERNO,
+                    LATIT, LONGI, DEPH and one Q_ flag column per parameter)
+    CTD directory:  <ctd>/SBE09_1387_<YYYYMMDD>_<HHMM>_77SE_00_<serno>.cnv (Sea-Bird ascii cnv with header,
+                    "# name" lines, *END* and fixed width values)
+    LIMS export:    <lims>/data.txt, tab separated with the same columns as the archive (cp1252)
+Values are random but reproducible (seed). The size is given by number of stations x years x samples per year.
+"""
+
+import datetime
+import json
+import logging
+import pathlib
+import random
+import shutil
+
+
+logger = logging.getLogger(__name__)
+
+# Station name, latitude and longitude (DDMM.mm)
+STATIONS = [('BY2 ARKONA', '5458.00', '1350.00'),
+            ('BY5 BORNHOLMSDJ', '5515.00', '1559.00'),
+            ('BY15 GOTLANDSDJ', '5719.20', '2003.00'),
+            ('BY31 LANDSORTSDJ', '5835.00', '1814.00'),
+            ('BY38 KARLSÖDJ', '5707.00', '1740.00'),
+            ('ANHOLT E', '5640.00', '1207.00'),
+            ('W LANDSKRONA', '5552.00', '1245.00'),
+            ('SLÄGGÖ', '5816.00', '1126.00'),
+            ('Å17', '5817.00', '1031.00'),
+            ('Å13', '5818.00', '1103.00'),
+            ('N14 FALKENBERG', '5656.00', '1213.00'),
+            ('FLADEN', '5711.50', '1140.00')]
+
+DEPTHS = [0, 5, 10, 15, 20, 30, 40, 50, 60, 70, 80, 100, 125, 150, 200]
+
+SHIP_CODE = '77SE'
+
+# Data type folder, SHARK data type and parameters
+ARCHIVE_DATA_TYPES = [('physicalchemical', 'PhysicalChemical',
+                       ['TEMP_BTL', 'SALT_BTL', 'DOXY_BTL', 'PHOS', 'NTRA', 'NTRI', 'AMON', 'SIOH', 'PTOT', 'NTOT']),
+                      ('chlorophyll', 'Chlorophyll', ['CPHL'])]
+
+LIMS_PARAMETERS = ['TEMP_BTL', 'SALT_BTL', 'DOXY_BTL', 'PHOS', 'NTRA', 'NTRI', 'AMON', 'SIOH', 'PTOT', 'NTOT', 'CPHL']
+
+SHARK_COLUMNS = ['MYEAR', 'STATN', 'SDATE', 'STIME', 'SHIPC', 'SERNO', 'LATIT', 'LONGI', 'DEPH']
+
+# Column, description and printf format in the cnv files
+CNV_COLUMNS = [('prDM', 'Pressure, Digiquartz [db]', '{:11.3f}'),
+               ('t090C', 'Temperature [ITS-90, deg C]', '{:11.4f}'),
+               ('sal00', 'Salinity, Practical [PSU]', '{:11.4f}'),
+               ('sbeox0ML/L', 'Oxygen, SBE 43 [ml/l]', '{:11.4f}'),
+               ('flECO-AFL', 'Fluorescence, WET Labs ECO-AFL/FL [mg/m^3]', '{:11.4f}'),
+               ('flag', '0.000e+00', '{:11.3e}')]
+
+SCALES = dict(small=dict(nr_stations=4, nr_years=2, nr_samples_per_year=12),
+              medium=dict(nr_stations=8, nr_years=5, nr_samples_per_year=24),
+              large=dict(nr_stations=12, nr_years=10, nr_samples_per_year=52))
+
+
+def get_sample_dates(year, nr_samples, rnd):
+    """
+    :param year:
+    :param nr_samples:
+    :param rnd: random.Random
+    :return: sorted list of nr_samples datetimes spread over the year
+    """
+    step = 365 / nr_samples
+    dates = []
+    for i in range(nr_samples):
+        day = int(i * step + rnd.uniform(0, max(step - 1, 0)))
+        date = datetime.datetime(year, 1, 1) + datetime.timedelta(days=min(day, 364))
+        dates.append(date.replace(hour=rnd.randint(6, 20), minute=rnd.randint(0, 59)))
+    return dates
+
+
+def _get_value(parameter, depth, rnd):
+    if parameter.startswith('TEMP') or parameter == 't090C':
+        return round(max(18 - depth * 0.1, 2) + rnd.gauss(0, 1), 2)
+    if parameter.startswith('SALT') or parameter == 'sal00':
+        return round(7 + depth * 0.05 + rnd.gauss(0, 0.3), 3)
+    if parameter.startswith('DOXY') or parameter.startswith('sbeox'):
+        return round(max(9 - depth * 0.04, 0) + rnd.gauss(0, 0.3), 2)
+    if parameter == 'prDM':
+        return depth
+    if parameter == 'flag':
+        return 0
+    return round(abs(rnd.gauss(1, 0.5)), 3)
+
+
+def _get_shark_rows(station, date, serno, parameters, rnd):
+    """
+    :return: one row per depth with the SHARK_COLUMNS followed by value and Q_ flag of each parameter
+    """
+    name, latitude, longitude = station
+    rows = []
+    for depth in DEPTHS:
+        row = [str(date.year), name, date.strftime('%Y-%m-%d'), date.strftime('%H:%M'), SHIP_CODE, serno,
+               latitude, longitude, str(depth)]
+        for parameter in parameters:
+            row.extend([str(_get_value(parameter, depth, rnd)), ''])
+        rows.append(row)
+    return rows
+
+
+def _get_shark_header(parameters):
+    header = list(SHARK_COLUMNS)
+    for parameter in parameters:
+        header.extend([parameter, f'Q_{parameter}'])
+    return header
+
+
+def _write_rows(path, header, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='cp1252', newline='') as fid:
+        fid.write('\t'.join(header) + '\r\n')
+        for row in rows:
+            fid.write('\t'.join(row) + '\r\n')
+
+
+def _write_shark_dataset(directory, data_type, year, rows, parameters):
+    """
+    Writes a SHARK archive dataset: shark_metadata.txt and processed_data/data.txt.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    metadata = [f'dataset_name: {directory.name}',
+                f'datatype: {data_type}',
+                'reporting_institute_code: SMHI',
+                f'min_year: {year}',
+                f'max_year: {year}']
+    pathlib.Path(directory, 'shark_metadata.txt').write_text('\n'.join(metadata) + '\n', encoding='cp1252')
+    _write_rows(pathlib.Path(directory, 'processed_data', 'data.txt'), _get_shark_header(parameters), rows)
+
+
+def get_cnv_file_name(date, serno):
+    return f'SBE09_1387_{date.strftime("%Y%m%d_%H%M")}_{SHIP_CODE}_00_{serno}.cnv'
+
+
+def _write_cnv_file(path, date, station, serno, nr_scans, rnd):
+    name, latitude, longitude = station
+    lines = ['* Sea-Bird SBE 9 Data File:',
+             f'* FileName = C:\\ctd\\data\\{path.stem}.hex',
+             '* Software version 7.26.7.107',
+             f'* System UpLoad Time = {date.strftime("%b %d %Y %H:%M:%S")}',
+             f'** Station: {name}',
+             f'** Ship: {SHIP_CODE}',
+             f'** Serie: {serno}',
+             f'** Latitude: {latitude[:2]} {latitude[2:]} N',
+             f'** Longitude: {longitude[:2]} {longitude[2:]} E',
+             '* System UTC = ' + date.strftime('%b %d %Y %H:%M:%S'),
+             f'# nquan = {len(CNV_COLUMNS)}',
+             f'# nvalues = {nr_scans}',
+             '# units = specified']
+    for i, (column, description, fmt) in enumerate(CNV_COLUMNS):
+        lines.append(f'# name {i} = {column}: {description}')
+    lines.extend([f'# start_time = {date.strftime("%b %d %Y %H:%M:%S")} [Instrument\'s time stamp, header]',
+                  '# bad_flag = -9.990e-29',
+                  '# file_type = ascii',
+                  '*END*'])
+    max_depth = DEPTHS[-1]
+    for i in range(nr_scans):
+        depth = round(max_depth * i / max(nr_scans - 1, 1), 2)
+        lines.append(''.join(fmt.format(_get_value(column, depth, rnd)) for column, description, fmt in CNV_COLUMNS))
+    path.write_text('\n'.join(lines) + '\n', encoding='cp1252')
+
+
+def generate(directory,
+             nr_stations=4,
+             nr_years=2,
+             nr_samples_per_year=12,
+             last_year=None,
+             nr_ctd_scans=500,
+             seed=0):
+    """
+    Writes an archive tree, a CTD directory and a LIMS export under directory.
+    Nothing is written if directory already holds data generated with the same arguments.
+    :param directory:
+    :param nr_stations: Max len(STATIONS)
+    :param nr_years:
+    :param nr_samples_per_year: Number of visits per station and year
+    :param last_year: Defaults to last year
+    :param nr_ctd_scans: Number of rows in each CTD file
+    :param seed:
+    :return: dict with archive_root_dir, ctd_directory, lims_path, years and stations
+    """
+    directory = pathlib.Path(directory)
+    last_year = last_year or datetime.date.today().year - 1
+    stations = STATIONS[:nr_stations]
+    years = list(range(last_year - nr_years + 1, last_year + 1))
+    info = dict(format=2, nr_stations=nr_stations, nr_years=nr_years, nr_samples_per_year=nr_samples_per_year,
+                last_year=last_year, nr_ctd_scans=nr_ctd_scans, seed=seed)
+    sources = dict(archive_root_dir=str(pathlib.Path(directory, 'archive')),
+                   ctd_directory=str(pathlib.Path(directory, 'ctd')),
+                   lims_path=str(pathlib.Path(directory, 'lims', 'data.txt')),
+                   years=years,
+                   stations=[station[0] for station in stations])
+    info_path = pathlib.Path(directory, 'synthetic.json')
+    if info_path.exists() and json.loads(info_path.read_text()).get('info') == info:
+        return sources
+
+    rnd = random.Random(seed)
+    archive_root = pathlib.Path(sources['archive_root_dir'])
+    ctd_directory = pathlib.Path(sources['ctd_directory'])
+    lims_path = pathlib.Path(sources['lims_path'])
+    for path in [archive_root, ctd_directory, lims_path.parent]:
+        if path.exists():
+            shutil.rmtree(path)
+    ctd_directory.mkdir(parents=True, exist_ok=True)
+
+    lims_rows = []
+    nr_files = 0
+    serno = 0
+    for year in years:
+        archive_rows = {folder: [] for folder, data_type, parameters in ARCHIVE_DATA_TYPES}
+        visits = sorted((date, station) for station in stations
+                        for date in get_sample_dates(year, nr_samples_per_year, rnd))
+        for date, station in visits:
+            serno += 1
+            serno_string = f'{serno % 10000:04d}'
+            for folder, data_type, parameters in ARCHIVE_DATA_TYPES:
+                archive_rows[folder].extend(_get_shark_rows(station, date, serno_string, parameters, rnd))
+            lims_rows.extend(_get_shark_rows(station, date, serno_string, LIMS_PARAMETERS, rnd))
+            _write_cnv_file(pathlib.Path(ctd_directory, get_cnv_file_name(date, serno_string)),
+                            date, station, serno_string, nr_ctd_scans, rnd)
+            nr_files += 1
+        for folder, data_type, parameters in ARCHIVE_DATA_TYPES:
+            dataset_directory = pathlib.Path(archive_root, folder, f'SHARK_{data_type}_{year}_BAS_SMHI')
+            _write_shark_dataset(dataset_directory, data_type, year, archive_rows[folder], parameters)
+            nr_files += 2
+
+    _write_rows(lims_path, _get_shark_header(LIMS_PARAMETERS), lims_rows)
+
+    info_path.write_text(json.dumps(dict(info=info), indent=2))
+    logger.info(f'Synthetic data generated in {directory}: {nr_files} files and {len(lims_rows)} LIMS rows')
+    return sources
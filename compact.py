@@ -0,0 +1,143 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Text columns with at most this share of unique values are stored as categorical
+MAX_UNIQUE_RATIO = 0.5
+
+# Attributes and containers are followed this many levels when looking for tables
+MAX_DEPTH = 4
+
+
+def _is_frame(obj):
+    return hasattr(obj, 'memory_usage') and hasattr(obj, 'columns') and hasattr(obj, 'dtypes')
+
+
+def compact_frame(df, downcast_floats=True, max_unique_ratio=MAX_UNIQUE_RATIO):
+    """
+    Reduces the memory used by df. Columns are replaced one by one, the frame itself is not copied.
+        - text columns with few unique values (e.g. station and area) become categorical
+        - integer columns are downcast to the smallest integer type that holds the values
+        - float64 columns are downcast to float32 if downcast_floats
+    :param df: pandas.DataFrame
+    :param downcast_floats:
+    :param max_unique_ratio:
+    :return: df
+    """
+    import pandas as pd
+    nr_rows = len(df)
+    if not nr_rows:
+        return df
+    for col in df.columns:
+        series = df[col]
+        dtype = series.dtype
+        if pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            if isinstance(dtype, pd.CategoricalDtype):
+                continue
+            try:
+                nr_unique = series.nunique(dropna=True)
+            except TypeError:
+                # Not hashable values
+                continue
+            if nr_unique / nr_rows <= max_unique_ratio:
+                df[col] = series.astype('category')
+        elif pd.api.types.is_bool_dtype(dtype):
+            continue
+        elif pd.api.types.is_integer_dtype(dtype):
+            df[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(dtype) and downcast_floats and dtype == 'float64':
+            df[col] = series.astype('float32')
+    return df
+
+
+def _iter_frames(obj, name, depth, seen):
+    """
+    Yields (name, frame) for all frames found in obj.
+    """
+    if id(obj) in seen or depth > MAX_DEPTH:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, dict):
+        items = list(obj.items())
+    elif isinstance(obj, list):
+        items = list(enumerate(obj))
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        items = list(vars(obj).items())
+    else:
+        return
+    is_container = isinstance(obj, (dict, list))
+    for key, value in items:
+        value_name = f'{name}[{key!r}]' if is_container else f'{name}.{key}'
+        if _is_frame(value):
+            if id(value) not in seen:
+                seen.add(id(value))
+                yield value_name, value
+            continue
+        yield from _iter_frames(value, value_name, depth + 1, seen)
+
+
+def find_frames(obj, name='data'):
+    """
+    :param obj: e.g. the data handler of algaware
+    :param name: Name used for obj in the returned names
+    :return: list of (name, frame) for all pandas frames found in obj
+    """
+    if _is_frame(obj):
+        return [(name, obj)]
+    return list(_iter_frames(obj, name, 0, set()))
+
+
+def compact_data(obj, name='data', downcast_floats=True):
+    """
+    Compacts all pandas frames found in obj (see compact_frame).
+    :param obj:
+    :param name:
+    :param downcast_floats:
+    :return: dict with frame name as key and (bytes before, bytes after) as value
+    """
+    result = {}
+    for frame_name, frame in find_frames(obj, name=name):
+        before = int(frame.memory_usage(deep=True).sum())
+        try:
+            compact_frame(frame, downcast_floats=downcast_floats)
+        except Exception as e:
+            logger.warning(f'Could not compact {frame_name}: {e}')
+            continue
+        result[frame_name] = (before, int(frame.memory_usage(deep=True).sum()))
+    return result
+
+
+def get_memory_report(obj, name='data'):
+    """
+    :param obj:
+    :param name:
+    :return: list of dicts (table, column, dtype, bytes) for every column of every frame found in obj
+    """
+    rows = []
+    for frame_name, frame in find_frames(obj, name=name):
+        usage = frame.memory_usage(deep=True)
+        for column, nr_bytes in usage.items():
+            dtype = 'index' if column == 'Index' else str(frame[column].dtype)
+            rows.append(dict(table=frame_name, column=str(column), dtype=dtype, bytes=int(nr_bytes)))
+    return rows
+
+
+def format_memory_report(rows, nr_columns=10):
+    """
+    :param rows: from get_memory_report
+    :param nr_columns: Number of largest columns to list per table
+    :return: Text with the total per table and its largest columns
+    """
+    tables = {}
+    for row in rows:
+        tables.setdefault(row['table'], []).append(row)
+    lines = [f'{"Total":<50} {sum(row["bytes"] for row in rows) / 1024 / 1024:10.1f} MB']
+    for table, table_rows in sorted(tables.items(), key=lambda item: -sum(row['bytes'] for row in item[1])):
+        lines.append(f'{table:<50} {sum(row["bytes"] for row in table_rows) / 1024 / 1024:10.1f} MB')
+        for row in sorted(table_rows, key=lambda row: -row['bytes'])[:nr_columns]:
+            lines.append(f'    {row["column"]:<30} {row["dtype"]:<14} {row["bytes"] / 1024 / 1024:10.2f} MB')
+    return '\n'.join(lines)
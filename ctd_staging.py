@@ -0,0 +1,174 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .jobs import report
+from .archive_index import parse_file_date
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STAGING_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent, 'cache', 'ctd')
+DEFAULT_NR_WORKERS = 8
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+
+def _list_files(directory):
+    """
+    :param directory:
+    :return: dict with relative path as key and os.stat_result as value for all files under directory
+    """
+    files = {}
+    stack = [pathlib.Path(directory)]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir():
+                    stack.append(pathlib.Path(entry.path))
+                elif entry.is_file():
+                    files[pathlib.Path(entry.path).relative_to(directory)] = entry.stat()
+    return files
+
+
+def _copy_file(source, target):
+    """
+    Copies source to target via a temporary file so that a half copied file is never read.
+    :return: number of bytes copied
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target.parent, suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp_path)
+        shutil.copystat(source, tmp_path)
+        os.replace(tmp_path, target)
+    except Exception:
+        pathlib.Path(tmp_path).unlink(missing_ok=True)
+        raise
+    return target.stat().st_size
+
+
+def _is_in_period(rel_path, start_date, end_date):
+    """
+    :return: True if the date in the file name (see archive_index.parse_file_date) is within the period
+             or if the name has no date
+    """
+    date = parse_file_date(rel_path.name)
+    if not date:
+        return True
+    return (not start_date or date >= start_date) and (not end_date or date <= end_date)
+
+
+class CTDStaging:
+    """
+    Copies the files of a CTD-data directory (often on a network share) that belong to a period to a local directory.
+    Only files with a date in the name within the period and files without a date in the name are copied.
+    Files are copied concurrently with a bounded thread pool and only when size or mtime has changed.
+    Files not selected from the source are removed from the local copy.
+    There is one local directory per source directory and period. The least recently used are removed
+    when the total size exceeds max_size.
+    """
+    def __init__(self, staging_directory=None, nr_workers=DEFAULT_NR_WORKERS, max_size=DEFAULT_MAX_SIZE):
+        self.staging_directory = pathlib.Path(staging_directory or DEFAULT_STAGING_DIRECTORY)
+        self.nr_workers = nr_workers
+        self.max_size = max_size
+        self.latest_report = {}
+
+    def get_local_directory(self, source_directory, start_date=None, end_date=None):
+        string = f'{pathlib.Path(source_directory).resolve()}:{start_date}:{end_date}'
+        return pathlib.Path(self.staging_directory, hashlib.md5(string.encode()).hexdigest())
+
+    def stage(self, source_directory, start_date=None, end_date=None, job=None):
+        """
+        :param source_directory:
+        :param start_date: YYYY-MM-DD
+        :param end_date: YYYY-MM-DD
+        :param job: jobs.Job used to report progress
+        :return: path to the local copy of the files in source_directory for the period
+        """
+        t0 = time.perf_counter()
+        source_directory = pathlib.Path(source_directory)
+        local_directory = self.get_local_directory(source_directory, start_date=start_date, end_date=end_date)
+        source_files = {rel_path: stat for rel_path, stat in _list_files(source_directory).items()
+                        if _is_in_period(rel_path, start_date, end_date)}
+        local_files = _list_files(local_directory) if local_directory.exists() else {}
+
+        to_copy = []
+        for rel_path, stat in source_files.items():
+            local_stat = local_files.get(rel_path)
+            if local_stat and local_stat.st_size == stat.st_size and \
+                    int(local_stat.st_mtime) == int(stat.st_mtime):
+                continue
+            to_copy.append(rel_path)
+
+        for rel_path in set(local_files) - set(source_files):
+            pathlib.Path(local_directory, rel_path).unlink(missing_ok=True)
+
+        nr_bytes = 0
+        with ThreadPoolExecutor(max_workers=self.nr_workers) as executor:
+            futures = [executor.submit(_copy_file,
+                                       pathlib.Path(source_directory, rel_path),
+                                       pathlib.Path(local_directory, rel_path)) for rel_path in to_copy]
+            try:
+                for i, future in enumerate(futures):
+                    nr_bytes += future.result()
+                    if i % 20 == 0:
+                        report(job, 'Copying CTD files', i + 1, len(futures))
+            except Exception:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+        local_directory.mkdir(parents=True, exist_ok=True)
+        os.utime(local_directory)
+        self._evict(keep=local_directory)
+
+        duration = time.perf_counter() - t0
+        self.latest_report = dict(nr_files=len(source_files),
+                                  nr_files_copied=len(to_copy),
+                                  nr_bytes_copied=nr_bytes,
+                                  duration=duration,
+                                  files_per_second=len(to_copy) / duration if duration else 0,
+                                  bytes_per_second=nr_bytes / duration if duration else 0)
+        logger.info('CTD staging: {nr_files_copied} of {nr_files} files copied ({nr_bytes_copied} bytes) '
+                    'in {duration:.2f} s, {files_per_second:.1f} files/s, '
+                    '{bytes_per_second:.0f} bytes/s'.format(**self.latest_report))
+        return local_directory
+
+    def _evict(self, keep=None):
+        """
+        Removes the least recently used local directories until the total size is within max_size.
+        :param keep: Local directory that is never removed
+        :return:
+        """
+        if not self.staging_directory.exists():
+            return
+        entries = []
+        total_size = 0
+        for local_directory in self.staging_directory.iterdir():
+            if not local_directory.is_dir():
+                continue
+            try:
+                size = sum(stat.st_size for stat in _list_files(local_directory).values())
+                entries.append((local_directory.stat().st_mtime, size, local_directory))
+            except OSError:
+                continue
+            total_size += size
+        for mtime, size, local_directory in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if local_directory == keep:
+                continue
+            shutil.rmtree(local_directory, ignore_errors=True)
+            total_size -= size
+            logger.debug(f'Removed staged CTD files {local_directory.name}')
+
+    def clear(self):
+        shutil.rmtree(self.staging_directory, ignore_errors=True)
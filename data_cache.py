@@ -0,0 +1,267 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import pickle
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+from .figure_cache import get_path_signature
+
+
+logger = logging.getLogger(__name__)
+
+# Increase when the content of the cache files changes
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_CACHE_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent, 'cache', 'data')
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+DEFAULT_MAX_MEMORY = 2 * 1024 * 1024 * 1024
+
+SOURCE_KEYS = ['ctd_directory', 'lims_path', 'archive_root_dir']
+
+
+class DataCacheError(Exception):
+    pass
+
+
+class DataCache:
+    """
+    Disk cache for parsed data. Objects are stored with pickle protocol 5 which writes the numpy
+    buffers behind pandas frames as binary blocks.
+    The key includes path, mtime and size of the sources so an entry is not used after a source has changed.
+    Least recently used entries are removed when the total size exceeds max_size.
+    """
+    suffix = '.pkl'
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = pathlib.Path(directory or DEFAULT_CACHE_DIRECTORY)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(load_kwargs, source_signatures=None, **kwargs):
+        """
+        :param load_kwargs: Arguments used for AlgawareSession.load_data
+        :param source_signatures: dict with signature of each source. Calculated from load_kwargs if not given.
+        :param kwargs: Other things that the cached object depends on (e.g. versions)
+        :return:
+        """
+        if source_signatures is None:
+            source_signatures = {key: get_path_signature(load_kwargs.get(key)) for key in SOURCE_KEYS}
+        info = dict(version=CACHE_FORMAT_VERSION,
+                    update_kwargs=load_kwargs.get('update_kwargs'),
+                    sources=source_signatures,
+                    other=kwargs)
+        return hashlib.md5(json.dumps(info, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _get_path(self, key):
+        return pathlib.Path(self.directory, f'{key}{self.suffix}')
+
+    def get(self, key):
+        """
+        :param key:
+        :return: The cached object or None if not in cache
+        """
+        path = self._get_path(key)
+        if not path.exists():
+            self.misses += 1
+            return None
+        try:
+            with open(path, 'rb') as fid:
+                obj = pickle.load(fid)
+        except Exception as e:
+            logger.warning(f'Could not read data cache file {path}: {e}')
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return obj
+
+    def put(self, key, obj):
+        """
+        Writes obj to the cache. The file is replaced atomically so that a half written file is never read.
+        Raises DataCacheError if obj can not be pickled, since then nothing will ever be cached.
+        :param key:
+        :param obj:
+        :return:
+        """
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fid:
+                    pickle.dump(obj, fid, protocol=5)
+                os.replace(tmp_path, self._get_path(key))
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                pathlib.Path(tmp_path).unlink(missing_ok=True)
+                raise DataCacheError(f'{type(obj).__name__} can not be pickled: {e}') from e
+            except Exception as e:
+                logger.warning(f'Could not write data cache: {e}')
+                pathlib.Path(tmp_path).unlink(missing_ok=True)
+                return
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total_size = 0
+        for path in self.directory.glob(f'*{self.suffix}'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+            logger.debug(f'Removed data cache entry {path.name}')
+
+    def clear(self):
+        with self._lock:
+            for path in self.directory.glob(f'*{self.suffix}'):
+                path.unlink(missing_ok=True)
+
+    def get_report(self):
+        """
+        :return: dict with number of hits and misses
+        """
+        return dict(hits=self.hits, misses=self.misses)
+
+
+def estimate_size(obj, max_depth=4):
+    """
+    Estimates the memory used by obj. pandas frames and numpy arrays are measured exactly,
+    containers and object attributes are followed max_depth levels.
+    :param obj:
+    :param max_depth:
+    :return: size in bytes
+    """
+    seen = set()
+
+    def size_of(item, depth):
+        if id(item) in seen:
+            return 0
+        seen.add(id(item))
+        if hasattr(item, 'memory_usage') and hasattr(item, 'columns'):
+            return int(item.memory_usage(deep=True).sum())
+        if hasattr(item, 'memory_usage') and hasattr(item, 'index'):
+            return int(item.memory_usage(deep=True))
+        if hasattr(item, 'nbytes') and hasattr(item, 'dtype'):
+            return int(item.nbytes)
+        size = sys.getsizeof(item, 0)
+        if depth >= max_depth:
+            return size
+        if isinstance(item, dict):
+            size += sum(size_of(key, depth + 1) + size_of(value, depth + 1) for key, value in item.items())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            size += sum(size_of(value, depth + 1) for value in item)
+        elif hasattr(item, '__dict__'):
+            size += size_of(vars(item), depth + 1)
+        return size
+
+    return size_of(obj, 0)
+
+
+class SharedDataCache:
+    """
+    Process-wide memory cache of loaded data shared by all sessions (e.g. after switching user).
+    Objects are shared read-only and must not be changed by the sessions using them.
+    Each entry counts the sessions using it (acquire/release). Entries not in use are kept,
+    least recently used first out, as long as the total size is below max_memory.
+    Entries in use are never removed.
+    """
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY):
+        self.max_memory = max_memory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        :param key:
+        :return: The object stored for key (and counts one more user of it) or None if not in cache
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry['references'] += 1
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry['obj']
+
+    def put(self, key, obj):
+        """
+        Adds obj to the cache with the caller as its first user.
+        :param key:
+        :param obj:
+        :return:
+        """
+        size = estimate_size(obj)
+        with self._lock:
+            references = self._entries[key]['references'] if key in self._entries else 0
+            self._entries[key] = dict(obj=obj, size=size, references=references + 1)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def release(self, key):
+        """
+        Tells the cache that the caller no longer uses the object for key.
+        :param key:
+        :return:
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry['references'] = max(entry['references'] - 1, 0)
+            self._evict()
+
+    def _evict(self):
+        total_size = sum(entry['size'] for entry in self._entries.values())
+        for key in list(self._entries):
+            if total_size <= self.max_memory:
+                break
+            entry = self._entries[key]
+            if entry['references']:
+                continue
+            del self._entries[key]
+            total_size -= entry['size']
+            logger.debug(f'Removed shared data entry {key}')
+
+    def clear(self):
+        """
+        Removes all entries not in use.
+        :return:
+        """
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if not entry['references']]:
+                del self._entries[key]
+
+    def get_report(self):
+        """
+        :return: dict with number of hits, misses, entries and the total size
+        """
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        nr_entries=len(self._entries),
+                        nr_in_use=len([entry for entry in self._entries.values() if entry['references']]),
+                        size=sum(entry['size'] for entry in self._entries.values()))
+
+
+shared_data_cache = SharedDataCache()
@@ -1,8 +1,30 @@
+import collections
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
+
+logger = logging.getLogger(__name__)
+
+# event_type -> {subscriber key: _Subscriber}
 subscribers = dict()
 subscribers_before = dict()
 subscribers_after = dict()
 
+# event_type -> milliseconds. Posts within this time are coalesced and only the latest data is delivered.
+debounce_times = dict()
+
+_scheduler = None
+_pending = dict()
+
+# Subscribers registered with run_async are called in these worker threads
+NR_ASYNC_WORKERS = 4
+ASYNC_POLL_INTERVAL = 50
+_executor = None
+# (future, callback) in the order the events were posted
+_async_results = collections.deque()
+_polling = False
+
 
 class InvalidEventType(Exception):
     pass
@@ -30,52 +52,246 @@ class EventTypes:
             'change_metadata_packs_sharkweb_path',
             'change_metadata_packs_lims_path',
         ]
+        self._event_type_set = set(self.event_types)
 
         for item in self.event_types:
             setattr(self, item, item)
 
     def __contains__(self, item):
-        if item in self.event_types:
-            return True
-        return False
+        return item in self._event_type_set
+
+    def add(self, event_type):
+        if event_type in self._event_type_set:
+            return
+        self.event_types.append(event_type)
+        self._event_type_set.add(event_type)
+        setattr(self, event_type, event_type)
+
+
+_event_types = EventTypes()
+
+
+def _get_key(func):
+    """
+    Bound methods are identified by instance and function so that a new bound method object
+    for the same method replaces the old subscription.
+    """
+    if hasattr(func, '__self__') and hasattr(func, '__func__'):
+        return id(func.__self__), func.__func__
+    return func
+
+
+def _get_ref(func, on_dead):
+    if func is None:
+        return lambda: None
+    if hasattr(func, '__self__') and hasattr(func, '__func__'):
+        return weakref.WeakMethod(func, lambda ref: on_dead())
+    return lambda: func
+
+
+class _Subscriber:
+    """
+    Holds a weak reference to bound methods so that subscribing does not keep widgets alive.
+    Plain functions are held by a strong reference (as a lambda would otherwise be dropped at once).
+    """
+    __slots__ = ['key', 'run_async', '_ref', '_callback_ref', '__weakref__']
+
+    def __init__(self, func, key, on_dead, run_async=False, callback=None):
+        self.key = key
+        self.run_async = run_async
+        self._ref = _get_ref(func, lambda: on_dead(key))
+        self._callback_ref = _get_ref(callback, lambda: on_dead(key))
+
+    def get(self):
+        """
+        :return: The subscribed function or None if the instance of the bound method is gone
+        """
+        return self._ref()
+
+    def get_callback(self):
+        return self._callback_ref()
+
+
+def _get_subscriber_dicts():
+    return [subscribers_before, subscribers, subscribers_after]
+
+
+def unsubscribe(event_type, func):
+    """
+    Removes func from all subscriber lists of event_type.
+    :param event_type:
+    :param func:
+    :return:
+    """
+    _remove_key(event_type, _get_key(func))
+
 
+def _remove_key(event_type, key):
+    for sub in _get_subscriber_dicts():
+        sub.get(event_type, {}).pop(key, None)
 
-def _remove_existing(event_type, func):
-    func_part = str(func).split()[2]
-    for sub in [subscribers_before, subscribers, subscribers_after]:
-        for f in list(sub.get(event_type, [])):
-            if func_part == str(f).split()[2]:
-                print('REMOVING:', func_part)
-                sub[event_type].remove(f)
 
+def add_event_type(event_type):
+    """
+    Registers event_type so that it can be subscribed to. Used for event types named after a widget id.
+    :param event_type:
+    :return:
+    """
+    _event_types.add(event_type)
 
-def subscribe(event_type, func, before=False, after=False):
-    _remove_existing(event_type, func)
-    # print('ADDING event:', event_type)
-    if event_type not in EventTypes():
+
+def subscribe(event_type, func, before=False, after=False, run_async=False, callback=None):
+    """
+    :param event_type:
+    :param func: Called with (data, **kwargs) when event_type is posted
+    :param before: Call before the normal subscribers
+    :param after: Call after the normal subscribers
+    :param run_async: Call func in a worker thread so that a slow subscriber does not block the GUI.
+                      func must not touch any widgets. Use callback for that.
+    :param callback: Called on the Tk thread with the return value of func if run_async.
+                     Callbacks are called in the order the events were posted.
+    :return:
+    """
+    if event_type not in _event_types:
         raise InvalidEventType(event_type)
+    key = _get_key(func)
+    _remove_key(event_type, key)
+    subscriber = _Subscriber(func, key, lambda key: _remove_key(event_type, key),
+                             run_async=run_async, callback=callback)
     if before:
-        if event_type not in subscribers_before:
-            subscribers_before[event_type] = set()
-        subscribers_before[event_type].add(func)
+        sub = subscribers_before
     elif after:
-        if event_type not in subscribers_after:
-            subscribers_after[event_type] = set()
-        subscribers_after[event_type].add(func)
+        sub = subscribers_after
+    else:
+        sub = subscribers
+    sub.setdefault(event_type, {})[key] = subscriber
+
+
+def set_scheduler(widget):
+    """
+    Sets the tkinter widget used to schedule delayed (debounced) events and results of async subscribers
+    on the Tk thread. Without a scheduler all events are delivered at once and async subscribers
+    are called directly.
+    :param widget:
+    :return:
+    """
+    global _scheduler
+    _scheduler = widget
+
+
+def set_debounce(event_type, milliseconds):
+    """
+    Events of event_type posted within milliseconds of each other are coalesced and delivered once,
+    with the latest data, when no new event has been posted for milliseconds.
+    :param event_type:
+    :param milliseconds: None or 0 to deliver every event at once
+    :return:
+    """
+    if milliseconds:
+        debounce_times[event_type] = milliseconds
     else:
-        if event_type not in subscribers:
-            subscribers[event_type] = set()
-        subscribers[event_type].add(func)
+        debounce_times.pop(event_type, None)
+
+
+def _schedule(event_type, data, kwargs):
+    after_id = _pending.get(event_type, (None,))[0]
+    try:
+        if after_id is not None:
+            _scheduler.after_cancel(after_id)
+        after_id = _scheduler.after(debounce_times[event_type], lambda: _post_pending(event_type))
+    except Exception:
+        # The scheduler widget is destroyed
+        _pending.pop(event_type, None)
+        return False
+    _pending[event_type] = (after_id, data, kwargs)
+    return True
+
+
+def _post_pending(event_type):
+    pending = _pending.pop(event_type, None)
+    if pending:
+        _dispatch(event_type, pending[1], **pending[2])
 
 
 def post_event(event_type, data, **kwargs):
-    for sub in [subscribers_before, subscribers, subscribers_after]:
+    if not (event_type in subscribers_before or event_type in subscribers or event_type in subscribers_after):
+        return
+    if event_type in debounce_times and _scheduler is not None and _schedule(event_type, data, kwargs):
+        return
+    _dispatch(event_type, data, **kwargs)
+
+
+def _dispatch(event_type, data, **kwargs):
+    for sub in _get_subscriber_dicts():
         if event_type not in sub:
             continue
-        for func in sub[event_type]:
+        for subscriber in list(sub[event_type].values()):
+            func = subscriber.get()
+            if func is None:
+                continue
+            if subscriber.run_async:
+                _submit(func, subscriber.get_callback(), data, kwargs)
+                continue
             func(data, **kwargs)
 
 
+def _submit(func, callback, data, kwargs):
+    global _executor
+    if _scheduler is None:
+        # No Tk thread to hand the result back to
+        result = func(data, **kwargs)
+        if callback:
+            callback(result)
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=NR_ASYNC_WORKERS, thread_name_prefix='events')
+    _async_results.append((_executor.submit(func, data, **kwargs), callback))
+    if not _polling:
+        _schedule_poll()
+
+
+def _schedule_poll():
+    global _polling
+    try:
+        _scheduler.after(ASYNC_POLL_INTERVAL, _poll_async_results)
+        _polling = True
+    except Exception:
+        # The scheduler widget is destroyed
+        _async_results.clear()
+
+
+def _poll_async_results():
+    """
+    Calls the callbacks of finished async subscribers in the order the events were posted.
+    Runs on the Tk thread and reschedules itself as long as there are results to wait for.
+    """
+    global _polling
+    _polling = False
+    while _async_results and _async_results[0][0].done():
+        future, callback = _async_results.popleft()
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception('Async event subscriber failed')
+            continue
+        if callback:
+            callback(result)
+    if _async_results:
+        _schedule_poll()
+
+
+def shutdown():
+    """
+    Stops the async worker threads. Results not yet delivered are dropped.
+    :return:
+    """
+    global _executor
+    _async_results.clear()
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
 def nr_subscribers(event_type):
     return len(subscribers[event_type])
 
@@ -100,15 +316,15 @@ def print_subscribers():
     print('-' * 50)
     for event_type in sorted(subscribers_before):
         print(' ' * 4, 'event_type:', event_type)
-        for func in subscribers_before[event_type]:
-            print(' ' * 8, func)
+        for subscriber in subscribers_before[event_type].values():
+            print(' ' * 8, subscriber.get())
     print('-' * 50)
     print('Current subscribers are:')
     print('-' * 50)
     for event_type in sorted(subscribers):
         print(' ' * 4, 'event_type:', event_type)
-        for func in subscribers[event_type]:
-            print(' ' * 8, func)
+        for subscriber in subscribers[event_type].values():
+            print(' ' * 8, subscriber.get())
     print('=' * 50)
 
 
@@ -0,0 +1,459 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+from .archive_index import parse_file_date
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent, 'cache', 'figures')
+DEFAULT_MAX_SIZE = 500 * 1024 * 1024
+
+# Attributes on algaware.core.Session (or its settings) that may hold the directory where figures are saved.
+# The figure cache is turned off with a warning if none is found (see AlgawareSession).
+EXPORT_DIRECTORY_ATTRIBUTES = ['export_directory', 'save_directory', 'output_directory']
+
+# Attributes on algaware.core.Session and its figure handler that may hold the figure settings.
+# The figure cache is turned off with a warning if none is found.
+FIGURE_SETTINGS_ATTRIBUTES = ['figure_settings', 'settings']
+
+# Settings are followed this many levels when hashed
+MAX_SETTINGS_DEPTH = 6
+
+# Columns in the xlist that may hold the station name. All loaded data is used in the data fingerprint
+# of every figure (with a warning) if none is found.
+STATION_COLUMNS = ['Station', 'STATION', 'STATN', 'station']
+
+
+def _find_export_directory(alg_session):
+    """
+    :param alg_session:
+    :return: tuple (object, attribute) holding the export directory or (None, None) if not known
+    """
+    objects = [alg_session, getattr(alg_session, 'settings', None)]
+    for obj in objects:
+        if obj is None:
+            continue
+        for attr in EXPORT_DIRECTORY_ATTRIBUTES:
+            if getattr(obj, attr, None):
+                return obj, attr
+    return None, None
+
+
+def get_export_directory(alg_session):
+    """
+    Returns the directory where the algaware session saves figures or None if not known.
+    :param alg_session:
+    :return:
+    """
+    obj, attr = _find_export_directory(alg_session)
+    if obj is None:
+        return None
+    return pathlib.Path(getattr(obj, attr))
+
+
+class PrivateExportDirectory:
+    """
+    Points the export directory of an algaware session to a new empty directory inside it, so that the files
+    saved by a render are not mixed up with files saved at the same time by others (e.g. parallel workers).
+    Call redirect() before the figure handler is initialized, since the figure handler may keep the directory
+    it was created with. The private directory is used until restore(). collect() moves the files saved since
+    the previous collect to the export directory.
+    """
+    def __init__(self, alg_session):
+        self.alg_session = alg_session
+        self.export_directory = None
+        self.private_directory = None
+        self._owner = None
+        self._attr = None
+        self._value = None
+
+    def redirect(self):
+        """
+        :return: True if the export directory is redirected. False if the export directory is not known.
+        """
+        if self.private_directory is not None:
+            return True
+        owner, attr = _find_export_directory(self.alg_session)
+        if owner is None:
+            return False
+        value = getattr(owner, attr)
+        export_directory = pathlib.Path(value)
+        export_directory.mkdir(parents=True, exist_ok=True)
+        private_directory = pathlib.Path(tempfile.mkdtemp(prefix='.render_', dir=export_directory))
+        setattr(owner, attr, private_directory if isinstance(value, pathlib.PurePath) else str(private_directory))
+        self._owner, self._attr, self._value = owner, attr, value
+        self.export_directory = export_directory
+        self.private_directory = private_directory
+        return True
+
+    def collect(self):
+        """
+        Moves the files saved in the private directory to the export directory.
+        :return: list of moved paths. Empty if not redirected, so no file is added to the figure cache by mistake.
+        """
+        saved_paths = []
+        if self.private_directory is None:
+            return saved_paths
+        for path in sorted(self.private_directory.rglob('*')):
+            if not path.is_file():
+                continue
+            target_path = pathlib.Path(self.export_directory, path.relative_to(self.private_directory))
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, target_path)
+            saved_paths.append(target_path)
+        for path in self.private_directory.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+        return saved_paths
+
+    def restore(self):
+        """
+        Moves remaining files to the export directory, removes the private directory and points the export directory
+        back. It is left as it is if it has been set to something else since redirect (e.g. by update_attributes).
+        :return:
+        """
+        if self.private_directory is None:
+            return
+        self.collect()
+        if str(getattr(self._owner, self._attr, '')) == str(self.private_directory):
+            setattr(self._owner, self._attr, self._value)
+        shutil.rmtree(self.private_directory, ignore_errors=True)
+        self.private_directory = None
+        self.export_directory = None
+        self._owner = None
+
+    def get_export_directory(self):
+        """
+        :return: The export directory of the algaware session (not the private directory) or None if not known
+        """
+        if self.private_directory is not None:
+            return self.export_directory
+        return get_export_directory(self.alg_session)
+
+
+def _to_json_data(obj, depth, seen):
+    """
+    Returns obj as data that can be written to json. Objects are replaced by their attributes.
+    Object ids and other values that differ between processes are not kept.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, pathlib.PurePath):
+        return str(obj)
+    if depth > MAX_SETTINGS_DEPTH or id(obj) in seen:
+        return None
+    seen = seen | {id(obj)}
+    if isinstance(obj, dict):
+        return {str(key): _to_json_data(value, depth + 1, seen) for key, value in obj.items()
+                if key not in EXPORT_DIRECTORY_ATTRIBUTES}
+    if isinstance(obj, (list, tuple)):
+        return [_to_json_data(item, depth + 1, seen) for item in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted((_to_json_data(item, depth + 1, seen) for item in obj), key=str)
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    if hasattr(obj, 'tolist'):
+        # numpy and pandas
+        return _to_json_data(obj.tolist(), depth + 1, seen)
+    if hasattr(obj, 'to_dict'):
+        return _to_json_data(obj.to_dict(), depth + 1, seen)
+    if hasattr(obj, '__dict__') and not callable(obj):
+        return [type(obj).__name__, _to_json_data(vars(obj), depth + 1, seen)]
+    return type(obj).__name__
+
+
+def get_settings_content(alg_session):
+    """
+    Returns the content of the figure settings of alg_session (see FIGURE_SETTINGS_ATTRIBUTES)
+    as json serializable data. The export directory is left out.
+    Call after the figure settings for the figure have been applied.
+    :param alg_session:
+    :return: dict
+    """
+    content = {}
+    objects = [('session', alg_session), ('figure_handler', getattr(alg_session, 'figure_handler', None))]
+    for name, obj in objects:
+        if obj is None:
+            continue
+        for attr in FIGURE_SETTINGS_ATTRIBUTES:
+            value = getattr(obj, attr, None)
+            if value is not None:
+                content[f'{name}.{attr}'] = _to_json_data(value, 0, set())
+    return content
+
+
+def get_settings_fingerprint(settings_content):
+    """
+    :param settings_content: see get_settings_content
+    :return:
+    """
+    return hashlib.md5(json.dumps(settings_content, sort_keys=True).encode()).hexdigest()
+
+
+def _iter_strings(data):
+    if isinstance(data, str):
+        yield data
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            yield key
+            yield from _iter_strings(value)
+    elif isinstance(data, list):
+        for item in data:
+            yield from _iter_strings(item)
+
+
+def get_station_column(xlist):
+    """
+    :param xlist: pandas.DataFrame
+    :return: The column in STATION_COLUMNS holding the station name or None
+    """
+    if xlist is None:
+        return None
+    return next((col for col in STATION_COLUMNS if col in xlist.columns), None)
+
+
+def get_figure_stations(xlist, settings_content):
+    """
+    Returns the stations in xlist that are named in the figure settings, i.e. the stations shown in the figure.
+    :param xlist: pandas.DataFrame
+    :param settings_content: see get_settings_content
+    :return: tuple (station column, sorted list of stations). (None, []) if no station is found.
+    """
+    column = get_station_column(xlist)
+    if column is None:
+        return None, []
+    strings = {string.strip().upper() for string in _iter_strings(settings_content)}
+    stations = sorted({str(station) for station in xlist[column].dropna().unique()
+                       if str(station).strip().upper() in strings})
+    if not stations:
+        return None, []
+    return column, stations
+
+
+def _scan_files(directory):
+    """
+    Yields (path relative to directory, os.stat_result) for all files under directory, also in subdirectories.
+    Files and directories removed while scanning are skipped.
+    :param directory:
+    :return:
+    """
+    directory = pathlib.Path(directory)
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    stack.append(pathlib.Path(entry.path))
+                elif entry.is_file():
+                    yield pathlib.Path(entry.path).relative_to(directory), entry.stat()
+            except OSError:
+                continue
+
+
+def get_path_signature(path):
+    """
+    Returns a signature of a file or directory (path, mtime and size) that changes when the source is updated.
+    For a directory the number of files, the total size and a hash of the relative path, mtime and size of every
+    file under it (also in subdirectories) is used.
+    :param path:
+    :return:
+    """
+    if not path:
+        return None
+    path = pathlib.Path(path)
+    if not path.exists():
+        return [str(path), None, None]
+    stat = path.stat()
+    if not path.is_dir():
+        return [str(path), stat.st_mtime_ns, stat.st_size]
+    files = sorted((rel_path.as_posix(), file_stat.st_mtime_ns, file_stat.st_size)
+                   for rel_path, file_stat in _scan_files(path))
+    md5 = hashlib.md5(json.dumps(files).encode())
+    return [str(path), len(files), sum(size for name, mtime, size in files), md5.hexdigest()]
+
+
+def get_period_signature(directory, start_date, end_date):
+    """
+    Returns a signature of the files under directory (also in subdirectories) that may hold data for the period:
+    files with a date in the name (see archive_index.parse_file_date) within the period and files without a date
+    in the name.
+    :param directory:
+    :param start_date: YYYY-MM-DD
+    :param end_date: YYYY-MM-DD
+    :return:
+    """
+    if not directory:
+        return None
+    directory = pathlib.Path(directory)
+    if not directory.is_dir():
+        return get_path_signature(directory)
+    files = []
+    for rel_path, file_stat in _scan_files(directory):
+        date = parse_file_date(rel_path.name)
+        if date and not start_date <= date <= end_date:
+            continue
+        files.append([rel_path.as_posix(), file_stat.st_mtime_ns, file_stat.st_size])
+    return [str(directory), sorted(files)]
+
+
+def get_data_fingerprint(xlist, load_kwargs, sources=None, station_column=None, stations=None):
+    """
+    Returns a fingerprint of the loaded data. Based on the arguments used when loading,
+    the signature of the sources and the content of the xlist.
+    If stations are given only the rows of the xlist for these stations are used.
+    :param xlist: pandas.DataFrame
+    :param load_kwargs:
+    :param sources: Signatures of the sources. Defaults to get_path_signature of every source.
+    :param station_column: Column in xlist holding the station name
+    :param stations: list of stations
+    :return:
+    """
+    import pandas as pd
+    md5 = hashlib.md5()
+    info = dict(load_kwargs)
+    if sources is None:
+        sources = [get_path_signature(load_kwargs.get(key)) for key in
+                   ['ctd_directory', 'lims_path', 'archive_root_dir']]
+    info['sources'] = sources
+    info['stations'] = stations
+    md5.update(json.dumps(info, sort_keys=True, default=str).encode())
+    if xlist is not None and stations:
+        xlist = xlist[xlist[station_column].astype(str).isin(stations)]
+    if xlist is not None:
+        md5.update(pd.util.hash_pandas_object(xlist, index=True).values.tobytes())
+        md5.update(json.dumps([str(col) for col in xlist.columns]).encode())
+    return md5.hexdigest()
+
+
+class FigureCache:
+    """
+    Cache for saved figure files. One entry per data fingerprint, figure settings and file format.
+    The least recently used entries are removed when the total size exceeds max_size.
+    """
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = pathlib.Path(directory or DEFAULT_CACHE_DIRECTORY)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(data_fingerprint, figure_settings, file_format):
+        """
+        :param data_fingerprint: see get_data_fingerprint
+        :param figure_settings: json serializable object describing the figure (e.g. figure_key and version)
+        :param file_format:
+        :return:
+        """
+        string = json.dumps([data_fingerprint, figure_settings, file_format], sort_keys=True, default=str)
+        return hashlib.md5(string.encode()).hexdigest()
+
+    def _entry_directory(self, key):
+        return pathlib.Path(self.directory, key)
+
+    def get(self, key, target_directory):
+        """
+        Copies the cached files for key to target_directory.
+        :param key:
+        :param target_directory:
+        :return: list of restored paths or None if not in cache
+        """
+        with self._lock:
+            entry_directory = self._entry_directory(key)
+            info_path = pathlib.Path(entry_directory, 'files.json')
+            if not info_path.exists():
+                self.misses += 1
+                return None
+            with open(info_path) as fid:
+                file_names = json.load(fid)
+            target_directory = pathlib.Path(target_directory)
+            target_directory.mkdir(parents=True, exist_ok=True)
+            paths = []
+            try:
+                for name in file_names:
+                    target_path = pathlib.Path(target_directory, name)
+                    shutil.copy2(pathlib.Path(entry_directory, name), target_path)
+                    paths.append(target_path)
+            except OSError as e:
+                logger.warning(f'Could not restore figure from cache: {e}')
+                shutil.rmtree(entry_directory, ignore_errors=True)
+                self.misses += 1
+                return None
+            os.utime(entry_directory)
+            self.hits += 1
+            return paths
+
+    def put(self, key, paths):
+        """
+        Stores the given files under key.
+        :param key:
+        :param paths:
+        :return:
+        """
+        paths = [pathlib.Path(path) for path in paths]
+        if not paths:
+            return
+        with self._lock:
+            entry_directory = self._entry_directory(key)
+            shutil.rmtree(entry_directory, ignore_errors=True)
+            entry_directory.mkdir(parents=True)
+            for path in paths:
+                shutil.copy2(path, pathlib.Path(entry_directory, path.name))
+            with open(pathlib.Path(entry_directory, 'files.json'), 'w') as fid:
+                json.dump([path.name for path in paths], fid)
+            self._evict()
+
+    def _evict(self):
+        if not self.directory.exists():
+            return
+        entries = []
+        total_size = 0
+        for entry_directory in self.directory.iterdir():
+            if not entry_directory.is_dir():
+                continue
+            try:
+                size = sum(path.stat().st_size for path in entry_directory.iterdir())
+                entries.append((entry_directory.stat().st_mtime, size, entry_directory))
+            except OSError:
+                continue
+            total_size += size
+        for mtime, size, entry_directory in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_directory, ignore_errors=True)
+            total_size -= size
+            logger.debug(f'Removed figure cache entry {entry_directory.name}')
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get_report(self):
+        """
+        :return: dict with number of hits and misses
+        """
+        return dict(hits=self.hits, misses=self.misses)
+
+    def log_report(self):
+        logger.info('Figure cache: {hits} hits, {misses} misses'.format(**self.get_report()))
+
@@ -4,7 +4,22 @@
 # Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
 
-from .page_user import PageUser
-from .page_algaware import PageAlgaware
+import importlib
+
+from ..timing import profile_startup
+
+# Pages are imported on first access (gui.PageAlgaware) so that importing the plugin stays cheap
+PAGE_MODULES = dict(PageUser='.page_user',
+                    PageAlgaware='.page_algaware')
+
+
+def __getattr__(name):
+    if name not in PAGE_MODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    with profile_startup(f'import {PAGE_MODULES[name]}'):
+        module = importlib.import_module(PAGE_MODULES[name], __name__)
+    page = getattr(module, name)
+    globals()[name] = page
+    return page
 
 
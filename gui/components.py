@@ -7,7 +7,7 @@ import datetime
 
 from pathlib import Path
 
-from ..events import post_event
+from ..events import post_event, set_debounce, add_event_type
 
 from sharkpylib.tklib import tkinter_widgets as tkw
 
@@ -471,6 +471,8 @@ class DirectoryLabelText(LabelText):
 
 
 class LabelEntry(tk.Frame):
+    # Typing posts change_<id>. Key strokes within this time (ms) are delivered as one event.
+    change_debounce = 300
 
     def __init__(self,
                  parent,
@@ -495,6 +497,10 @@ class LabelEntry(tk.Frame):
         super().__init__(parent)
         self.grid(**self.grid_frame)
 
+        add_event_type(f'change_{self._id}')
+        if self.change_debounce:
+            set_debounce(f'change_{self._id}', self.change_debounce)
+
         self._create_frame()
 
     def _create_frame(self):
@@ -534,6 +540,7 @@ class LabelEntry(tk.Frame):
 
             return_string = ''.join(return_list)
             self._stringvar.set(return_string)
+        post_event(f'change_{self._id}', self.value)
 
     @property
     def value(self):
@@ -541,8 +548,8 @@ class LabelEntry(tk.Frame):
 
     @value.setter
     def value(self, value):
+        # The trace on the variable calls _on_change_entry
         self._stringvar.set(str(value))
-        self._on_change_entry()
 
     def get(self):
         return self.value
@@ -552,6 +559,9 @@ class LabelEntry(tk.Frame):
 
 
 class YearEntry(LabelEntry):
+    # change_<id> is delivered at once
+    change_debounce = None
+
     def s__init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # self.entry.configure(state='disabled')
@@ -671,3 +681,271 @@ class SeriesSelection(tk.Frame):
         return self.selection_widget.get_selected()
 
 
+class ColumnarTableModel:
+    """
+    Holds table data as one list per column. Sorting and filtering only changes the order of row indices.
+    """
+    def __init__(self, columns=None):
+        self.columns = list(columns or [])
+        self._data = {col: [] for col in self.columns}
+        self.nr_rows = 0
+        self._sort_column = None
+        self._sort_reverse = False
+        self._filter_column = None
+        self._filter_string = ''
+        self.order = []
+
+    def set_df(self, df):
+        """
+        :param df: pandas.DataFrame
+        :return:
+        """
+        self.columns = [str(col) for col in df.columns]
+        self._data = {str(col): df[col].tolist() for col in df.columns}
+        self.nr_rows = len(df)
+        self._update_order()
+
+    def set_data(self, columns, data):
+        """
+        :param columns: list of column names
+        :param data: dict with column name as key and list of values as value
+        :return:
+        """
+        self.columns = list(columns)
+        self._data = {col: list(data.get(col, [])) for col in self.columns}
+        self.nr_rows = max([len(values) for values in self._data.values()] or [0])
+        self._update_order()
+
+    @staticmethod
+    def _is_missing(value):
+        return value is None or value != value
+
+    def get_value(self, row, column):
+        """
+        :param row: row index in the current order
+        :param column: column name
+        :return: string to show in the table. Missing values gives ''
+        """
+        values = self._data.get(column)
+        if values is None or row >= len(self.order):
+            return ''
+        value = values[self.order[row]]
+        if self._is_missing(value):
+            return ''
+        return str(value)
+
+    def _sort_key(self, column):
+        values = self._data[column]
+
+        def key(index):
+            value = values[index]
+            if self._is_missing(value):
+                return 2, ''
+            if isinstance(value, (int, float)):
+                return 0, value
+            return 1, str(value)
+        return key
+
+    def _update_order(self):
+        order = range(self.nr_rows)
+        if self._filter_column in self._data and self._filter_string:
+            string = self._filter_string.upper()
+            values = self._data[self._filter_column]
+            order = [i for i in order if not self._is_missing(values[i]) and string in str(values[i]).upper()]
+        order = list(order)
+        if self._sort_column in self._data:
+            order.sort(key=self._sort_key(self._sort_column), reverse=self._sort_reverse)
+        self.order = order
+
+    def sort(self, column, reverse=None):
+        """
+        Sorts on column. Sorting on the same column again reverses the order if reverse is not given.
+        :param column:
+        :param reverse:
+        :return:
+        """
+        if reverse is None:
+            reverse = not self._sort_reverse if column == self._sort_column else False
+        self._sort_column = column
+        self._sort_reverse = reverse
+        self._update_order()
+
+    def filter(self, column, string):
+        """
+        Only rows where column contains string (case insensitive) are kept.
+        :param column:
+        :param string:
+        :return:
+        """
+        self._filter_column = column
+        self._filter_string = string.strip()
+        self._update_order()
+
+    @property
+    def nr_visible_rows(self):
+        return len(self.order)
+
+
+class VirtualTable(tk.Frame):
+    """
+    Table that only has widgets for the visible rows. Data is read from a ColumnarTableModel
+    and only cells that show a new value are updated when scrolling, sorting or loading new data.
+    Click on a header to sort. The search entry filters on search_column.
+    """
+    def __init__(self,
+                 parent,
+                 id,
+                 columns=None,
+                 nr_rows=20,
+                 column_width=10,
+                 search_column=None,
+                 **kwargs):
+
+        self.grid_frame = {'padx': 5,
+                           'pady': 5,
+                           'sticky': 'nsew'}
+        self.grid_frame.update(kwargs)
+
+        self._id = id
+        self.nr_rows = nr_rows
+        self.column_width = column_width
+        self.search_column = search_column
+        self.model = ColumnarTableModel(columns)
+        self._first_row = 0
+        self._headers = []
+        self._cells = []
+        self._cell_values = []
+
+        super().__init__(parent)
+        self.grid(**self.grid_frame)
+
+        self._create_frame()
+
+    def _create_frame(self):
+        layout = dict(padx=1, pady=1, sticky='nsew')
+
+        search_frame = tk.Frame(self)
+        search_frame.grid(row=0, column=0, columnspan=2, sticky='nsew')
+        tk.Label(search_frame, text='Search station:').grid(row=0, column=0, padx=5, pady=5, sticky='w')
+        self._stringvar_search = tk.StringVar()
+        self._stringvar_search.trace('w', self._on_search)
+        tk.Entry(search_frame, textvariable=self._stringvar_search, width=15).grid(row=0, column=1,
+                                                                                  padx=5, pady=5, sticky='w')
+        self._stringvar_info = tk.StringVar()
+        tk.Label(search_frame, textvariable=self._stringvar_info).grid(row=0, column=2, padx=5, pady=5, sticky='w')
+
+        self.table_frame = tk.Frame(self)
+        self.table_frame.grid(row=1, column=0, sticky='nsew')
+
+        self.scrollbar = tk.Scrollbar(self, orient='vertical', command=self._on_scrollbar)
+        self.scrollbar.grid(row=1, column=1, sticky='ns')
+
+        for row in range(self.nr_rows):
+            self._cells.append([])
+            self._cell_values.append([])
+        self._set_columns(self.model.columns)
+
+        for widget in [self, self.table_frame]:
+            widget.bind('<MouseWheel>', self._on_mouse_wheel)
+            widget.bind('<Button-4>', lambda event: self.scroll(-1))
+            widget.bind('<Button-5>', lambda event: self.scroll(1))
+
+        tkw.grid_configure(self, nr_rows=2, nr_columns=2)
+
+    def _set_columns(self, columns):
+        """
+        Creates widgets for a new set of columns. Widgets are reused if the number of columns is the same.
+        :param columns:
+        :return:
+        """
+        if len(columns) != len(self._headers):
+            for widget in self._headers:
+                widget.destroy()
+            for row_cells in self._cells:
+                for widget in row_cells:
+                    widget.destroy()
+            self._headers = []
+            for c in range(len(columns)):
+                button = tk.Button(self.table_frame, width=self.column_width, relief='groove',
+                                   command=lambda c=c: self._on_click_header(c))
+                button.grid(row=0, column=c, padx=1, pady=1, sticky='nsew')
+                self._headers.append(button)
+            for r in range(self.nr_rows):
+                self._cells[r] = []
+                self._cell_values[r] = []
+                for c in range(len(columns)):
+                    label = tk.Label(self.table_frame, width=self.column_width, anchor='w', relief='sunken', bg='white')
+                    label.grid(row=r + 1, column=c, padx=1, pady=1, sticky='nsew')
+                    label.bind('<MouseWheel>', self._on_mouse_wheel)
+                    label.bind('<Button-4>', lambda event: self.scroll(-1))
+                    label.bind('<Button-5>', lambda event: self.scroll(1))
+                    self._cells[r].append(label)
+                    self._cell_values[r].append('')
+        for button, column in zip(self._headers, columns):
+            if button['text'] != column:
+                button.config(text=column)
+
+    def set_df(self, df):
+        """
+        :param df: pandas.DataFrame. Missing values are shown as empty cells.
+        :return:
+        """
+        self.model.set_df(df)
+        self._set_columns(self.model.columns)
+        self._first_row = 0
+        self._redraw()
+
+    def set_data(self, columns, data):
+        self.model.set_data(columns, data)
+        self._set_columns(self.model.columns)
+        self._first_row = 0
+        self._redraw()
+
+    def _redraw(self):
+        nr_visible = self.model.nr_visible_rows
+        max_first_row = max(nr_visible - self.nr_rows, 0)
+        self._first_row = min(max(self._first_row, 0), max_first_row)
+        for r in range(self.nr_rows):
+            model_row = self._first_row + r
+            for c, column in enumerate(self.model.columns):
+                value = self.model.get_value(model_row, column) if model_row < nr_visible else ''
+                if self._cell_values[r][c] != value:
+                    self._cells[r][c].config(text=value)
+                    self._cell_values[r][c] = value
+        if nr_visible:
+            self.scrollbar.set(self._first_row / nr_visible,
+                               min(self._first_row + self.nr_rows, nr_visible) / nr_visible)
+        else:
+            self.scrollbar.set(0, 1)
+        self._stringvar_info.set(f'{nr_visible} of {self.model.nr_rows} rows')
+
+    def scroll(self, nr_rows):
+        self._first_row += nr_rows
+        self._redraw()
+
+    def _on_scrollbar(self, *args):
+        if args[0] == 'moveto':
+            self._first_row = int(float(args[1]) * self.model.nr_visible_rows)
+        elif args[0] == 'scroll':
+            step = int(args[1])
+            if args[2] == 'pages':
+                step *= self.nr_rows
+            self._first_row += step
+        self._redraw()
+
+    def _on_mouse_wheel(self, event):
+        self.scroll(-1 if event.delta > 0 else 1)
+
+    def _on_click_header(self, column_index):
+        if column_index >= len(self.model.columns):
+            return
+        self.model.sort(self.model.columns[column_index])
+        self._redraw()
+
+    def _on_search(self, *args):
+        column = self.search_column
+        if column not in self.model.columns:
+            column = self.model.columns[0] if self.model.columns else None
+        self.model.filter(column, self._stringvar_search.get())
+        self._first_row = 0
+        self._redraw()
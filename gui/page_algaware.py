@@ -6,8 +6,6 @@
 
 import tkinter as tk
 
-from PIL import ImageTk
-
 try:
     import ttk
 except:
@@ -21,6 +19,8 @@ import calendar
 
 from . import components
 from ..saves import SaveComponents
+from ..render import get_file_formats
+from ..pipeline import get_monthly_periods
 
 import logging
 
@@ -103,13 +103,15 @@ class PageAlgaware(BaseGUI, tk.Frame):
         self.log_directory = parent_app.log_directory
 
         self.handler = None
+        self.job = None
 
         # self.default_import_directory = self.settings['directory']['Import directory']
         # self.default_export_directory = self.settings['directory']['Export directory']
 
     def startup(self):
         self._set_frame()
-        self._save_obj.add_components(self.archive_root_directory)
+        self._save_obj.add_components(self.archive_root_directory,
+                                      self.nr_render_workers)
 
         self._save_obj.load(user=self.user.name)
 
@@ -157,6 +159,12 @@ class PageAlgaware(BaseGUI, tk.Frame):
         self.labelframe_plot_figures = tk.LabelFrame(self, text='Plot figures')
         self.labelframe_plot_figures.grid(row=r, column=c, **self.grid)
 
+        self.labelframe_timing = tk.LabelFrame(self, text='Timing of latest load/plot and memory of loaded data')
+        self.labelframe_timing.grid(row=r + 1, column=0, columnspan=3, **self.grid)
+        self.labelframe_timing.grid_remove()
+        self.timing_label = components.MonospaceLabel(self.labelframe_timing, justify='left', anchor='nw')
+        self.timing_label.grid(row=0, column=0, sticky='nw', padx=5, pady=5)
+
         # tkw.grid_configure(self, nr_rows=4, nr_columns=4)
 
         self.frame_grid = {
@@ -226,6 +234,11 @@ class PageAlgaware(BaseGUI, tk.Frame):
         self.archive_root_directory = components.DirectoryLabelText(frame, 'archive_root',
                                       title='Rotkatalog för arkivet:',
                                       row=r, column=c, sticky='nw')
+        r += 1
+        self.button_rebuild_archive_index = tk.Button(frame,
+                                                      text='Rebuild archive index',
+                                                      command=self._rebuild_archive_index)
+        self.button_rebuild_archive_index.grid(row=r, column=c, sticky='nw', padx=5, pady=5)
 
     def _set_frame_ctd_directory(self):
         """
@@ -263,30 +276,32 @@ class PageAlgaware(BaseGUI, tk.Frame):
                                           command=self._load_data)
         self.button_load_data.grid(row=r, column=c, **self.grid)
         # ----------------------------------------------------------------------
+        r += 1
+        self.stringvar_progress = tk.StringVar()
+        tk.Label(frame, textvariable=self.stringvar_progress).grid(row=r, column=c, **self.grid)
+        r += 1
+        self.button_cancel_job = tk.Button(frame,
+                                           text='Cancel',
+                                           state='disabled',
+                                           command=self._cancel_job)
+        self.button_cancel_job.grid(row=r, column=c, **self.grid)
+        r += 1
+        self.show_timing = tkw.CheckbuttonWidgetSingle(frame, name='Show timing and memory', row=r,
+                                                       callback=self._toggle_timing_panel)
+        r += 1
+        self.compact_data = tkw.CheckbuttonWidgetSingle(frame, name='Compact data (less memory)', row=r)
 
     def _set_frame_data(self):
         frame = self.labelframe_data
 
-        # New test
-        self.entry_grid = tkw.EntryGridWidget(frame,
-                                              width=420,
-                                              height=420,
-                                              column=0,
-                                              row=0,
-                                              # return_direction='vertical',
-                                              nr_rows=22,
-                                              nr_columns=5,
-                                              in_slides=True)
-
-        # col_width = dict((self.header_to_col[item], 5) for item in header)
         header = ['Station', 'Statistics', 'BTL-data', 'CTD-data', 'Dates']
-        col_width = {}
-        for i, item in enumerate(header):
-            col_width[i] = 10
-        self.entry_grid.set_width_for_columns(col_width)
-        self.entry_grid.insert_values([0]*len(header), range(len(header)), header)
-
-        self.entry_grid.disable_row(0)
+        self.data_table = components.VirtualTable(frame, 'available_data',
+                                                  columns=header,
+                                                  nr_rows=21,
+                                                  column_width=10,
+                                                  search_column='Station',
+                                                  row=0,
+                                                  column=0)
 
     def _set_frame_plot_figures(self):
         """
@@ -309,13 +324,6 @@ class PageAlgaware(BaseGUI, tk.Frame):
 
         self.combobox_widget_file_format.set('pdf')
 
-        print(self.combobox_widget_file_format.get())
-        # TODO läs ifrån combobox eller stringvar ???
-        # self.stringvar_file_format.set('png')
-        """
-        active, disabled, focus, pressed, selected, background,
-            readonly, alternate, invalid
-        """
         # ----------------------------------------------------------------------
         r += 1
         add_line(frame, r)
@@ -334,6 +342,18 @@ class PageAlgaware(BaseGUI, tk.Frame):
         for item in preselected:
             self.area_options.cbutton[item].select()
 
+        r += 1
+        add_line(frame, r)
+        r += 1
+        # ----------------------------------------------------------------------
+        self.parallel_plot = tkw.CheckbuttonWidgetSingle(frame, name='Render areas in parallel', row=r)
+        self.nr_render_workers = components.LabelEntry(frame, 'nr_render_workers',
+                                                       title='Workers:',
+                                                       width=4,
+                                                       data_type=int,
+                                                       row=r,
+                                                       column=1)
+
         r += 1
         add_line(frame, r)
         r += 1
@@ -343,6 +363,12 @@ class PageAlgaware(BaseGUI, tk.Frame):
                                              text='Plot figures',
                                              command=self._plot)
         self.button_plot_figures.grid(row=r, column=c, **self.grid)
+        self._update_plot_button()
+        c += 1
+        self.button_plot_months = tk.Button(frame,
+                                            text='Plot each month in period',
+                                            command=self._plot_months)
+        self.button_plot_months.grid(row=r, column=c, **self.grid)
         # ----------------------------------------------------------------------
 
     def _dummy(self):
@@ -353,7 +379,7 @@ class PageAlgaware(BaseGUI, tk.Frame):
         :return:
         """
         x_list = self.parent_app.get_data_xlist()
-        self.entry_grid.set_df(x_list.fillna(''), columns=x_list.columns)
+        self.data_table.set_df(x_list)
 
     def get_calendar_date(self):
         """
@@ -365,13 +391,10 @@ class PageAlgaware(BaseGUI, tk.Frame):
         # print('ttkcal.selection', ttkcal.selection)
         return ttkcal.selection
 
-    def _load_data(self):
+    def _get_data_sources(self):
         """
-        :return:
+        :return: dict with ctd_directory, lims_path and archive_root_dir or None if the sources are not valid
         """
-        time_settings = {'start_time': self.sdate,
-                         'end_time': self.edate}
-
         archive_root_dir = self.archive_root_directory.get().strip()
         lims_path = self.lims_path.get_value().strip()
         if not self.use_lims.get():
@@ -388,19 +411,181 @@ class PageAlgaware(BaseGUI, tk.Frame):
             return
         else:
             logger.info('Data source is LIMS')
-        self.parent_app.load_data(time_settings,
-                                  ctd_directory=self.ctd_directory.get_value(),
-                                  lims_path=lims_path,
-                                  archive_root_dir=archive_root_dir)
-        self.set_entry_grid_values()
+        return dict(ctd_directory=self.ctd_directory.get_value(),
+                    lims_path=lims_path,
+                    archive_root_dir=archive_root_dir)
+
+    def _load_data(self):
+        """
+        :return:
+        """
+        time_settings = {'start_time': self.sdate,
+                         'end_time': self.edate}
+
+        sources = self._get_data_sources()
+        if not sources:
+            return
+
+        self.parent_app.set_compact_data(self.compact_data.get())
+
+        def target(job):
+            self.parent_app.load_data(time_settings, job=job, **sources)
+
+        def on_done(result):
+            self._on_job_finished('Data loaded')
+            self.set_entry_grid_values()
+
+        self._start_job('load_data', target, on_done=on_done)
+
+    def _rebuild_archive_index(self):
+        """
+        :return:
+        """
+        archive_root_dir = self.archive_root_directory.get().strip()
+        if not archive_root_dir:
+            messagebox.showerror('Rebuild archive index', 'No archive root given!')
+            return
+
+        def target(job):
+            job.report('Indexing archive')
+            return self.parent_app.rebuild_archive_index(archive_root_dir)
+
+        def on_done(nr_files):
+            self._on_job_finished(f'{nr_files} files in archive index')
+
+        self._start_job('rebuild_archive_index', target, on_done=on_done)
 
     def _plot(self):
         """
         :return:
         """
         figures_to_plot = self.area_options.get_checked_item_list()
-        for figure_key in figures_to_plot:
-            self.parent_app.plot(figure_key, save_as_format=self.file_formats)
+        save_as_format = self.file_formats
+        parallel = self.parallel_plot.get()
+        nr_workers = self.nr_render_workers.get()
+
+        def target(job):
+            return self.parent_app.plot_figures(figures_to_plot,
+                                                save_as_format=save_as_format,
+                                                parallel=parallel,
+                                                nr_workers=nr_workers,
+                                                job=job)
+
+        def on_done(result):
+            failed = [figure_key for figure_key, error in result.items() if error]
+            if failed:
+                self._on_job_finished('Some figures failed')
+                messagebox.showerror('Plot figures', 'Could not plot:\n' + '\n'.join(failed))
+            else:
+                self._on_job_finished('Figures plotted')
+
+        self._start_job('plot', target, on_done=on_done)
+
+    def _plot_months(self):
+        """
+        Loads and plots each month in the selected period. The next month is loaded while the current is plotted.
+        :return:
+        """
+        try:
+            periods = get_monthly_periods(self.sdate, self.edate)
+        except ValueError:
+            messagebox.showerror('Plot each month', 'Invalid period!')
+            return
+        sources = self._get_data_sources()
+        if not sources:
+            return
+        figures_to_plot = self.area_options.get_checked_item_list()
+        save_as_format = self.file_formats
+
+        def target(job):
+            return self.parent_app.plot_periods(periods, figures_to_plot,
+                                                save_as_format=save_as_format,
+                                                job=job,
+                                                **sources)
+
+        def on_done(result):
+            failed = []
+            for (start_time, end_time), value in result.items():
+                if isinstance(value, Exception):
+                    failed.append(f'{start_time} - {end_time}: {value}')
+                    continue
+                failed.extend([f'{start_time} - {end_time}: {figure_key}'
+                               for figure_key, error in value.items() if error])
+            if failed:
+                self._on_job_finished('Some figures failed')
+                messagebox.showerror('Plot each month', 'Could not plot:\n' + '\n'.join(failed))
+            else:
+                self._on_job_finished(f'Figures plotted for {len(result)} months')
+
+        self._start_job('plot_months', target, on_done=on_done)
+
+    def _start_job(self, name, target, on_done=None):
+        """
+        Runs target(job) in the background and shows progress on the page.
+        :param name:
+        :param target:
+        :param on_done:
+        :return:
+        """
+        job = self.parent_app.start_job(name, target,
+                                        on_progress=self._on_job_progress,
+                                        on_done=on_done,
+                                        on_error=self._on_job_error,
+                                        on_cancelled=lambda: self._on_job_finished('Cancelled'))
+        if not job:
+            messagebox.showinfo('Busy', 'Please wait for the running job to finish or cancel it.')
+            return
+        self.job = job
+        self.button_load_data.config(state='disabled')
+        self.button_plot_figures.config(state='disabled')
+        self.button_plot_months.config(state='disabled')
+        self.button_cancel_job.config(state='normal')
+        self.stringvar_progress.set('Starting...')
+
+    def _on_job_progress(self, stage, step, nr_steps):
+        if step and nr_steps:
+            self.stringvar_progress.set(f'{stage} ({step}/{nr_steps})')
+        else:
+            self.stringvar_progress.set(stage)
+
+    def _on_job_error(self, error):
+        self._on_job_finished('Failed')
+        messagebox.showerror('Algaware', str(error))
+
+    def _on_job_finished(self, message=''):
+        self.job = None
+        self._update_timing_panel()
+        self.button_load_data.config(state='normal')
+        self._update_plot_button()
+        self.button_plot_months.config(state='normal')
+        self.button_cancel_job.config(state='disabled')
+        self.stringvar_progress.set(message)
+
+    def _update_plot_button(self):
+        """
+        Plotting is only possible when the latest load has finished.
+        """
+        state = 'normal' if self.parent_app.is_data_loaded() else 'disabled'
+        self.button_plot_figures.config(state=state)
+
+    def _toggle_timing_panel(self):
+        if self.show_timing.get():
+            self.labelframe_timing.grid()
+            self._update_timing_panel()
+        else:
+            self.labelframe_timing.grid_remove()
+
+    def _update_timing_panel(self):
+        if not self.show_timing.get():
+            return
+        self.timing_label.config(text=self.parent_app.get_timing_summary() + '\n\n' +
+                                 self.parent_app.get_memory_report())
+
+    def _cancel_job(self):
+        if not self.job:
+            return
+        self.job.cancel()
+        self.stringvar_progress.set('Cancelling...')
 
     def _set_sdate_with_calendar(self):
         """
@@ -495,16 +680,9 @@ class PageAlgaware(BaseGUI, tk.Frame):
     @property
     def file_formats(self):
         """
-        :return:
+        :return: list of file formats selected in the combobox. "ALL" gives eps, png and pdf.
         """
-        print('returning %s as file format' % self.stringvar_file_format.get())
-        # print('self.combobox_widget_file_format.get_value()', self.combobox_widget_file_format.get_value())
-        # fmts = self.stringvar_file_format.get()
-        # print('fmts', fmts, type(fmts))
-        # if fmts == 'ALL':
-        #     fmts = ['png', 'pdf', 'eps']
-        fmts = ['png', 'pdf']
-        return fmts
+        return get_file_formats(self.stringvar_file_format.get())
 
     def plot_image(self, frame, row, col):
         """
@@ -517,6 +695,7 @@ class PageAlgaware(BaseGUI, tk.Frame):
         # image = image.resize((320, 87), Image.ANTIALIAS)
 
         # photo = ImageTk.PhotoImage(image)
+        from PIL import ImageTk
         label = tk.Label(frame)
         # label = tk.Label(frame, image=photo)
         label.img = ImageTk.PhotoImage(file=path)  # keep a reference!
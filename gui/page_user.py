@@ -10,9 +10,6 @@ import core
 import sharkpylib.tklib.tkinter_widgets as tkw
 from sharkpylib import utils
 
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-
 
 class PageUser(tk.Frame):
     """
@@ -0,0 +1,122 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    Runs target(job) in a background thread. Progress and the result is handed back to the tkinter thread
+    by polling a queue with widget.after so that callbacks can update the GUI.
+    The target should call job.report(...) between stages and job.check_cancelled() where it is safe to stop.
+    """
+    def __init__(self, widget, target,
+                 name='',
+                 on_progress=None,
+                 on_done=None,
+                 on_error=None,
+                 on_cancelled=None,
+                 poll_interval=100):
+        self.widget = widget
+        self.target = target
+        self.name = name
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancelled = on_cancelled
+        self.poll_interval = poll_interval
+
+        self._queue = queue.Queue()
+        self._cancel_event = threading.Event()
+        self._thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name=f'algaware_job_{self.name}', daemon=True)
+        self._thread.start()
+        self.widget.after(self.poll_interval, self._poll)
+        return self
+
+    def _run(self):
+        try:
+            result = self.target(self)
+            self._queue.put(('done', result))
+        except JobCancelled:
+            self._queue.put(('cancelled', None))
+        except Exception as e:
+            logger.exception(f'Job {self.name} failed')
+            self._queue.put(('error', e))
+
+    def _poll(self):
+        while True:
+            try:
+                kind, data = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                self._call(self.on_progress, *data)
+                continue
+            self.running = False
+            if kind == 'done':
+                self._call(self.on_done, data)
+            elif kind == 'cancelled':
+                self._call(self.on_cancelled)
+            elif kind == 'error':
+                self._call(self.on_error, data)
+            return
+        self.widget.after(self.poll_interval, self._poll)
+
+    @staticmethod
+    def _call(func, *args):
+        if func:
+            func(*args)
+
+    def report(self, stage, step=None, nr_steps=None):
+        """
+        Called from the job thread.
+        :param stage: Name of the current stage
+        :param step:
+        :param nr_steps:
+        :return:
+        """
+        self._queue.put(('progress', (stage, step, nr_steps)))
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        """
+        Called from the job thread. Raises JobCancelled if cancel has been requested.
+        :return:
+        """
+        if self._cancel_event.is_set():
+            raise JobCancelled(self.name)
+
+
+def report(job, stage, step=None, nr_steps=None):
+    """
+    Reports progress and checks for cancel if job is given.
+    :param job: Job or None
+    :param stage:
+    :param step:
+    :param nr_steps:
+    :return:
+    """
+    if job is None:
+        return
+    job.check_cancelled()
+    job.report(stage, step, nr_steps)
@@ -0,0 +1,231 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+
+from .figure_cache import get_path_signature
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FILTER_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent, 'cache', 'lims')
+
+DATE_COLUMNS = ['SDATE', 'sample_date', 'Provtagningsdatum']
+STATION_COLUMNS = ['STATN', 'station_name', 'Station']
+
+CHUNK_SIZE = 1024 * 1024
+
+# YYYY-MM-DD, YYYYMMDD, YYYY/MM/DD or YYYY.MM.DD, possibly followed by a time
+DATE_PATTERN = re.compile(r'^(\d{4})([-/.]?)(\d{2})\2(\d{2})(?!\d)')
+
+
+def _normalize_date(value):
+    """
+    :param value: date as str, possibly with time
+    :return: YYYY-MM-DD or '' if not a date in a known format
+    """
+    match = DATE_PATTERN.match(value.strip().strip('"'))
+    if not match:
+        return ''
+    year, _, month, day = match.groups()
+    return f'{year}-{month}-{day}'
+
+
+def _get_column_index(header, alternatives):
+    for name in alternatives:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def iter_lines(fid, chunk_size=CHUNK_SIZE):
+    """
+    Yields lines (bytes) reading the file chunk_size bytes at a time.
+    :param fid: file opened in binary mode
+    :param chunk_size:
+    :return:
+    """
+    rest = b''
+    while True:
+        chunk = fid.read(chunk_size)
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+
+def filter_lims_export(path,
+                       start_time,
+                       end_time,
+                       stations=None,
+                       target_path=None,
+                       sorted_by_date=False,
+                       separator='\t',
+                       encoding='cp1252',
+                       info=None):
+    """
+    Writes the header and the rows of a LIMS export with sample date in start_time..end_time
+    (and station in stations if given) to target_path. The file is read in chunks so memory use
+    does not depend on the size of the export. Rows are copied byte by byte.
+    Rows with a blank sample date or a date in an unknown format are kept (and counted), since they
+    can not be compared with the period. The same goes for rows with fewer columns than the header
+    (also when the station column is missing).
+    :param path: LIMS export
+    :param start_time: YYYY-MM-DD
+    :param end_time: YYYY-MM-DD
+    :param stations: list of station names
+    :param target_path:
+    :param sorted_by_date: Stop reading at the first row after end_time
+    :param separator:
+    :param encoding: Encoding of the export. Used to match station names.
+    :param info: dict that is updated with nr_rows, nr_kept, nr_undated, nr_short and is_sorted
+                 (True if all rows were read, all had a date and the dates never decrease)
+    :return: path to the filtered file or path if the export could not be filtered
+    """
+    path = pathlib.Path(path)
+    target_path = pathlib.Path(target_path)
+    sep = separator.encode(encoding)
+    station_set = {station.strip().upper() for station in stations} if stations else None
+    nr_rows = 0
+    nr_kept = 0
+    nr_undated = 0
+    nr_short = 0
+    is_sorted = True
+    previous_date = ''
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target_path.parent, suffix='.tmp')
+    try:
+        with open(path, 'rb') as fid, os.fdopen(fd, 'wb') as out:
+            lines = iter_lines(fid)
+            header_line = next(lines, b'')
+            header = [item.strip().strip(b'"').decode(encoding, errors='replace')
+                      for item in header_line.rstrip(b'\r\n').split(sep)]
+            date_index = _get_column_index(header, DATE_COLUMNS)
+            station_index = _get_column_index(header, STATION_COLUMNS)
+            if date_index is None or (station_set and station_index is None):
+                logger.warning(f'Could not find date or station column in LIMS export {path}. Not filtering.')
+                out.close()
+                pathlib.Path(tmp_path).unlink(missing_ok=True)
+                return path
+            out.write(header_line)
+            for line in lines:
+                if not line.strip():
+                    continue
+                nr_rows += 1
+                values = line.rstrip(b'\r\n').split(sep)
+                if len(values) <= date_index:
+                    # Row with fewer columns than the header. Handled as a row without sample date.
+                    nr_short += 1
+                    date = ''
+                else:
+                    date = _normalize_date(values[date_index].decode(encoding, errors='replace'))
+                if not date:
+                    nr_undated += 1
+                    is_sorted = False
+                else:
+                    if date < previous_date:
+                        is_sorted = False
+                    previous_date = date
+                    if date > end_time:
+                        if sorted_by_date:
+                            is_sorted = None
+                            break
+                        continue
+                    if date < start_time:
+                        continue
+                if station_set is not None and len(values) > station_index:
+                    station = values[station_index].decode(encoding, errors='replace').strip().strip('"').upper()
+                    if station not in station_set:
+                        continue
+                out.write(line)
+                nr_kept += 1
+        os.replace(tmp_path, target_path)
+    except Exception:
+        pathlib.Path(tmp_path).unlink(missing_ok=True)
+        raise
+    logger.info(f'LIMS export filtered: {nr_kept} of {nr_rows} read rows kept')
+    if nr_undated:
+        logger.warning(f'{nr_undated} rows in LIMS export {path} have no sample date in a known format. '
+                       f'They are kept.')
+    if nr_short:
+        logger.warning(f'{nr_short} rows in LIMS export {path} have fewer columns than the header. They are kept.')
+    if info is not None:
+        info.update(nr_rows=nr_rows, nr_kept=nr_kept, nr_undated=nr_undated, nr_short=nr_short,
+                    is_sorted=is_sorted)
+    return target_path
+
+
+class LimsFilter:
+    """
+    Keeps filtered copies of LIMS exports. A filtered file is reused as long as the export,
+    the period and the stations are the same.
+    If sorted_by_date is None, reading stops after the period for exports that were found to be sorted
+    on date the first time they were filtered.
+    """
+    def __init__(self, directory=None, sorted_by_date=None, max_nr_files=10):
+        self.directory = pathlib.Path(directory or DEFAULT_FILTER_DIRECTORY)
+        self.sorted_by_date = sorted_by_date
+        self.max_nr_files = max_nr_files
+        self._sorted_exports = {}
+
+    def get_filtered_path(self, lims_path, start_time, end_time, stations=None):
+        """
+        :param lims_path:
+        :param start_time: YYYY-MM-DD
+        :param end_time: YYYY-MM-DD
+        :param stations:
+        :return: path to a LIMS export with only the rows in the period
+        """
+        signature = json.dumps(get_path_signature(lims_path))
+        info = [signature, start_time, end_time, sorted(stations or [])]
+        key = hashlib.md5(json.dumps(info).encode()).hexdigest()
+        target_path = pathlib.Path(self.directory, f'{key}{pathlib.Path(lims_path).suffix}')
+        try:
+            os.utime(target_path)
+            return target_path
+        except FileNotFoundError:
+            # Not filtered yet or removed by another process using the same directory
+            pass
+        sorted_by_date = self.sorted_by_date
+        if sorted_by_date is None:
+            sorted_by_date = self._sorted_exports.get(signature, False)
+        filter_info = {}
+        path = filter_lims_export(lims_path, start_time, end_time,
+                                  stations=stations,
+                                  target_path=target_path,
+                                  sorted_by_date=sorted_by_date,
+                                  info=filter_info)
+        if filter_info.get('is_sorted') is not None:
+            self._sorted_exports[signature] = filter_info['is_sorted']
+        self._evict()
+        return path
+
+    def _evict(self):
+        """
+        Removes all but the max_nr_files latest used files. The directory may be shared with other processes
+        (e.g. batch workers) evicting at the same time, so files may disappear while this runs.
+        """
+        files = []
+        for path in self.directory.iterdir():
+            if path.suffix == '.tmp':
+                continue
+            try:
+                files.append((path.stat().st_mtime, path))
+            except OSError:
+                continue
+        files.sort(reverse=True)
+        for mtime, path in files[self.max_nr_files:]:
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                logger.debug(f'Could not remove filtered LIMS export {path}: {e}')
@@ -0,0 +1,187 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import calendar
+import datetime
+import logging
+import queue
+import threading
+import time
+
+from .jobs import JobCancelled, report
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for cancel while waiting on the queues
+WAIT_INTERVAL = 0.2
+
+_DONE = object()
+
+
+def get_monthly_periods(start_time, end_time):
+    """
+    Splits start_time..end_time in calendar months.
+    :param start_time: YYYY-MM-DD
+    :param end_time: YYYY-MM-DD
+    :return: list of (start_time, end_time) as strings in format %Y-%m-%d
+    """
+    start = datetime.datetime.strptime(str(start_time)[:10], '%Y-%m-%d').date()
+    end = datetime.datetime.strptime(str(end_time)[:10], '%Y-%m-%d').date()
+    periods = []
+    while start <= end:
+        month_end = start.replace(day=calendar.monthrange(start.year, start.month)[1])
+        periods.append((start.strftime('%Y-%m-%d'), min(month_end, end).strftime('%Y-%m-%d')))
+        start = month_end + datetime.timedelta(days=1)
+    return periods
+
+
+class _LoaderJob:
+    """
+    Passed as job to load_data in the loader thread, so that a load stops at the next stage when the pipeline
+    is stopped or job is cancelled. Progress of the loads is not reported, since the job reports the plotting.
+    """
+    def __init__(self, stop, job=None):
+        self._stop = stop
+        self._job = job
+
+    def report(self, stage, step=None, nr_steps=None):
+        logger.debug(f'Loading: {stage}')
+
+    @property
+    def cancelled(self):
+        return self._stop.is_set() or (self._job is not None and self._job.cancelled)
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled('period_loader')
+
+
+class PeriodPipeline:
+    """
+    Loads and plots several periods. A loader thread loads the next period while the current period is
+    plotted in the calling thread. At most max_buffered loaded periods wait to be plotted, so at most
+    max_buffered + 2 sessions (one loading, the buffered ones and one plotting) exist at the same time.
+    Sessions are created with create_session() and reused between periods.
+    """
+    def __init__(self, create_session, max_buffered=1):
+        self.create_session = create_session
+        self.max_buffered = max_buffered
+        self.latest_report = {}
+        self._sessions = []
+        self._free_sessions = queue.Queue()
+        self._stop = threading.Event()
+
+    def _get_free_session(self):
+        try:
+            return self._free_sessions.get_nowait()
+        except queue.Empty:
+            pass
+        if len(self._sessions) < self.max_buffered + 2:
+            session = self.create_session()
+            self._sessions.append(session)
+            return session
+        while not self._stop.is_set():
+            try:
+                return self._free_sessions.get(timeout=WAIT_INTERVAL)
+            except queue.Empty:
+                pass
+        return None
+
+    def _put(self, ready, item):
+        while not self._stop.is_set():
+            try:
+                ready.put(item, timeout=WAIT_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _load(self, periods, load_kwargs, ready, load_times, job=None):
+        loader_job = _LoaderJob(self._stop, job)
+        try:
+            for start_time, end_time in periods:
+                t0 = time.perf_counter()
+                session = None
+                try:
+                    session = self._get_free_session()
+                    if session is None:
+                        return
+                    session.load_data({'start_time': start_time, 'end_time': end_time}, job=loader_job,
+                                      **load_kwargs)
+                    error = None
+                except JobCancelled:
+                    return
+                except Exception as e:
+                    logger.error(f'Could not load period {start_time} - {end_time}: {e}')
+                    error = e
+                load_times.append(time.perf_counter() - t0)
+                self._put(ready, ((start_time, end_time), session, error))
+        finally:
+            self._put(ready, _DONE)
+
+    def _get_ready(self, ready, job):
+        while True:
+            if job is not None:
+                job.check_cancelled()
+            try:
+                return ready.get(timeout=WAIT_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def run(self, periods, figure_keys, save_as_format=None, load_kwargs=None, job=None):
+        """
+        :param periods: list of (start_time, end_time)
+        :param figure_keys:
+        :param save_as_format:
+        :param load_kwargs: ctd_directory, lims_path, archive_root_dir and stations passed to AlgawareSession.load_data
+        :param job: jobs.Job used to report progress and check for cancel. It is passed to load_data and plot_figures,
+                    so cancel stops the load in progress and the plot at the next stage or figure.
+        :return: dict with period as key and a dict (figure_key: None or exception)
+                 or the exception raised when creating the session or loading as value
+        """
+        periods = [tuple(period) for period in periods]
+        load_kwargs = load_kwargs or {}
+        ready = queue.Queue(maxsize=self.max_buffered)
+        load_times = []
+        plot_times = []
+        result = {}
+        self._stop.clear()
+        t0 = time.perf_counter()
+        loader = threading.Thread(target=self._load, args=(periods, load_kwargs, ready, load_times, job),
+                                  name='period_loader', daemon=True)
+        loader.start()
+        try:
+            for i in range(len(periods) + 1):
+                item = self._get_ready(ready, job)
+                if item is _DONE:
+                    break
+                period, session, error = item
+                if error is not None:
+                    result[period] = error
+                    if session is not None:
+                        self._free_sessions.put(session)
+                    continue
+                report(job, f'Plotting {period[0]} - {period[1]}', i + 1, len(periods))
+                t_plot = time.perf_counter()
+                try:
+                    result[period] = session.plot_figures(figure_keys, save_as_format=save_as_format, job=job)
+                finally:
+                    plot_times.append(time.perf_counter() - t_plot)
+                    self._free_sessions.put(session)
+        finally:
+            self._stop.set()
+            loader.join()
+            self.close()
+        self.latest_report = dict(nr_periods=len(periods),
+                                  duration=time.perf_counter() - t0,
+                                  load_time=sum(load_times),
+                                  plot_time=sum(plot_times))
+        logger.info('Pipeline: {nr_periods} periods in {duration:.1f} s '
+                    '(load {load_time:.1f} s, plot {plot_time:.1f} s)'.format(**self.latest_report))
+        return result
+
+    def close(self):
+        for session in self._sessions:
+            session.close()
+        self._sessions = []
+        self._free_sessions = queue.Queue()
@@ -0,0 +1,264 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+import multiprocessing.util
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .jobs import report
+from .figure_cache import PrivateExportDirectory
+
+
+logger = logging.getLogger(__name__)
+
+# Session used by the current worker process. Set in _initialize_worker.
+_worker_session = None
+
+ALL_FORMATS = ['eps', 'png', 'pdf']
+
+# Formats that are slow to write. They are saved after the other formats of the same drawn figure.
+SLOW_FORMATS = ['eps']
+
+# pyplot is not thread-safe. Only one figure is drawn at a time in a process.
+_draw_lock = threading.Lock()
+
+
+def use_non_interactive_backend():
+    """
+    Figures are only saved to file, never shown, so no GUI backend is needed. pyplot with an interactive
+    backend (e.g. TkAgg) can not be used outside the main thread, where load and plot jobs run.
+    Switching backend closes all open pyplot figures of the process, so it is only done if needed and only in
+    processes that never show figures: worker processes, batch and benchmarks. Never in the GUI process,
+    where the backend belongs to the host application (there figures are drawn in worker processes,
+    see AlgawareSession render_in_subprocess).
+    :return:
+    """
+    import matplotlib
+    if matplotlib.get_backend().lower() != 'agg':
+        matplotlib.use('Agg', force=True)
+
+
+def get_file_formats(value):
+    """
+    Returns a list of file formats from the value selected in the GUI.
+    "ALL" gives all formats in ALL_FORMATS. Formats in SLOW_FORMATS are placed last.
+    :param value: str or list
+    :return:
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    fmts = []
+    for item in value:
+        item = item.strip().lower().lstrip('.')
+        if item == 'all':
+            items = ALL_FORMATS
+        else:
+            items = [item]
+        for fmt in items:
+            if fmt and fmt not in fmts:
+                fmts.append(fmt)
+    fmts.sort(key=lambda fmt: fmt in SLOW_FORMATS)
+    return fmts
+
+
+def get_nr_workers(nr_workers=None, nr_jobs=None):
+    """
+    Returns the number of worker processes to use. Defaults to the number of cores.
+    Never more than the number of jobs.
+    :param nr_workers:
+    :param nr_jobs:
+    :return:
+    """
+    try:
+        nr_workers = int(nr_workers)
+    except (TypeError, ValueError):
+        nr_workers = 0
+    if nr_workers < 1:
+        nr_workers = os.cpu_count() or 1
+    if nr_jobs:
+        nr_workers = min(nr_workers, nr_jobs)
+    return max(nr_workers, 1)
+
+
+class RenderSession:
+    """
+    Keeps the figure handler of an algaware session between renders.
+    The figure handler is built once per load and the figure settings are only updated when the figure_key changes.
+    The plot handler is rebuilt for every render since it holds the figure being drawn.
+    The time spent on the setup steps is measured so that the saved setup cost can be reported.
+    Figures are saved in a private export directory (see figure_cache.PrivateExportDirectory) that is set up
+    before the figure handler is initialized, so render can tell which files it saved.
+    """
+    def __init__(self, alg_session, timer=None):
+        self.alg_session = alg_session
+        self.timer = timer
+        self.private_export_directory = PrivateExportDirectory(alg_session)
+        self.reset()
+
+    def reset(self):
+        """
+        Call when new data has been loaded.
+        :return:
+        """
+        self.private_export_directory.restore()
+        self._figure_handler_initialized = False
+        self._figure_key = None
+        self._applied_ahead = False
+        self._setup_times = {}
+        self.nr_renders = 0
+        self.time_spent = 0.0
+        self.time_saved = 0.0
+
+    def _run_setup_step(self, name, figure_key, func, *args):
+        t0 = time.perf_counter()
+        if self.timer is None:
+            func(*args)
+        else:
+            with self.timer.stage(name, figure_key=figure_key):
+                func(*args)
+        duration = time.perf_counter() - t0
+        self._setup_times[name] = duration
+        self.time_spent += duration
+
+    def _skip_setup_step(self, name):
+        self.time_saved += self._setup_times.get(name, 0.0)
+
+    def apply_figure_settings(self, figure_key):
+        """
+        Builds the figure handler if needed and applies the figure settings of figure_key,
+        e.g. to read the settings before the figure is rendered.
+        :param figure_key:
+        :return:
+        """
+        with _draw_lock:
+            if figure_key != self._figure_key or not self._figure_handler_initialized:
+                self._apply_figure_settings(figure_key)
+                self._applied_ahead = True
+
+    def _apply_figure_settings(self, figure_key):
+        if self._figure_handler_initialized:
+            self._skip_setup_step('figure_handler')
+        else:
+            self.private_export_directory.redirect()
+            self._run_setup_step('figure_handler', figure_key, self.alg_session.initialize_figure_handler)
+            self._figure_handler_initialized = True
+            self._figure_key = None
+
+        if figure_key == self._figure_key:
+            self._skip_setup_step('figure_settings')
+        else:
+            self._run_setup_step('figure_settings', figure_key, self.alg_session.update_figure_settings, figure_key)
+            self._figure_key = figure_key
+
+    def prepare(self, figure_key):
+        """
+        Applies what differs from the previous render before rendering figure_key.
+        :param figure_key:
+        :return:
+        """
+        # If apply_figure_settings has just set up figure_key, skipping the setup saves nothing
+        if not (self._applied_ahead and figure_key == self._figure_key):
+            self._apply_figure_settings(figure_key)
+        self._applied_ahead = False
+
+        self._run_setup_step('plot_handler', figure_key, self.alg_session.initialize_plot_handler)
+
+    def render(self, figure_key, save_as_format=None):
+        """
+        The figure is drawn once and saved in all formats in save_as_format.
+        Drawing is never done in two threads at the same time. The process must use a non-interactive backend
+        (see use_non_interactive_backend).
+        :param figure_key:
+        :param save_as_format: list of formats
+        :return: list of paths saved by this render. Empty if the export directory is not known.
+        """
+        with _draw_lock:
+            try:
+                self.prepare(figure_key)
+                if self.timer is None:
+                    self.alg_session.plot_figure(save_as_format=save_as_format)
+                else:
+                    with self.timer.stage('plot_figure', figure_key=figure_key):
+                        self.alg_session.plot_figure(save_as_format=save_as_format)
+            finally:
+                saved_paths = self.private_export_directory.collect()
+        self.nr_renders += 1
+        return saved_paths
+
+    def close(self):
+        self.private_export_directory.restore()
+
+    def get_report(self):
+        """
+        :return: dict with setup cost spent and saved since the latest load
+        """
+        return dict(nr_renders=self.nr_renders,
+                    setup_time_spent=self.time_spent,
+                    setup_time_saved=self.time_saved)
+
+    def log_report(self):
+        report = self.get_report()
+        logger.info('Render session: {nr_renders} renders, setup {setup_time_spent:.2f} s, '
+                    'saved {setup_time_saved:.2f} s'.format(**report))
+
+
+def _initialize_worker(worker_config, load_kwargs):
+    global _worker_session
+    use_non_interactive_backend()
+    from .session import create_worker_session
+    _worker_session = create_worker_session(worker_config)
+    # Removes the private export directory when the worker process exits
+    multiprocessing.util.Finalize(None, _worker_session.close, exitpriority=10)
+    _worker_session.load_data(**load_kwargs)
+
+
+def _render_figure(figure_key, save_as_format):
+    return _worker_session.render(figure_key, get_file_formats(save_as_format))
+
+
+class ParallelRenderer:
+    """
+    Renders each figure_key in its own worker process.
+    The algaware session can not be shared between processes so every worker creates a session with the same
+    configuration as the session in the GUI, loads the data once (using the same arguments) and then renders
+    the figures given to it.
+    """
+    def __init__(self, nr_workers=None):
+        self.nr_workers = nr_workers
+
+    def plot(self, worker_config, load_kwargs, formats_by_figure_key, job=None):
+        """
+        :param worker_config: see AlgawareSession.get_worker_config
+        :param load_kwargs: Arguments used for AlgawareSession.load_data
+        :param formats_by_figure_key: dict with figure_key as key and list of file formats as value
+        :param job: jobs.Job used to report progress. Figures not yet started are dropped on cancel.
+        :return: dict with figure_key as key and the saved paths by format (or the raised exception) as value
+        """
+        if not formats_by_figure_key:
+            return {}
+        nr_workers = get_nr_workers(self.nr_workers, nr_jobs=len(formats_by_figure_key))
+        logger.info(f'Rendering {len(formats_by_figure_key)} figures using {nr_workers} worker processes')
+        result = {}
+        with ProcessPoolExecutor(max_workers=nr_workers,
+                                 initializer=_initialize_worker,
+                                 initargs=(worker_config, load_kwargs)) as executor:
+            futures = {executor.submit(_render_figure, figure_key, save_as_format): figure_key
+                       for figure_key, save_as_format in formats_by_figure_key.items()}
+            try:
+                for i, future in enumerate(as_completed(futures)):
+                    figure_key = futures[future]
+                    try:
+                        result[figure_key] = future.result()
+                    except Exception as e:
+                        logger.error(f'Could not render figure {figure_key}: {e}')
+                        result[figure_key] = e
+                    report(job, f'Rendered {figure_key}', i + 1, len(futures))
+            except Exception:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+        return result
@@ -1,27 +1,84 @@
-
 import yaml
 from yaml.loader import SafeLoader
+import atexit
+import copy
+import logging
+import os
 import pathlib
 import json
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    YamlLoader = SafeLoader
+
+DEFAULTS_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent, 'defaults')
+
+# Process-wide caches validated by mtime: path -> (mtime_ns, value)
+_default_users_cache = {}
+_defaults_cache = {}
+_default_user_cache = {}
+
+
+def _get_mtime(path):
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
 
 
 def get_default_users():
-    users = []
-    directory = pathlib.Path(pathlib.Path(__file__).parent, 'defaults')
-    if not directory.exists():
+    directory = DEFAULTS_DIRECTORY
+    mtime = _get_mtime(directory)
+    if mtime is None:
         return []
+    cached = _default_users_cache.get(directory)
+    if cached and cached[0] == mtime:
+        return list(cached[1])
+    users = []
     for path in directory.iterdir():
         if path.suffix != '.yaml':
             continue
         users.append(path.stem)
-    return sorted(users)
+    users = sorted(users)
+    _default_users_cache[directory] = (mtime, users)
+    return list(users)
 
 
 def get_default_user_file_path(user):
     users = get_default_users()
     if user not in users:
         return False
-    return pathlib.Path(pathlib.Path(__file__).parent, 'defaults', f'{user}.yaml')
+    return pathlib.Path(DEFAULTS_DIRECTORY, f'{user}.yaml')
+
+
+def load_defaults(file_path):
+    """
+    Returns the content of a defaults yaml file. The parsed content is cached and only read again
+    when the file mtime has changed. A copy is returned, so the caller may change it.
+    :param file_path:
+    :return: dict
+    """
+    file_path = pathlib.Path(file_path)
+    mtime = _get_mtime(file_path)
+    if mtime is None:
+        _defaults_cache.pop(file_path, None)
+        return {}
+    cached = _defaults_cache.get(file_path)
+    if cached and cached[0] == mtime:
+        return copy.deepcopy(cached[1])
+    with open(file_path) as fid:
+        data = yaml.load(fid, Loader=YamlLoader) or {}
+    _defaults_cache[file_path] = (mtime, data)
+    return copy.deepcopy(data)
 
 
 class Defaults:
@@ -47,62 +104,312 @@ class Defaults:
 
     def _load(self):
         """
-        Loads dict from json
+        Loads dict from yaml (cached)
         :return:
         """
-        if self.file_path and self.file_path.exists():
-            with open(self.file_path) as fid:
-                self.data = yaml.load(fid, Loader=SafeLoader)
+        if self.file_path:
+            self.data = load_defaults(self.file_path)
 
     def get(self, key, default=None):
         return self.data.get(key, default)
 
     def _save_default_user(self, user):
-        if not user:
+        if not user or user == self._load_default_user():
             return
         with open(self._default_user_path, 'w') as fid:
             fid.write(user)
 
     def _load_default_user(self):
-        if not self._default_user_path.exists():
+        mtime = _get_mtime(self._default_user_path)
+        if mtime is None:
             return
+        cached = _default_user_cache.get(self._default_user_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
         with open(self._default_user_path) as fid:
-            return fid.read().strip()
+            user = fid.read().strip()
+        _default_user_cache[self._default_user_path] = (mtime, user)
+        return user
+
+
+# Changes are written to disk this many seconds after the latest Saves.set
+FLUSH_DELAY = 1.0
+LOCK_TIMEOUT = 5
+# A lock file older than this (seconds) is left from a crashed process and is removed
+STALE_LOCK_AGE = 30
+
+# "json" or "sqlite"
+SAVES_BACKEND = 'json'
+
+
+class FileLock:
+    """
+    Lock shared between processes: a lock file created with O_EXCL.
+    """
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = pathlib.Path(path)
+        self.timeout = timeout
+
+    def __enter__(self):
+        t0 = time.monotonic()
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - self.path.stat().st_mtime > STALE_LOCK_AGE:
+                        self.path.unlink(missing_ok=True)
+                        continue
+                except OSError:
+                    continue
+            if time.monotonic() - t0 > self.timeout:
+                raise TimeoutError(f'Could not lock {self.path}')
+            time.sleep(0.05)
+
+    def __exit__(self, *args):
+        self.path.unlink(missing_ok=True)
+
+
+class JsonBackend:
+    """
+    Stores all settings in one json file. Writes merge the changes into what is on disk
+    (under a lock file) and replace the file atomically.
+    """
+    def __init__(self, file_path):
+        self.file_path = pathlib.Path(file_path)
+        self._lock = FileLock(self.file_path.with_name(self.file_path.name + '.lock'))
+
+    def get_version(self):
+        try:
+            stat = self.file_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self):
+        if not self.file_path.exists():
+            return {}
+        try:
+            with open(self.file_path) as fid:
+                return json.load(fid)
+        except ValueError as e:
+            logger.warning(f'Could not read {self.file_path}: {e}')
+            return {}
+
+    def write(self, changes):
+        """
+        :param changes: dict with the keys to update
+        :return: all data in the file after the update
+        """
+        with self._lock:
+            data = self.read()
+            data.update(changes)
+            fd, tmp_path = tempfile.mkstemp(dir=self.file_path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as fid:
+                    json.dump(data, fid, indent=4, sort_keys=True)
+                os.replace(tmp_path, self.file_path)
+            except Exception:
+                pathlib.Path(tmp_path).unlink(missing_ok=True)
+                raise
+        return data
+
+
+class SqliteBackend:
+    """
+    Stores the settings in a SQLite database, one row per key. SQLite handles access from several processes.
+    Settings in an existing json file are imported when the database is created.
+    """
+    def __init__(self, file_path, import_path=None):
+        self.file_path = pathlib.Path(file_path)
+        is_new = not self.file_path.exists()
+        self._connection = sqlite3.connect(str(self.file_path), timeout=LOCK_TIMEOUT, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+        if is_new and import_path and pathlib.Path(import_path).exists():
+            self.write(JsonBackend(import_path).read())
+
+    def get_version(self):
+        # data_version changes when another connection has changed the database
+        with self._lock:
+            return self._connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def read(self):
+        with self._lock:
+            rows = self._connection.execute('SELECT key, value FROM settings').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def write(self, changes):
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                                         [(key, json.dumps(value)) for key, value in changes.items()])
+        return self.read()
+
+
+class SettingsStore:
+    """
+    In-memory cache of the settings in a backend. set() only updates memory. Changes are written
+    (write-behind) in a background thread FLUSH_DELAY seconds after the latest set, at flush() and at exit.
+    The backend is read again when it has been changed by another process.
+    """
+    def __init__(self, backend, flush_delay=FLUSH_DELAY):
+        self.backend = backend
+        self.flush_delay = flush_delay
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._dirty = {}
+        # Changes being written by flush
+        self._writing = {}
+        self._timer = None
+        self._version = backend.get_version()
+        self.data = backend.read()
+        # key -> number of times the value has changed
+        self._key_versions = {}
+
+    def refresh(self):
+        """
+        Reads the backend if it has been changed since the latest read or write. Changes not yet written are kept.
+        """
+        with self._lock:
+            version = self.backend.get_version()
+            if version == self._version:
+                return
+            self._set_data({**self.backend.read(), **self._writing, **self._dirty})
+            self._version = version
+
+    def _set_data(self, data):
+        for key in set(data) | set(self.data):
+            if data.get(key) != self.data.get(key):
+                self._key_versions[key] = self._key_versions.get(key, 0) + 1
+        self.data = data
+
+    def get(self, key, default=None):
+        self.refresh()
+        return self.data.get(key, default)
+
+    def get_version(self, key):
+        """
+        :param key:
+        :return: A number that changes every time the value of key changes
+        """
+        self.refresh()
+        return self._key_versions.get(key, 0)
+
+    def set(self, key, value):
+        with self._lock:
+            if self.data.get(key) != value:
+                self._key_versions[key] = self._key_versions.get(key, 0) + 1
+            self.data[key] = value
+            self._dirty[key] = value
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Writes changes not yet written to the backend. The backend is written without holding the lock,
+        so get and set from other threads are not blocked by the file I/O. _write_lock keeps the writes in order.
+        :return:
+        """
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                changes = self._dirty
+                self._writing = changes
+                self._dirty = {}
+            try:
+                data = self.backend.write(changes)
+                version = self.backend.get_version()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f'Could not write settings: {e}')
+                with self._lock:
+                    self._dirty = {**changes, **self._dirty}
+                    self._writing = {}
+                return
+            with self._lock:
+                # Keys set while writing are still dirty and win over the written data
+                self._set_data({**data, **self._dirty})
+                self._version = version
+                self._writing = {}
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_settings_store(file_path, backend=None):
+    """
+    Returns the store for file_path. One store is shared by all Saves in the process.
+    :param file_path: path to the json file. The sqlite backend uses the same path with suffix .sqlite
+    :param backend: "json" or "sqlite". Defaults to SAVES_BACKEND
+    :return:
+    """
+    backend = backend or SAVES_BACKEND
+    file_path = pathlib.Path(file_path)
+    with _stores_lock:
+        key = (str(file_path), backend)
+        if key not in _stores:
+            if backend == 'sqlite':
+                store_backend = SqliteBackend(file_path.with_suffix('.sqlite'), import_path=file_path)
+            else:
+                store_backend = JsonBackend(file_path)
+            _stores[key] = SettingsStore(store_backend)
+        return _stores[key]
+
+
+def flush_all():
+    for store in list(_stores.values()):
+        store.flush()
+
+
+atexit.register(flush_all)
 
 
 class Saves:
 
-    def __init__(self):
+    def __init__(self, backend=None):
         self.file_path = pathlib.Path(pathlib.Path(__file__).parent, 'saves.json')
+        self._store = get_settings_store(self.file_path, backend=backend)
 
-        self.data = {}
-
-        self._load()
+    @property
+    def data(self):
+        return self._store.data
 
     def _load(self):
         """
-        Loads dict from json
+        Reloads if the file has been changed by another process
         :return:
         """
-        if self.file_path.exists():
-            with open(self.file_path) as fid:
-                self.data = json.load(fid)
+        self._store.refresh()
 
     def _save(self):
         """
-        Writes information to json file.
+        Writes changes to file now instead of in the background.
         :return:
         """
-        with open(self.file_path, 'w') as fid:
-            json.dump(self.data, fid, indent=4, sort_keys=True)
+        self._store.flush()
 
-    def set(self, user, key, value):
-        self._load()
-        self.data[self._get_key(user, key)] = value
+    def flush(self):
         self._save()
 
+    def set(self, user, key, value):
+        self._store.set(self._get_key(user, key), value)
+
     def get(self, user, key, default=''):
-        return self.data.get(self._get_key(user, key), default)
+        return self._store.get(self._get_key(user, key), default)
+
+    def get_version(self, user, key):
+        return self._store.get_version(self._get_key(user, key))
 
     @staticmethod
     def _get_key(user, key):
@@ -110,33 +417,66 @@ class Saves:
 
 
 class SaveComponents:
+    """
+    Stores the values of components per user. Remembers, per user, the stored version and the value of every
+    component at the latest load or save, so that load only sets components whose stored value has changed
+    and save only writes components that have been changed. Load always sets the components when they show the
+    values of another user.
+    """
 
     def __init__(self, key):
         self._saves = Saves()
         self._defaults = {}
         self._saves_id_key = key
         self._components_to_store = set()
+        # user -> dict(version=stored version, values={component id: value})
+        self._synced = {}
+        # The user whose values the components show
+        self._user = None
 
     def add_components(self, *args):
         for comp in args:
             self._components_to_store.add(comp)
 
+    @staticmethod
+    def _get_value(comp):
+        value = comp.get()
+        if value is None:
+            pass
+        elif type(value) != bool:
+            value = str(value)
+        return value
+
+    def _get_synced(self, user):
+        return self._synced.setdefault(user, dict(version=None, values={}))
+
     def save(self, user='default'):
-        data = {}
+        synced = self._get_synced(user)
+        changed = {}
         for comp in self._components_to_store:
             try:
-                value = comp.get()
-                if value is None:
-                    pass
-                elif type(value) != bool:
-                    value = str(value)
-                data[comp._id] = value
+                value = self._get_value(comp)
             except:
-                pass
+                continue
+            if comp._id in synced['values'] and synced['values'][comp._id] == value:
+                continue
+            changed[comp._id] = value
+        self._user = user
+        if not changed:
+            return
+        data = dict(self._saves.get(user, self._saves_id_key) or {})
+        data.update(changed)
         self._saves.set(user, self._saves_id_key, data)
+        synced['values'].update(changed)
+        synced['version'] = self._saves.get_version(user, self._saves_id_key)
 
     def load(self, component=False, user='default'):
-        data = self._saves.get(user, self._saves_id_key)
+        synced = self._get_synced(user)
+        version = self._saves.get_version(user, self._saves_id_key)
+        if not component and user == self._user and version == synced['version']:
+            # The components show the values of user and nothing stored has changed since the latest load or save
+            return
+        data = self._saves.get(user, self._saves_id_key) or {}
         components = self._components_to_store
         if component:
             components = [component]
@@ -147,7 +487,11 @@ class SaveComponents:
                     item = data.get(comp._id, None)
                 if item is None:
                     continue
-                comp.set(item)
+                if self._get_value(comp) != item:
+                    comp.set(item)
+                synced['values'][comp._id] = item
             except:
                 pass
-
+        if not component:
+            synced['version'] = version
+            self._user = user
@@ -0,0 +1,700 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+import pathlib
+
+from .render import RenderSession, ParallelRenderer, get_file_formats
+from .figure_cache import FigureCache, get_data_fingerprint, get_path_signature, get_period_signature, \
+    get_settings_content, get_settings_fingerprint, get_figure_stations, get_station_column, \
+    EXPORT_DIRECTORY_ATTRIBUTES, FIGURE_SETTINGS_ATTRIBUTES, STATION_COLUMNS
+from .jobs import report
+from .archive_index import ArchiveIndex
+from .ctd_staging import CTDStaging
+from .lims import LimsFilter
+from .statistics_store import StatisticsStore, STATISTIC_HANDLER_ATTRIBUTE
+from .data_cache import DataCache, DataCacheError
+from .compact import compact_data, compact_frame, get_memory_report
+from .timing import StageTimer, import_module
+
+
+logger = logging.getLogger(__name__)
+
+# Attribute on algaware.core.Session holding the loaded data
+DATA_HANDLER_ATTRIBUTE = 'data_handler'
+
+
+class DataNotLoaded(Exception):
+    pass
+
+
+class AlgawareSession:
+    """
+    Wrapper around algaware.core.Session holding the arguments used for the latest load.
+    Has no tkinter dependencies so that it can be created in worker processes.
+
+    If incremental, stages in load_data whose input has not changed since the previous load are skipped:
+    the statistics are only rebuilt when the year changes and nothing is reloaded if period and sources
+    are the same as before.
+
+    If a data_cache (see data_cache.DataCache) is given the loaded data is stored on disk and
+    read from there the next time the same period is loaded from unchanged sources.
+
+    If use_archive_index, changes in the archive root directory are found through an archive_index.ArchiveIndex
+    (stored in archive_index_directory) instead of walking the archive. Only the datasets of the period are visited.
+
+    If a ctd_staging (see ctd_staging.CTDStaging) is given the CTD files for the period are copied
+    to a local directory before they are handed to algaware.
+
+    If a lims_filter (see lims.LimsFilter) is given only the rows of the LIMS export within the period
+    are handed to algaware.
+
+    If a statistics_store (see statistics_store.StatisticsStore) is given the statistics for a year
+    are read from there instead of being computed.
+
+    If compact_data the loaded tables are made smaller (categorical text columns and downcast numbers,
+    see compact.compact_frame).
+
+    If a shared_data_cache (see data_cache.SharedDataCache) is given the loaded data is shared in memory
+    with other sessions in the process that load the same period from the same sources.
+
+    If render_in_subprocess figures are never drawn in this process but in worker processes
+    (see render.ParallelRenderer). Used in the GUI process, where pyplot uses the backend of the host application
+    and switching it (see render.use_non_interactive_backend) would close the figures of other plugins.
+
+    Time and memory for every stage is recorded by timer (see timing.StageTimer).
+
+    data_loaded is False until a load has finished. A load that is cancelled or fails may leave the period,
+    year or statistics of the new load next to the data of the previous one, so plotting is refused
+    until a load succeeds.
+    """
+    def __init__(self, figure_cache=None, data_cache=None, incremental=True, use_archive_index=True,
+                 ctd_staging=None, lims_filter=None, statistics_store=None, timer=None, shared_data_cache=None,
+                 compact_data=False, archive_index_directory=None, render_in_subprocess=False):
+        self.timer = timer or StageTimer()
+        algaware = import_module('algaware')
+        self.algaware_version = getattr(algaware, '__version__', '')
+        self.alg_session = algaware.core.Session()
+        self.render_session = RenderSession(self.alg_session, timer=self.timer)
+        self.figure_cache = figure_cache
+        self.data_cache = data_cache
+        self.shared_data_cache = shared_data_cache
+        self._shared_data_key = None
+        self.compact_data = compact_data
+        self._xlist = None
+        self.ctd_staging = ctd_staging
+        self.lims_filter = lims_filter
+        self.statistics_store = statistics_store
+        self.incremental = incremental
+        self.use_archive_index = use_archive_index
+        self.archive_index_directory = archive_index_directory
+        self.render_in_subprocess = render_in_subprocess
+        self._archive_indexes = {}
+        self._data_fingerprints = {}
+        self._settings_content = {}
+        self._station_column_warned = False
+        self.load_kwargs = {}
+        self._loaded_state = {}
+        self.data_loaded = False
+
+    def load_data(self, update_kwargs,
+                  ctd_directory=None,
+                  lims_path=None,
+                  archive_root_dir=None,
+                  stations=None,
+                  job=None,
+                  force=False):
+        """
+        :param update_kwargs:
+        :param ctd_directory:
+        :param lims_path:
+        :param archive_root_dir:
+        :param stations: Only the rows of the LIMS export for these stations are loaded (needs a lims_filter)
+        :param job: jobs.Job used to report progress and check for cancel between stages
+        :param force: Run all stages even if incremental
+        :return:
+        """
+        load_kwargs = dict(update_kwargs=dict(update_kwargs),
+                           ctd_directory=ctd_directory,
+                           lims_path=lims_path,
+                           archive_root_dir=archive_root_dir,
+                           stations=sorted(stations) if stations else None)
+        self.timer.start_run('load')
+        self.data_loaded = False
+        self._data_fingerprints = {}
+        self._settings_content = {}
+        try:
+            with self.timer.stage('total'):
+                self._load_data(load_kwargs, job=job, force=force)
+            self.data_loaded = True
+        except Exception:
+            # Nothing from this load can be trusted. The next load runs all stages.
+            self._loaded_state = {}
+            raise
+        finally:
+            self.timer.flush()
+
+    def _load_data(self, load_kwargs, job=None, force=False):
+        update_kwargs = load_kwargs['update_kwargs']
+        ctd_directory = load_kwargs['ctd_directory']
+        lims_path = load_kwargs['lims_path']
+        archive_root_dir = load_kwargs['archive_root_dir']
+        timer = self.timer
+        incremental = self.incremental and not force
+        previous_state = self._loaded_state if incremental else {}
+        nr_steps = 5
+        report(job, 'Updating attributes', 1, nr_steps)
+        with timer.stage('update_attributes'):
+            self.alg_session.update_attributes(**update_kwargs)
+        with timer.stage('source_signatures'):
+            state = self._get_load_state(load_kwargs)
+        if state == previous_state:
+            logger.info('Data for the period is already loaded')
+            report(job, 'Data already loaded', nr_steps, nr_steps)
+            return
+
+        self._loaded_state = {}
+        self.load_kwargs = load_kwargs
+        self._xlist = None
+        if state['year'] != previous_state.get('year'):
+            report(job, 'Updating year', 2, nr_steps)
+            with timer.stage('update_year'):
+                self.alg_session.update_year(state['year'])
+            report(job, 'Initializing statistics', 3, nr_steps)
+            with timer.stage('statistic_handler'):
+                self._initialize_statistic_handler(state['year'])
+        else:
+            logger.debug('Statistics for the year is already loaded')
+        self._release_shared_data()
+        shared_data_key = self._get_shared_data_key(state)
+        with timer.stage('shared_data_read'):
+            loaded_from_cache = self._load_shared_data(shared_data_key)
+        data_cache_key = self._get_data_cache_key(state)
+        if not loaded_from_cache:
+            with timer.stage('data_cache_read'):
+                loaded_from_cache = self._load_data_from_cache(data_cache_key)
+            if loaded_from_cache:
+                self._put_shared_data(shared_data_key)
+        if not loaded_from_cache:
+            if ctd_directory and self.ctd_staging is not None:
+                report(job, 'Copying CTD files', 4, nr_steps)
+                with timer.stage('ctd_staging'):
+                    ctd_directory = str(self.ctd_staging.stage(ctd_directory, *self._get_period(load_kwargs),
+                                                               job=job))
+            if lims_path and self.lims_filter is not None:
+                report(job, 'Filtering LIMS export', 4, nr_steps)
+                with timer.stage('lims_filter'):
+                    lims_path = str(self.lims_filter.get_filtered_path(lims_path, *self._get_period(load_kwargs),
+                                                                       stations=load_kwargs['stations']))
+            elif lims_path and load_kwargs['stations']:
+                logger.warning('Stations are ignored: LIMS rows are only filtered on station with a lims_filter')
+            report(job, 'Initializing data handler', 4, nr_steps)
+            with timer.stage('data_handler'):
+                self.alg_session.initialize_data_handler(ctd_directory=ctd_directory,
+                                                         lims_path=lims_path,
+                                                         archive_root_dir=archive_root_dir)
+            report(job, 'Loading data', 5, nr_steps)
+            with timer.stage('load'):
+                self.alg_session.load_data()
+            if self.compact_data:
+                with timer.stage('compact'):
+                    self._compact_loaded_data()
+            with timer.stage('data_cache_write'):
+                self._save_data_to_cache(data_cache_key)
+            self._put_shared_data(shared_data_key)
+        self._loaded_state = state
+        self.render_session.reset()
+
+    def _initialize_statistic_handler(self, year):
+        if self.statistics_store is None:
+            self.alg_session.initialize_statistic_handler()
+            return
+        statistic_handler = self.statistics_store.get(year)
+        if statistic_handler is not None:
+            setattr(self.alg_session, STATISTIC_HANDLER_ATTRIBUTE, statistic_handler)
+            logger.info(f'Statistics for {year} read from store')
+            return
+        self.alg_session.initialize_statistic_handler()
+        statistic_handler = getattr(self.alg_session, STATISTIC_HANDLER_ATTRIBUTE, None)
+        if statistic_handler is None:
+            self._disable_statistics_store(f'algaware.core.Session has no attribute {STATISTIC_HANDLER_ATTRIBUTE}')
+            return
+        self.statistics_store.put(year, statistic_handler)
+
+    def _get_shared_data_key(self, state):
+        if self.shared_data_cache is None:
+            return None
+        return DataCache.get_key(self.load_kwargs,
+                                 source_signatures=state['sources'],
+                                 algaware_version=self.algaware_version,
+                                 stations=state['stations'],
+                                 compact_data=self.compact_data)
+
+    def _load_shared_data(self, key):
+        """
+        :param key:
+        :return: True if data was taken from the shared data cache
+        """
+        if not key:
+            return False
+        data_handler = self.shared_data_cache.acquire(key)
+        if data_handler is None:
+            return False
+        self._shared_data_key = key
+        setattr(self.alg_session, DATA_HANDLER_ATTRIBUTE, data_handler)
+        logger.info('Data taken from the shared data cache')
+        return True
+
+    def _put_shared_data(self, key):
+        if not key:
+            return
+        data_handler = getattr(self.alg_session, DATA_HANDLER_ATTRIBUTE, None)
+        if data_handler is None:
+            logger.warning(f'Shared data cache disabled: algaware.core.Session has no {DATA_HANDLER_ATTRIBUTE}')
+            self.shared_data_cache = None
+            return
+        self.shared_data_cache.put(key, data_handler)
+        self._shared_data_key = key
+
+    def _release_shared_data(self):
+        if self._shared_data_key is None:
+            return
+        self.shared_data_cache.release(self._shared_data_key)
+        self._shared_data_key = None
+
+    def _get_data_cache_key(self, state):
+        if self.data_cache is None:
+            return None
+        return self.data_cache.get_key(self.load_kwargs,
+                                       source_signatures=state['sources'],
+                                       algaware_version=self.algaware_version,
+                                       stations=state['stations'],
+                                       compact_data=self.compact_data)
+
+    def _load_data_from_cache(self, key):
+        """
+        :param key:
+        :return: True if data was loaded from cache
+        """
+        if not key:
+            return False
+        data_handler = self.data_cache.get(key)
+        if data_handler is None:
+            return False
+        setattr(self.alg_session, DATA_HANDLER_ATTRIBUTE, data_handler)
+        logger.info('Data loaded from cache')
+        return True
+
+    def _save_data_to_cache(self, key):
+        if not key:
+            return
+        data_handler = getattr(self.alg_session, DATA_HANDLER_ATTRIBUTE, None)
+        if data_handler is None:
+            self._disable_data_cache(f'algaware.core.Session has no {DATA_HANDLER_ATTRIBUTE}')
+            return
+        try:
+            self.data_cache.put(key, data_handler)
+        except DataCacheError as e:
+            self._disable_data_cache(e)
+
+    def _disable_figure_cache(self, reason):
+        """
+        The figure cache is turned off for this session when figures can not be told apart,
+        so that the warning is given once instead of on every plot.
+        """
+        logger.warning(f'Figure cache disabled: {reason}')
+        self.figure_cache = None
+
+    def _disable_statistics_store(self, reason):
+        """
+        The statistics store is turned off for this session when the statistics can not be found on the session,
+        so that the warning is given once instead of on every new year.
+        """
+        logger.warning(f'Statistics store disabled: {reason}')
+        self.statistics_store = None
+
+    def _disable_data_cache(self, reason):
+        """
+        The data cache is turned off for this session when the loaded data can not be cached,
+        so that the warning is given once instead of on every load.
+        """
+        logger.warning(f'Data cache disabled: {reason}')
+        self.data_cache = None
+
+    def get_archive_index(self, archive_root_dir, start_date=None, end_date=None):
+        """
+        :param archive_root_dir:
+        :param start_date: Only the datasets with data for the period are updated (see ArchiveIndex.update)
+        :param end_date:
+        :return: Updated archive_index.ArchiveIndex for the given archive root directory
+        """
+        archive_root_dir = str(archive_root_dir)
+        if archive_root_dir not in self._archive_indexes:
+            self._archive_indexes[archive_root_dir] = ArchiveIndex(archive_root_dir,
+                                                                   index_directory=self.archive_index_directory)
+        index = self._archive_indexes[archive_root_dir]
+        index.update(start_date=start_date, end_date=end_date)
+        return index
+
+    def rebuild_archive_index(self, archive_root_dir):
+        """
+        :param archive_root_dir:
+        :return: number of files in the index
+        """
+        index = ArchiveIndex(archive_root_dir, index_directory=self.archive_index_directory)
+        index.rebuild()
+        self._archive_indexes[str(archive_root_dir)] = index
+        return index.nr_files
+
+    def _get_archive_signature(self, load_kwargs):
+        archive_root_dir = load_kwargs.get('archive_root_dir')
+        if not archive_root_dir or not self.use_archive_index:
+            return get_path_signature(archive_root_dir)
+        start_date, end_date = self._get_period(load_kwargs)
+        index = self.get_archive_index(archive_root_dir, start_date=start_date, end_date=end_date)
+        return [str(archive_root_dir), index.get_signature(start_date=start_date, end_date=end_date)]
+
+    @staticmethod
+    def _get_period(load_kwargs):
+        """
+        :return: tuple (start_date, end_date) in format YYYY-MM-DD of the period in load_kwargs
+        """
+        update_kwargs = load_kwargs['update_kwargs']
+        return str(update_kwargs['start_time'])[:10], str(update_kwargs['end_time'])[:10]
+
+    def _get_load_state(self, load_kwargs):
+        """
+        Returns what the loaded data depends on. Called after update_attributes.
+        :param load_kwargs:
+        :return:
+        """
+        sources = {key: get_path_signature(load_kwargs.get(key))
+                   for key in ['ctd_directory', 'lims_path']}
+        sources['archive_root_dir'] = self._get_archive_signature(load_kwargs)
+        return dict(year=self.alg_session.start_time.year,
+                    update_kwargs=load_kwargs['update_kwargs'],
+                    stations=load_kwargs['stations'],
+                    sources=sources,
+                    compact_data=self.compact_data)
+
+    def _compact_loaded_data(self):
+        data_handler = getattr(self.alg_session, DATA_HANDLER_ATTRIBUTE, None)
+        if data_handler is None:
+            return
+        result = compact_data(data_handler, name=DATA_HANDLER_ATTRIBUTE)
+        before = sum(value[0] for value in result.values())
+        after = sum(value[1] for value in result.values())
+        logger.info(f'Compacted {len(result)} tables from {before / 1024 / 1024:.1f} MB '
+                    f'to {after / 1024 / 1024:.1f} MB')
+
+    def get_data_xlist(self):
+        """
+        The list is made once per load. It is shared by all callers and must not be changed.
+        :return:
+        """
+        if self._xlist is None:
+            xlist = self.alg_session.get_xlist()
+            if self.compact_data and xlist is not None:
+                compact_frame(xlist, downcast_floats=False)
+            self._xlist = xlist
+        return self._xlist
+
+    def get_memory_report(self):
+        """
+        :return: list of dicts (table, column, dtype, bytes) for the loaded tables (see compact.get_memory_report)
+        """
+        rows = []
+        data_handler = getattr(self.alg_session, DATA_HANDLER_ATTRIBUTE, None)
+        if data_handler is not None:
+            rows.extend(get_memory_report(data_handler, name=DATA_HANDLER_ATTRIBUTE))
+        if self._xlist is not None:
+            rows.extend(get_memory_report(self._xlist, name='xlist'))
+        return rows
+
+    def _get_settings_content(self, figure_key):
+        if figure_key not in self._settings_content:
+            self.render_session.apply_figure_settings(figure_key)
+            self._settings_content[figure_key] = get_settings_content(self.alg_session)
+            if not self._settings_content[figure_key] and self.figure_cache is not None:
+                # A change in the settings would not be seen, so cached figures could be out of date
+                self._disable_figure_cache(f'algaware.core.Session and its figure handler have none of the '
+                                           f'attributes {FIGURE_SETTINGS_ATTRIBUTES}')
+        return self._settings_content[figure_key]
+
+    def get_figure_settings(self, figure_key):
+        """
+        Returns what, apart from the data, decides how the figure for figure_key looks:
+        the content of the figure settings applied for figure_key (see figure_cache.get_settings_content).
+        :param figure_key:
+        :return:
+        """
+        settings_fingerprint = get_settings_fingerprint(self._get_settings_content(figure_key))
+        return [figure_key, self.algaware_version, settings_fingerprint]
+
+    def get_data_fingerprint(self, figure_key):
+        """
+        Returns a fingerprint of the data shown in the figure for figure_key. Only the rows of the xlist
+        and the archive files for the stations named in the figure settings are used, so a change for
+        another area does not invalidate the cached figure. All loaded data is used if no station is found.
+        :param figure_key:
+        :return:
+        """
+        if figure_key not in self._data_fingerprints:
+            with self.timer.stage('data_fingerprint', figure_key=figure_key):
+                xlist = self.get_data_xlist()
+                if xlist is not None and get_station_column(xlist) is None and not self._station_column_warned:
+                    logger.warning(f'The xlist has none of the columns {STATION_COLUMNS}. All loaded data is used '
+                                   f'in the data fingerprint of every figure.')
+                    self._station_column_warned = True
+                station_column, stations = get_figure_stations(xlist, self._get_settings_content(figure_key))
+                sources = self._get_figure_sources(stations) if stations else None
+                self._data_fingerprints[figure_key] = get_data_fingerprint(xlist, self.load_kwargs,
+                                                                           sources=sources,
+                                                                           station_column=station_column,
+                                                                           stations=stations)
+        return self._data_fingerprints[figure_key]
+
+    def _get_figure_sources(self, stations):
+        """
+        :param stations:
+        :return: Signatures of the sources limited to the period and, for the archive, to the given stations
+        """
+        start_date, end_date = self._get_period(self.load_kwargs)
+        archive_root_dir = self.load_kwargs.get('archive_root_dir')
+        if archive_root_dir and self.use_archive_index:
+            index = self.get_archive_index(archive_root_dir, start_date=start_date, end_date=end_date)
+            archive_signature = [str(archive_root_dir),
+                                 index.get_signature(start_date=start_date, end_date=end_date, stations=stations)]
+        else:
+            archive_signature = self._loaded_state['sources']['archive_root_dir']
+        return [get_period_signature(self.load_kwargs.get('ctd_directory'), start_date, end_date),
+                get_path_signature(self.load_kwargs.get('lims_path')),
+                archive_signature]
+
+    def _restore_from_cache(self, figure_key, file_formats):
+        """
+        Copies cached figures to the export directory.
+        :param figure_key:
+        :param file_formats:
+        :return: list of formats not found in cache
+        """
+        if self.figure_cache is None or not file_formats:
+            return file_formats
+        export_directory = self.render_session.private_export_directory.get_export_directory()
+        if not export_directory:
+            self._disable_figure_cache(f'algaware.core.Session has none of the attributes '
+                                       f'{EXPORT_DIRECTORY_ATTRIBUTES}')
+            return file_formats
+        data_fingerprint = self.get_data_fingerprint(figure_key)
+        figure_settings = self.get_figure_settings(figure_key)
+        if self.figure_cache is None:
+            return file_formats
+        remaining = []
+        for fmt in file_formats:
+            key = self.figure_cache.get_key(data_fingerprint, figure_settings, fmt)
+            if self.figure_cache.get(key, export_directory) is None:
+                remaining.append(fmt)
+        return remaining
+
+    def _add_to_cache(self, figure_key, paths_by_format):
+        if self.figure_cache is None or not paths_by_format:
+            return
+        data_fingerprint = self.get_data_fingerprint(figure_key)
+        figure_settings = self.get_figure_settings(figure_key)
+        if self.figure_cache is None:
+            return
+        for fmt, paths in paths_by_format.items():
+            key = self.figure_cache.get_key(data_fingerprint, figure_settings, fmt)
+            self.figure_cache.put(key, paths)
+
+    def render(self, figure_key, file_formats):
+        """
+        Draws the figure once and saves it in all file_formats.
+        :param figure_key:
+        :param file_formats: list of formats
+        :return: dict with format as key and list of saved paths as value. Empty if the export directory is unknown.
+                 Files are saved in a private directory (see figure_cache.PrivateExportDirectory), so only
+                 files saved by this render are returned.
+        """
+        with self.timer.stage('render', figure_key=figure_key, formats=file_formats):
+            if self.render_in_subprocess:
+                return self._render_in_subprocess(figure_key, file_formats)
+            return self._render(figure_key, file_formats)
+
+    def _render_in_subprocess(self, figure_key, file_formats):
+        renderer = ParallelRenderer(nr_workers=1)
+        paths_by_format = renderer.plot(self.get_worker_config(), self.load_kwargs, {figure_key: file_formats})
+        if isinstance(paths_by_format[figure_key], Exception):
+            raise paths_by_format[figure_key]
+        return paths_by_format[figure_key]
+
+    def _render(self, figure_key, file_formats):
+        saved_paths = self.render_session.render(figure_key, save_as_format=file_formats or None)
+        paths_by_format = {}
+        for path in saved_paths:
+            fmt = path.suffix.lower().lstrip('.')
+            if fmt in file_formats:
+                paths_by_format.setdefault(fmt, []).append(str(path))
+        return paths_by_format
+
+    def _check_data_loaded(self):
+        if not self.data_loaded:
+            raise DataNotLoaded('No data loaded. Load data before plotting.')
+
+    def plot(self, figure_key, save_as_format=None):
+        """
+        The figure is drawn once and saved in all formats, slow formats (eps) last.
+        Formats found in the figure cache are copied from there instead.
+        :param figure_key:
+        :param save_as_format: str or list of formats. "ALL" gives all available formats.
+        :return:
+        """
+        self._check_data_loaded()
+        file_formats = get_file_formats(save_as_format)
+        remaining_formats = self._restore_from_cache(figure_key, file_formats)
+        if remaining_formats or not file_formats:
+            self._add_to_cache(figure_key, self.render(figure_key, remaining_formats))
+
+    def plot_figures(self, figure_keys, save_as_format=None, parallel=False, nr_workers=None, job=None):
+        """
+        Plots all given figure_keys. If parallel each figure_key is rendered in its own worker process.
+        Every worker reads the loaded data from the data cache, so without a data cache the figures are
+        rendered in one process instead of having every worker load all sources again.
+        If render_in_subprocess the figures are always rendered in worker processes (one if not parallel).
+        :param figure_keys:
+        :param save_as_format:
+        :param parallel:
+        :param nr_workers: Number of worker processes. Defaults to the number of cores.
+        :param job: jobs.Job used to report progress and check for cancel between figures
+        :return: dict with figure_key as key and None or the raised exception as value
+        """
+        self._check_data_loaded()
+        figure_keys = list(figure_keys)
+        self.timer.start_run('plot')
+        try:
+            with self.timer.stage('total'):
+                return self._plot_figures(figure_keys, save_as_format=save_as_format, parallel=parallel,
+                                          nr_workers=nr_workers, job=job)
+        finally:
+            self.timer.flush()
+
+    def _plot_figures(self, figure_keys, save_as_format=None, parallel=False, nr_workers=None, job=None):
+        if self.figure_cache is not None:
+            self.figure_cache.reset_stats()
+        parallel = parallel and len(figure_keys) > 1
+        if parallel and self.data_cache is None:
+            logger.warning('Rendering in one process: there is no data cache to load the data from '
+                           'in the worker processes')
+            parallel = False
+        if parallel or self.render_in_subprocess:
+            result = self._plot_in_worker_processes(figure_keys, save_as_format=save_as_format,
+                                                    nr_workers=nr_workers if parallel else 1, job=job)
+        else:
+            result = {}
+            for i, figure_key in enumerate(figure_keys):
+                report(job, f'Plotting {figure_key}', i + 1, len(figure_keys))
+                try:
+                    self.plot(figure_key, save_as_format=save_as_format)
+                    result[figure_key] = None
+                except Exception as e:
+                    logger.error(f'Could not plot figure {figure_key}: {e}')
+                    result[figure_key] = e
+            self.render_session.log_report()
+        if self.figure_cache is not None:
+            self.figure_cache.log_report()
+        return result
+
+    def _plot_in_worker_processes(self, figure_keys, save_as_format=None, nr_workers=None, job=None):
+        result = {}
+        file_formats = get_file_formats(save_as_format)
+        formats_by_figure_key = {}
+        for figure_key in figure_keys:
+            remaining = self._restore_from_cache(figure_key, file_formats)
+            if file_formats and not remaining:
+                result[figure_key] = None
+                continue
+            formats_by_figure_key[figure_key] = remaining
+        renderer = ParallelRenderer(nr_workers=nr_workers)
+        with self.timer.stage('render_parallel', nr_figures=len(formats_by_figure_key)):
+            rendered = renderer.plot(self.get_worker_config(), self.load_kwargs, formats_by_figure_key, job=job)
+        for figure_key, value in rendered.items():
+            if isinstance(value, Exception):
+                result[figure_key] = value
+                continue
+            self._add_to_cache(figure_key, value)
+            result[figure_key] = None
+        return result
+
+    def get_worker_config(self):
+        """
+        Returns the configuration of this session as picklable data, so that a session loading the same data
+        the same way can be created in a worker process (see create_worker_session).
+        The figure cache and the shared data cache are only used by this session and are left out.
+        :return: dict
+        """
+        config = dict(incremental=self.incremental,
+                      use_archive_index=self.use_archive_index,
+                      compact_data=self.compact_data,
+                      archive_index_directory=self.archive_index_directory and str(self.archive_index_directory))
+        config['data_cache'] = None if self.data_cache is None else \
+            dict(directory=str(self.data_cache.directory),
+                 max_size=self.data_cache.max_size)
+        config['ctd_staging'] = None if self.ctd_staging is None else \
+            dict(staging_directory=str(self.ctd_staging.staging_directory),
+                 nr_workers=self.ctd_staging.nr_workers,
+                 max_size=self.ctd_staging.max_size)
+        config['lims_filter'] = None if self.lims_filter is None else \
+            dict(directory=str(self.lims_filter.directory),
+                 sorted_by_date=self.lims_filter.sorted_by_date,
+                 max_nr_files=self.lims_filter.max_nr_files)
+        config['statistics_store'] = None if self.statistics_store is None else \
+            dict(directory=str(self.statistics_store.root_directory),
+                 source_paths=self.statistics_store.source_paths)
+        return config
+
+    def close(self):
+        self._release_shared_data()
+        self.render_session.close()
+
+
+def create_worker_session(config):
+    """
+    Creates a session in a worker process.
+    :param config: see AlgawareSession.get_worker_config
+    :return: AlgawareSession
+    """
+    config = dict(config)
+    for name, cls in [('data_cache', DataCache),
+                      ('ctd_staging', CTDStaging),
+                      ('lims_filter', LimsFilter),
+                      ('statistics_store', StatisticsStore)]:
+        if config.get(name) is not None:
+            config[name] = cls(**config[name])
+    return AlgawareSession(**config)
+
+
+def create_session(cache_directory=None, log_directory=None, shared_data_cache=None, stage_ctd_files=False,
+                   compact_data=False, render_in_subprocess=False):
+    """
+    Creates a session with all caches, as used by the App.
+    :param cache_directory: Directory for all caches. Each cache uses its default directory if not given.
+    :param log_directory: Directory for the timing file (see timing.StageTimer)
+    :param shared_data_cache: data_cache.SharedDataCache
+    :param stage_ctd_files: Copy the CTD files of the period to a local directory (see ctd_staging.CTDStaging)
+    :param compact_data:
+    :param render_in_subprocess: Never draw figures in this process (see AlgawareSession)
+    :return: AlgawareSession
+    """
+    def get_directory(name):
+        return pathlib.Path(cache_directory, name) if cache_directory else None
+
+    return AlgawareSession(figure_cache=FigureCache(directory=get_directory('figures')),
+                           data_cache=DataCache(directory=get_directory('data')),
+                           ctd_staging=CTDStaging(staging_directory=get_directory('ctd')) if stage_ctd_files else None,
+                           lims_filter=LimsFilter(directory=get_directory('lims')),
+                           statistics_store=StatisticsStore(directory=get_directory('statistics')),
+                           timer=StageTimer(log_directory=log_directory),
+                           shared_data_cache=shared_data_cache,
+                           compact_data=compact_data,
+                           archive_index_directory=get_directory('archive_index'),
+                           render_in_subprocess=render_in_subprocess)
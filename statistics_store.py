@@ -0,0 +1,160 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .figure_cache import get_path_signature
+from .render import get_nr_workers
+from .timing import import_module
+
+
+logger = logging.getLogger(__name__)
+
+# Increase when the content of the stored files changes
+STORE_FORMAT_VERSION = 2
+
+DEFAULT_STORE_DIRECTORY = pathlib.Path(pathlib.Path(__file__).parent, 'cache', 'statistics')
+
+# Attribute on algaware.core.Session holding the statistics
+STATISTIC_HANDLER_ATTRIBUTE = 'statistic_handler'
+
+
+def _get_algaware_version():
+    algaware = import_module('algaware')
+    return getattr(algaware, '__version__', '')
+
+
+def _get_default_source_paths():
+    """
+    :return: The algaware package directory, which holds the data files the statistics are computed from
+    """
+    algaware = import_module('algaware')
+    return [pathlib.Path(algaware.__file__).parent]
+
+
+def get_source_key(source_paths):
+    """
+    :param source_paths: files and directories the statistics are computed from
+    :return: short hash of the signatures of source_paths
+    """
+    signatures = [get_path_signature(path) for path in source_paths]
+    return hashlib.md5(json.dumps(signatures).encode()).hexdigest()[:12]
+
+
+class StatisticsStore:
+    """
+    On disk store of the statistics (climatology) used in the figures. One file per year.
+    The reference period of the statistics is decided by algaware. Files are placed in a directory named after
+    STORE_FORMAT_VERSION and the algaware version, so old files are never read after an update.
+    The file names also hold a key of the source files (see get_source_key), so statistics are computed again
+    when the source files change without a new algaware version (e.g. an editable install).
+    """
+    suffix = '.pkl'
+
+    def __init__(self, directory=None, source_paths=None):
+        self.root_directory = pathlib.Path(directory or DEFAULT_STORE_DIRECTORY)
+        self.directory = pathlib.Path(self.root_directory,
+                                      f'v{STORE_FORMAT_VERSION}_{_get_algaware_version() or "unknown"}')
+        self.source_paths = [str(path) for path in source_paths or _get_default_source_paths()]
+        self.source_key = get_source_key(self.source_paths)
+
+    def _get_path(self, year):
+        return pathlib.Path(self.directory, f'{year}_{self.source_key}{self.suffix}')
+
+    def _remove_outdated(self, year):
+        path = self._get_path(year)
+        for outdated_path in self.directory.glob(f'{year}_*{self.suffix}'):
+            if outdated_path == path:
+                continue
+            try:
+                outdated_path.unlink(missing_ok=True)
+            except OSError as e:
+                logger.debug(f'Could not remove outdated statistics {outdated_path}: {e}')
+
+    def has(self, year):
+        return self._get_path(year).exists()
+
+    def get(self, year):
+        """
+        :param year:
+        :return: The stored statistic handler or None if not stored
+        """
+        path = self._get_path(year)
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'rb') as fid:
+                return pickle.load(fid)
+        except Exception as e:
+            logger.warning(f'Could not read stored statistics {path}: {e}')
+            return None
+
+    def put(self, year, statistic_handler):
+        """
+        :param year:
+        :param statistic_handler:
+        :return:
+        """
+        path = self._get_path(year)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fid:
+                pickle.dump(statistic_handler, fid, protocol=5)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f'Could not store statistics for {year}: {e}')
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            return
+        self._remove_outdated(year)
+
+    def build(self, years, nr_workers=None, overwrite=False):
+        """
+        Computes and stores the statistics for the given years. Each year is computed in a worker process.
+        :param years:
+        :param nr_workers: Number of worker processes. Defaults to the number of cores.
+        :param overwrite: Compute also years that are already stored
+        :return: dict with year as key and None or the raised exception as value
+        """
+        years = [int(year) for year in years if overwrite or not self.has(year)]
+        if not years:
+            return {}
+        nr_workers = get_nr_workers(nr_workers, nr_jobs=len(years))
+        logger.info(f'Building statistics for {len(years)} years using {nr_workers} worker processes')
+        result = {}
+        with ProcessPoolExecutor(max_workers=nr_workers) as executor:
+            futures = {executor.submit(_build_year, str(self.root_directory), self.source_paths, year): year
+                       for year in years}
+            for future in as_completed(futures):
+                year = futures[future]
+                try:
+                    future.result()
+                    result[year] = None
+                except Exception as e:
+                    logger.error(f'Could not build statistics for {year}: {e}')
+                    result[year] = e
+        return result
+
+
+def _build_year(directory, source_paths, year):
+    """
+    Computes the statistics for year the same way as AlgawareSession.load_data does for a period in year.
+    """
+    algaware = import_module('algaware')
+    alg_session = algaware.core.Session()
+    alg_session.update_attributes(start_time=f'{year}-01-01', end_time=f'{year}-12-31')
+    alg_session.update_year(year)
+    alg_session.initialize_statistic_handler()
+    statistic_handler = getattr(alg_session, STATISTIC_HANDLER_ATTRIBUTE, None)
+    if statistic_handler is None:
+        raise AttributeError(f'algaware.core.Session has no attribute {STATISTIC_HANDLER_ATTRIBUTE}')
+    store = StatisticsStore(directory=directory, source_paths=source_paths)
+    store.put(year, statistic_handler)
+    return year
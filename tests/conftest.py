@@ -0,0 +1,22 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+The plugin is imported by SHARKtools as plugins.SHARKtools_algaware, and its __init__ needs the main app.
+The modules tested here do not, so they are imported from a package (SHARKtools_algaware) that skips __init__.
+The package is also registered under the name of the plugin directory, which pytest imports when collecting.
+"""
+
+import pathlib
+import sys
+import types
+
+
+PACKAGE_NAME = 'SHARKtools_algaware'
+PACKAGE_DIRECTORY = pathlib.Path(__file__).parent.parent
+
+if PACKAGE_NAME not in sys.modules:
+    package = types.ModuleType(PACKAGE_NAME)
+    package.__path__ = [str(PACKAGE_DIRECTORY)]
+    sys.modules[PACKAGE_NAME] = package
+    sys.modules.setdefault(PACKAGE_DIRECTORY.name, package)
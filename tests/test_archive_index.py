@@ -0,0 +1,72 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import pathlib
+
+import pytest
+
+from SHARKtools_algaware.archive_index import ArchiveIndex, get_file_info, parse_file_date
+from SHARKtools_algaware.benchmarks import synthetic
+
+
+@pytest.fixture
+def sources(tmp_path):
+    return synthetic.generate(pathlib.Path(tmp_path, 'data'), nr_stations=3, nr_years=3, nr_samples_per_year=6,
+                              last_year=2020, nr_ctd_scans=5)
+
+
+@pytest.fixture
+def index(sources, tmp_path):
+    index = ArchiveIndex(sources['archive_root_dir'], index_directory=pathlib.Path(tmp_path, 'index'))
+    index.update()
+    return index
+
+
+def _get_data_file(sources, year):
+    return pathlib.Path(sources['archive_root_dir'], 'physicalchemical', f'SHARK_PhysicalChemical_{year}_BAS_SMHI',
+                        'processed_data', 'data.txt')
+
+
+def test_lookup_period_in_datasets(sources, index):
+    paths = index.lookup(start_date='2020-07-01', end_date='2020-07-31')
+    assert _get_data_file(sources, 2020) in paths
+    assert all('_2020_' in str(path) for path in paths)
+
+
+def test_lookup_station_from_content(sources, index):
+    station = sources['stations'][0]
+    paths = index.lookup(station=station)
+    assert _get_data_file(sources, 2019) in paths
+    assert len(paths) == 2 * len(sources['years'])
+    assert index.lookup(station='NO SUCH STATION') == []
+
+
+def test_ctd_file_info():
+    name = synthetic.get_cnv_file_name(synthetic.datetime.datetime(2020, 7, 14, 12), '0001')
+    assert parse_file_date(name) == '2020-07-14'
+
+
+def test_ctd_station_from_header(sources):
+    path = sorted(pathlib.Path(sources['ctd_directory']).iterdir())[0]
+    start_date, end_date, stations = get_file_info(path)
+    assert start_date == end_date == parse_file_date(path.name)
+    assert stations and stations[0] in sources['stations']
+    assert synthetic.SHIP_CODE not in stations
+
+
+def test_signature_ignores_other_years(sources, index, tmp_path):
+    signature = index.get_signature('2020-07-01', '2020-07-31')
+    path = _get_data_file(sources, 2019)
+    path.write_text(path.read_text() + '\n', encoding='cp1252')
+    index = ArchiveIndex(sources['archive_root_dir'], index_directory=pathlib.Path(tmp_path, 'index'))
+    assert index.update('2020-07-01', '2020-07-31') == 0
+    assert index.get_signature('2020-07-01', '2020-07-31') == signature
+
+
+def test_signature_changes_when_file_of_period_is_edited(sources, index):
+    station = sources['stations'][0]
+    signature = index.get_signature('2020-07-01', '2020-07-31', stations=[station])
+    path = _get_data_file(sources, 2020)
+    path.write_text(path.read_text() + '\n', encoding='cp1252')
+    index.update('2020-07-01', '2020-07-31')
+    assert index.get_signature('2020-07-01', '2020-07-31', stations=[station]) != signature
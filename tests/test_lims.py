@@ -0,0 +1,22 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import pathlib
+
+from SHARKtools_algaware.lims import filter_lims_export
+
+
+def test_short_rows_are_kept(tmp_path):
+    path = pathlib.Path(tmp_path, 'lims.txt')
+    path.write_bytes(b'STATN\tvalue\tSDATE\n'
+                     b'ANHOLT E\t1\t2020-07-02\n'
+                     b'ANHOLT E\t2\t2020-08-02\n'
+                     b'BY31\t3\n'
+                     b'BY31\n')
+    info = {}
+    target_path = filter_lims_export(path, '2020-07-01', '2020-07-31', stations=['BY31', 'ANHOLT E'],
+                                     target_path=pathlib.Path(tmp_path, 'filtered.txt'), info=info)
+    lines = target_path.read_bytes().splitlines()
+    assert lines == [b'STATN\tvalue\tSDATE', b'ANHOLT E\t1\t2020-07-02', b'BY31\t3', b'BY31']
+    assert info['nr_short'] == 2
+    assert info['nr_kept'] == 3
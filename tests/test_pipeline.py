@@ -0,0 +1,85 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import threading
+import time
+
+import pytest
+
+from SHARKtools_algaware.jobs import JobCancelled, report
+from SHARKtools_algaware.pipeline import PeriodPipeline
+
+
+class FakeJob:
+    def __init__(self):
+        self._cancel_event = threading.Event()
+
+    def report(self, stage, step=None, nr_steps=None):
+        pass
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+
+class FakeSession:
+    def __init__(self, nr_load_stages=1, fail_periods=()):
+        self.nr_load_stages = nr_load_stages
+        self.fail_periods = fail_periods
+        self.closed = False
+
+    def load_data(self, update_kwargs, job=None):
+        for i in range(self.nr_load_stages):
+            report(job, f'stage {i}', i + 1, self.nr_load_stages)
+            time.sleep(0.05)
+        if update_kwargs['start_time'] in self.fail_periods:
+            raise ValueError(update_kwargs['start_time'])
+
+    def plot_figures(self, figure_keys, save_as_format=None, job=None):
+        return {figure_key: None for figure_key in figure_keys}
+
+    def close(self):
+        self.closed = True
+
+
+PERIODS = [('2020-01-01', '2020-01-31'), ('2020-02-01', '2020-02-29'), ('2020-03-01', '2020-03-31')]
+
+
+def test_load_errors_are_recorded_per_period():
+    pipeline = PeriodPipeline(lambda: FakeSession(fail_periods=['2020-02-01']))
+    result = pipeline.run(PERIODS, ['A'])
+    assert result[PERIODS[0]] == {'A': None}
+    assert isinstance(result[PERIODS[1]], ValueError)
+    assert result[PERIODS[2]] == {'A': None}
+
+
+def test_create_session_errors_are_recorded_per_period():
+    def create_session():
+        raise OSError('no cache directory')
+
+    result = PeriodPipeline(create_session).run(PERIODS, ['A'])
+    assert list(result) == PERIODS
+    assert all(isinstance(error, OSError) for error in result.values())
+
+
+def test_cancel_stops_the_load_in_progress():
+    sessions = []
+
+    def create_session():
+        sessions.append(FakeSession(nr_load_stages=200))
+        return sessions[-1]
+
+    job = FakeJob()
+    threading.Timer(0.2, job.cancel).start()
+    t0 = time.perf_counter()
+    with pytest.raises(JobCancelled):
+        PeriodPipeline(create_session).run(PERIODS, ['A'], job=job)
+    assert time.perf_counter() - t0 < 2
+    assert all(session.closed for session in sessions)
@@ -0,0 +1,77 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import pathlib
+import threading
+
+from SHARKtools_algaware import saves
+from SHARKtools_algaware.saves import JsonBackend, SettingsStore
+
+
+class SlowBackend(JsonBackend):
+    """
+    Blocks in write until released.
+    """
+    def __init__(self, file_path):
+        super().__init__(file_path)
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, changes):
+        self.writing.set()
+        self.release.wait(5)
+        return super().write(changes)
+
+
+def test_flush_does_not_block_set(tmp_path):
+    backend = SlowBackend(pathlib.Path(tmp_path, 'saves.json'))
+    store = SettingsStore(backend, flush_delay=60)
+    store.set('a', 1)
+    thread = threading.Thread(target=store.flush)
+    thread.start()
+    assert backend.writing.wait(5)
+    values = {}
+    setter = threading.Thread(target=lambda: (store.set('b', 2), values.update(a=store.get('a'), b=store.get('b'))))
+    setter.start()
+    setter.join(1)
+    blocked = setter.is_alive()
+    backend.release.set()
+    setter.join(5)
+    assert not blocked
+    assert values == {'a': 1, 'b': 2}
+    thread.join(5)
+    assert store.get('b') == 2
+    store.flush()
+    assert backend.read() == {'a': 1, 'b': 2}
+
+
+class Component:
+    def __init__(self, _id, value=''):
+        self._id = _id
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+def test_load_applies_values_when_user_changes(tmp_path, monkeypatch):
+    store = SettingsStore(JsonBackend(pathlib.Path(tmp_path, 'saves.json')), flush_delay=60)
+    monkeypatch.setattr(saves, 'get_settings_store', lambda *args, **kwargs: store)
+    comp = Component('station')
+    save_components = saves.SaveComponents('test')
+    save_components.add_components(comp)
+
+    comp.set('A station')
+    save_components.save(user='A')
+    comp.set('B station')
+    save_components.save(user='B')
+
+    save_components.load(user='A')
+    assert comp.get() == 'A station'
+    save_components.load(user='B')
+    assert comp.get() == 'B station'
+    save_components.load(user='A')
+    assert comp.get() == 'A station'
@@ -0,0 +1,246 @@
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import contextlib
+import datetime
+import importlib
+import json
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+import uuid
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+TIMING_FILE_NAME = 'algaware_timing.jsonl'
+STARTUP_TIMING_FILE_NAME = 'algaware_startup.jsonl'
+
+# Set this environment variable to 1 to record import and construction time during startup
+STARTUP_PROFILE_VARIABLE = 'ALGAWARE_PROFILE_STARTUP'
+
+
+def _get_windows_memory_counters():
+    """
+    :return: PROCESS_MEMORY_COUNTERS of the current process or None if not on Windows
+    """
+    if sys.platform != 'win32':
+        return None
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD),
+                    ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t),
+                    ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t),
+                    ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    try:
+        get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_process_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+        get_process_memory_info.restype = wintypes.BOOL
+        get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+        get_current_process.restype = wintypes.HANDLE
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if not get_process_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+            return None
+        return counters
+    except (AttributeError, OSError):
+        return None
+
+
+def get_rss():
+    """
+    :return: Current resident memory of the process in bytes or None if not available
+    """
+    try:
+        with open('/proc/self/statm') as fid:
+            return int(fid.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    counters = _get_windows_memory_counters()
+    if counters is not None:
+        return counters.WorkingSetSize
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+def get_max_rss():
+    """
+    :return: Highest resident memory of the process since it started in bytes or None if not available
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is given in bytes on macOS and in kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+    counters = _get_windows_memory_counters()
+    if counters is not None:
+        return counters.PeakWorkingSetSize
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    except ImportError:
+        return None
+
+
+class StageTimer:
+    """
+    Records wall time, cpu time and memory for stages in load and plot.
+    Memory is recorded as the resident memory at the end of the stage (rss), its change during the stage
+    (rss_delta) and the highest resident memory of the process so far (max_rss).
+    Records are appended as json lines to log_directory/algaware_timing.jsonl on flush.
+    Only the records of the latest run are kept in memory after a flush.
+    """
+    def __init__(self, log_directory=None, file_name=TIMING_FILE_NAME):
+        self.file_path = pathlib.Path(log_directory, file_name) if log_directory else None
+        self.records = []
+        self._nr_written = 0
+        self._run = {}
+        self._lock = threading.Lock()
+
+    def start_run(self, operation):
+        """
+        Starts a new run. Following records are tagged with the run id and operation.
+        :param operation: e.g. "load" or "plot"
+        :return: run id
+        """
+        self._run = dict(run_id=uuid.uuid4().hex[:12], operation=operation)
+        return self._run['run_id']
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """
+        Context manager that records the time spent in the block.
+        :param name: Name of the stage
+        :param info: Extra info stored in the record (e.g. figure_key)
+        :return:
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        rss_start = get_rss()
+        try:
+            yield
+        finally:
+            rss = get_rss()
+            record = dict(self._run,
+                          stage=name,
+                          timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+                          wall_time=time.perf_counter() - wall_start,
+                          cpu_time=time.process_time() - cpu_start,
+                          rss=rss,
+                          rss_delta=rss - rss_start if rss is not None and rss_start is not None else None,
+                          max_rss=get_max_rss(),
+                          **info)
+            with self._lock:
+                self.records.append(record)
+
+    def flush(self):
+        """
+        Appends records not yet written to the timing file. Records of earlier runs are dropped from memory.
+        :return:
+        """
+        with self._lock:
+            records = self.records[self._nr_written:]
+            run_id = self._run.get('run_id')
+            self.records = [record for record in self.records if record.get('run_id') == run_id]
+            self._nr_written = len(self.records)
+        if not records or not self.file_path:
+            return
+        try:
+            os.makedirs(self.file_path.parent, exist_ok=True)
+            with open(self.file_path, 'a') as fid:
+                for record in records:
+                    fid.write(json.dumps(record, default=str) + '\n')
+        except OSError as e:
+            logger.warning(f'Could not write timing records: {e}')
+
+    def get_latest_run(self):
+        """
+        :return: list of records in the latest run
+        """
+        run_id = self._run.get('run_id')
+        return [record for record in self.records if record.get('run_id') == run_id]
+
+    def get_summary(self):
+        """
+        :return: Text with one line per stage of the latest run
+        """
+        lines = []
+        for record in self.get_latest_run():
+            name = record['stage']
+            if record.get('figure_key'):
+                name = f'{name} {record["figure_key"]}'
+            rss_delta = record.get('rss_delta')
+            rss_delta = f'{rss_delta / 1024 / 1024:+.0f} MB' if rss_delta is not None else '-'
+            lines.append(f'{name:<40} {record["wall_time"]:7.2f} s {record["cpu_time"]:7.2f} s cpu {rss_delta:>8}')
+        return '\n'.join(lines)
+
+
+startup_timer = StageTimer(file_name=STARTUP_TIMING_FILE_NAME)
+startup_timer.start_run('startup')
+
+
+def is_startup_profiling():
+    return os.environ.get(STARTUP_PROFILE_VARIABLE, '').strip().lower() in ['1', 'true', 'yes']
+
+
+@contextlib.contextmanager
+def profile_startup(name, **info):
+    """
+    Records the time spent in the block in startup_timer if startup profiling is on.
+    :param name: e.g. "construct PageAlgaware"
+    :param info:
+    :return:
+    """
+    if not is_startup_profiling():
+        yield
+        return
+    with startup_timer.stage(name, **info):
+        yield
+
+
+def import_module(name):
+    """
+    Imports and returns the module name. Used for heavy dependencies that are imported on first use.
+    The import time is recorded in startup_timer if startup profiling is on.
+    :param name:
+    :return:
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    with profile_startup(f'import {name}'):
+        return importlib.import_module(name)
+
+
+def log_startup_report(log_directory=None):
+    """
+    Logs the records in startup_timer and appends them to algaware_startup.jsonl in log_directory.
+    Does nothing if startup profiling is off.
+    :param log_directory:
+    :return:
+    """
+    if not is_startup_profiling():
+        return
+    if log_directory:
+        startup_timer.file_path = pathlib.Path(log_directory, STARTUP_TIMING_FILE_NAME)
+    startup_timer.flush()
+    logger.info('Startup profile:\n' + startup_timer.get_summary())